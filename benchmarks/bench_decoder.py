@@ -0,0 +1,58 @@
+''' Microbenchmark of the reply decoding, prints frames decoded per second.
+
+    python benchmarks/bench_decoder.py
+
+The frames are fed the way a socket returns them: a big stream of pipelined
+answers cut in fixed size chunks that split frames in arbitrary places.
+The old regex over str(bytes) is measured too, one answer at a time.
+'''
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyhelvarnet
+
+FRAMES = 100000
+CHUNK = 4096
+
+
+def Replies(count):
+    return [("?V:1,C:110,@1.10.%d.%d=%d#" % (subnet % 4 + 1, subnet % 64 + 1, subnet)).encode()
+            for subnet in range(count)]
+
+
+def BenchDecoder(replies):
+    stream = b"".join(replies)
+    chunks = [stream[i:i + CHUNK] for i in range(0, len(stream), CHUNK)]
+    decoder = pyhelvarnet.HelvarNetFrameDecoder()
+    start = time.perf_counter()
+    decoded = 0
+    for chunk in chunks:
+        decoded += len(decoder.Feed(chunk))
+    elapsed = time.perf_counter() - start
+    assert decoded == len(replies)
+    return decoded / elapsed
+
+
+def BenchDecoderSingle(replies):
+    decoder = pyhelvarnet.HelvarNetFrameDecoder()
+    start = time.perf_counter()
+    for reply in replies:
+        decoder.Feed(reply)[0].answer.decode()
+    return len(replies) / (time.perf_counter() - start)
+
+
+def BenchRegex(replies):
+    start = time.perf_counter()
+    for reply in replies:
+        re.search("(?<=\\=).*(?=#)", str(reply)).group()
+    return len(replies) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    replies = Replies(FRAMES)
+    print("decoder, %d byte chunks: %12.0f frames/s" % (CHUNK, BenchDecoder(replies)))
+    print("decoder, one reply each: %12.0f frames/s" % BenchDecoderSingle(replies))
+    print("regex on str(bytes):     %12.0f frames/s" % BenchRegex(replies))
@@ -0,0 +1,72 @@
+''' Per call overhead of the command logging, on a 10k command run.
+
+    python benchmarks/bench_logging.py
+
+The commands are encoded but not sent, so only the CPU spent per call is
+measured. Every run does the same mix of SetDeviceAbsoluteLevel,
+RecallSceneOnGroup and QueryLoadLevel calls with:
+    print: two print() calls per command, what the library used to do
+    debug: logging enabled at DEBUG, written to /dev/null
+    quiet: logging at its default level, nothing is formatted
+'''
+import contextlib
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyhelvarnet
+
+COMMANDS = 10000
+
+
+class NullRouter(pyhelvarnet.HelvarNetCommands):
+    ''' Encodes the messages and throws them away '''
+
+    def _Query(self, command, values, convert=None):
+        self._Message(command, values)
+
+    def _Send(self, command, values):
+        self._Message(command, values)
+
+
+class PrintRouter(NullRouter):
+    ''' Prints two lines per command, like the library did before logging '''
+
+    def _Message(self, command, values):
+        message = self._encoder.Encode(command, values)
+        print("Command " + str(command) + " for " + str(values) + ".")
+        print("Sent command looks like: " + message.decode())
+        return message
+
+
+def Run(router, count):
+    start = time.perf_counter()
+    for index in range(count // 3):
+        router.SetDeviceAbsoluteLevel(1, index % 64 + 1, index % 101, 0)
+        router.RecallSceneOnGroup(index % 16 + 1, 1, index % 16 + 1, 0)
+        router.QueryLoadLevel(1, index % 64 + 1)
+    return time.perf_counter() - start
+
+
+def Bench(name, router, handler, level, count):
+    logger = logging.getLogger("pyhelvarnet")
+    logger.handlers = [handler] if handler else []
+    logger.propagate = False
+    logger.setLevel(level)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(devnull)
+        elapsed = Run(router("192.168.1.10", 50000), count)
+    calls = count // 3 * 3
+    print("%-6s %8.3f s for %d commands, %7.2f us per call" % (name, elapsed, calls, elapsed / calls * 1e6))
+    return elapsed
+
+
+if __name__ == "__main__":
+    printed = Bench("print", PrintRouter, None, logging.WARNING, COMMANDS)
+    debug = Bench("debug", NullRouter, logging.StreamHandler(), logging.DEBUG, COMMANDS)
+    quiet = Bench("quiet", NullRouter, None, logging.WARNING, COMMANDS)
+    print("quiet saves %.2f us per call over print (%.1fx faster)" % (
+        (printed - quiet) / (COMMANDS // 3 * 3) * 1e6, printed / quiet))
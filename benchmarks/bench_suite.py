@@ -0,0 +1,254 @@
+''' Benchmark suite, run against the router simulator (helvarsim.py) in the
+same process. Measures commands per second and p50/p95/p99 latency of
+queries, control writes and full site scans at several concurrency levels,
+plus CPU microbenchmarks of the message encoding and the reply parsing.
+
+    python benchmarks/bench_suite.py --output results.json
+    python benchmarks/bench_suite.py --compare results.json
+
+With --compare the results are checked against an earlier JSON file, and the
+exit code is 1 if any benchmark got slower than --tolerance (10% by default).
+'''
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import pyhelvarnet
+import helvarsim
+
+ROUTER = "1.10"
+SUBNETS = 2
+DEVICES = 64
+GROUPS = 16
+
+
+def Percentile(latencies, percent):
+    if not latencies:
+        return None
+    index = min(len(latencies) - 1, int(round(percent / 100 * (len(latencies) - 1))))
+    return latencies[index]
+
+
+def Result(name, concurrency, count, elapsed, latencies=()):
+    latencies = sorted(latencies)
+    result = {"name": name, "concurrency": concurrency, "operations": count,
+              "seconds": round(elapsed, 6), "ops_per_s": round(count / elapsed, 1)}
+    for percent in (50, 95, 99):
+        value = Percentile(latencies, percent)
+        result["p%d_ms" % percent] = round(value * 1000, 4) if value is not None else None
+    return result
+
+
+def Timed(call):
+    start = time.perf_counter()
+    call()
+    return time.perf_counter() - start
+
+
+def RunThreads(call, count, concurrency):
+    ''' Runs call(index) count times from concurrency threads, returns the
+    elapsed time and every call latency
+    '''
+    def Worker(indexes):
+        return [Timed(lambda: call(index)) for index in indexes]
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        start = time.perf_counter()
+        parts = executor.map(Worker, [range(worker, count, concurrency) for worker in range(concurrency)])
+        latencies = [latency for part in parts for latency in part]
+        return time.perf_counter() - start, latencies
+
+
+def Address(index):
+    return index // DEVICES % SUBNETS + 1, index % DEVICES + 1
+
+
+################# Network benchmarks #################
+def BenchClientQueries(server, port, count, concurrency):
+    with pyhelvarnet.HelvarNetClient(server, port, maxConnections=concurrency) as client:
+        elapsed, latencies = RunThreads(lambda index: client.QueryLoadLevel(*Address(index)), count, concurrency)
+    return Result("client.QueryLoadLevel", concurrency, count, elapsed, latencies)
+
+
+def BenchClientWrites(server, port, count, concurrency):
+    with pyhelvarnet.HelvarNetClient(server, port, maxConnections=concurrency) as client:
+        elapsed, latencies = RunThreads(
+            lambda index: client.SetDeviceAbsoluteLevel(*Address(index), index % 101, 0), count, concurrency)
+    return Result("client.SetDeviceAbsoluteLevel", concurrency, count, elapsed, latencies)
+
+
+def BenchClientScenes(server, port, count, concurrency):
+    with pyhelvarnet.HelvarNetClient(server, port, maxConnections=concurrency) as client:
+        elapsed, latencies = RunThreads(
+            lambda index: client.RecallSceneOnGroup(index % GROUPS + 1, 1, index % 16 + 1, 0), count, concurrency)
+    return Result("client.RecallSceneOnGroup", concurrency, count, elapsed, latencies)
+
+
+def BenchPipelineQueries(server, port, count, concurrency):
+    ''' concurrency is the number of queries in flight on the connection '''
+    with pyhelvarnet.HelvarNetPipeline(server, port, maxInFlight=concurrency) as pipe:
+        sent = {}
+
+        def Done(future):
+            latencies.append(time.perf_counter() - sent.pop(future))
+
+        latencies = []
+        start = time.perf_counter()
+        futures = []
+        for index in range(count):
+            queued = time.perf_counter()
+            future = pipe.QueryLoadLevel(*Address(index))
+            sent[future] = queued
+            future.add_done_callback(Done)
+            futures.append(future)
+        concurrent.futures.wait(futures)
+        elapsed = time.perf_counter() - start
+    return Result("pipeline.QueryLoadLevel", concurrency, count, elapsed, latencies)
+
+
+def BenchAsyncQueries(server, port, count, concurrency):
+    async def Run():
+        async with pyhelvarnet.AsyncHelvarNetClient(server, port, maxConnections=concurrency) as client:
+            async def Worker(indexes):
+                latencies = []
+                for index in indexes:
+                    start = time.perf_counter()
+                    await client.QueryLoadLevel(*Address(index))
+                    latencies.append(time.perf_counter() - start)
+                return latencies
+
+            start = time.perf_counter()
+            parts = await asyncio.gather(*[Worker(range(worker, count, concurrency))
+                                           for worker in range(concurrency)])
+            return time.perf_counter() - start, [latency for part in parts for latency in part]
+
+    elapsed, latencies = asyncio.run(Run())
+    return Result("async.QueryLoadLevel", concurrency, count, elapsed, latencies)
+
+
+def BenchScan(server, port, count, concurrency):
+    ''' count full scans of the simulated site, concurrency is maxInFlight '''
+    latencies = []
+    for _ in range(count):
+        inventory = pyhelvarnet.HelvarNetInventory(server, port, maxInFlight=concurrency,
+                                                   subnets=range(1, SUBNETS + 1), addresses=range(1, DEVICES + 1))
+        latencies.append(Timed(inventory.Scan))
+        assert len(inventory.devices) == SUBNETS * DEVICES
+    return Result("inventory.Scan", concurrency, count, sum(latencies), latencies)
+
+
+################# CPU microbenchmarks #################
+def BenchEncode(count):
+    encoder = pyhelvarnet.HelvarNetEncoder(1, 10)
+    start = time.perf_counter()
+    for index in range(count):
+        encoder.Encode(14, (index % 101, 0, Address(index)))
+    return Result("cpu.Encode", 1, count, time.perf_counter() - start)
+
+
+def BenchEncodeMany(count):
+    encoder = pyhelvarnet.HelvarNetEncoder(1, 10)
+    commands = [(152, (Address(index),)) for index in range(count)]
+    start = time.perf_counter()
+    encoder.EncodeMany(commands)
+    return Result("cpu.EncodeMany", 1, count, time.perf_counter() - start)
+
+
+def BenchDecode(count):
+    stream = b"".join(("?V:1,C:152,@1.10.%d.%d=%d#" % (Address(index) + (index % 101,))).encode()
+                      for index in range(count))
+    chunks = [stream[i:i + 4096] for i in range(0, len(stream), 4096)]
+    decoder = pyhelvarnet.HelvarNetFrameDecoder()
+    start = time.perf_counter()
+    decoded = sum(len(decoder.Feed(chunk)) for chunk in chunks)
+    elapsed = time.perf_counter() - start
+    assert decoded == count
+    return Result("cpu.Decode", 1, count, elapsed)
+
+
+def Environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {"date": datetime.datetime.now().isoformat(timespec="seconds"), "commit": commit,
+            "python": platform.python_version(), "implementation": platform.python_implementation(),
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def Compare(results, baseline, tolerance):
+    ''' Benchmarks with fewer commands per second than the baseline allows '''
+    previous = {(result["name"], result["concurrency"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["name"], result["concurrency"]))
+        if old and result["ops_per_s"] < old["ops_per_s"] * (1 - tolerance):
+            regressions.append((result, old))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pyhelvarnet benchmark suite")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Slowdown allowed by --compare")
+    parser.add_argument("--count", type=int, default=2000, help="Commands per network benchmark")
+    parser.add_argument("--cpu-count", type=int, default=100000, help="Operations per CPU benchmark")
+    parser.add_argument("--scans", type=int, default=3, help="Full scans per scan benchmark")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated concurrency levels")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated router latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Simulated router jitter, seconds")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    simulator = helvarsim.HelvarNetSimulator.Generate(routers=[ROUTER], subnets=SUBNETS, devices=DEVICES,
+                                                      groups=GROUPS, latency=args.latency, jitter=args.jitter,
+                                                      seed=0)
+    benchmarks = [(BenchClientQueries, args.count), (BenchClientWrites, args.count),
+                  (BenchClientScenes, args.count), (BenchAsyncQueries, args.count),
+                  (BenchPipelineQueries, args.count), (BenchScan, args.scans)]
+    results = []
+    with simulator.Start(port=0):
+        server = simulator.RouterIP(ROUTER)
+        for benchmark, count in benchmarks:
+            for concurrency in levels:
+                result = benchmark(server, simulator.port, count, concurrency)
+                results.append(result)
+                print("%-32s x%-3d %10.1f ops/s  p50 %8s ms  p95 %8s ms  p99 %8s ms" % (
+                    result["name"], concurrency, result["ops_per_s"],
+                    result["p50_ms"], result["p95_ms"], result["p99_ms"]))
+    for benchmark in (BenchEncode, BenchEncodeMany, BenchDecode):
+        result = benchmark(args.cpu_count)
+        results.append(result)
+        print("%-32s      %10.1f ops/s" % (result["name"], result["ops_per_s"]))
+
+    report = {"environment": Environment(),
+              "settings": {"count": args.count, "cpu_count": args.cpu_count, "scans": args.scans,
+                           "latency": args.latency, "jitter": args.jitter,
+                           "site": {"routers": 1, "subnets": SUBNETS, "devices": DEVICES, "groups": GROUPS}},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = Compare(results, json.load(f), args.tolerance)
+        for result, old in regressions:
+            print("REGRESSION %s x%d: %.1f ops/s, was %.1f" % (
+                result["name"], result["concurrency"], result["ops_per_s"], old["ops_per_s"]))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+''' HelvarNet gateway, one process in front of the routers that every local
+service talks to instead of the routers themselves. It speaks the HelvarNet
+text protocol on TCP, so the services keep using pyhelvarnet (or anything
+else) as they do now, and the routers only see the gateway:
+
+    - a few persistent pipelined connections per router, whatever the number
+      of services and connections on the local side
+    - one cache of the answers for everybody (HelvarNetCache, with the
+      CACHE_TTLS and CACHE_INVALIDATIONS of pyhelvarnet)
+    - identical queries waiting for the router at the same time, from any
+      service, share a single request
+    - a rate limit per router, the waiting requests in priority order
+      (control commands first, see HelvarNetPriority)
+
+From the command line:
+
+    python helvargateway.py --server 192.168.0.200 --routers 1.200,1.201 --rps 30
+
+Every router gets its own address on 127.0.<cluster>.<router> (the whole
+127.0.0.0/8 is loopback on Linux), so the clients derive the right device
+addresses:
+
+    router = pyhelvarnet.HelvarNetClient("127.0.1.200", 50000)
+
+Connections to --host (without --no-loopback-routers, as well) go to the
+first router. Like with the outbox of the client, a query may reach the
+router before a command sent just before it: commands go through their own
+connection, in order, and queries through the others. A command sent with
+A:1 waits for its answer before the next request of the client is read.
+'''
+import argparse
+import asyncio
+import collections
+import itertools
+import logging
+import threading
+
+import pyhelvarnet
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _CacheKey(frame, router):
+    ''' (router, command, values) the request is cached and invalidated
+    under: the router of the device address when it has one, whatever the
+    router the client is connected to, so every device has a single entry
+    '''
+    command, values = frame.Request(router)
+    for value in values or ():
+        if isinstance(value, tuple) and len(value) == 4:
+            router = value[0] + "." + value[1]
+            command, values = frame.Request(router)
+            break
+    return router, command, values
+
+
+class _Router:
+    ''' Upstream side of one router: the first connection takes the commands,
+    in order, the queries go round robin over the others
+    '''
+
+    def __init__(self, name, server, port, connections, maxInFlight, timeout, rps, burst):
+        self.name = name
+        self.pipes = [pyhelvarnet.AsyncHelvarNetPipeline(server, port, maxInFlight, timeout)
+                      for _ in range(max(connections, 1))]
+        self.queries = itertools.cycle(self.pipes[1:] or self.pipes)
+        self.limit = pyhelvarnet.AsyncHelvarNetScheduler(rps, burst) if rps else None
+        self.inflight = {}  # correlation key -> Task with the reply frame
+
+    async def Wait(self, command):
+        if self.limit is not None:
+            await self.limit.Acquire(pyhelvarnet.HelvarNetPriority.ForCommand(command))
+
+    async def Close(self):
+        for pipe in self.pipes:
+            await pipe.Close()
+
+
+class HelvarNetGateway:
+    ''' Serves the routers at server (any router of the workgroup, the others
+    are on the same network) to local clients, see the module docstring.
+    connections is the number of upstream connections per router, each one
+    with up to maxInFlight queries waiting for their answer. rps limits the
+    requests per second to each router. cache is a HelvarNetCache to share,
+    by default the gateway has its own, False for none.
+
+        gateway = HelvarNetGateway("192.168.0.200", ["1.200", "1.201"], rps=30)
+        with gateway.Start(port=50000):
+            ...
+    '''
+
+    def __init__(self, server, routers, port=50000, connections=2, maxInFlight=64, timeout=10,
+                 rps=None, burst=None, cache=None, deduplicate=True):
+        self.server = server
+        self.routers = list(routers)
+        self.deduplicate = deduplicate
+        self.cache = pyhelvarnet.HelvarNetCache() if cache is None else cache if cache is not False else None
+        self.stats = collections.Counter()
+        self.port = None
+        self.__routers = {router: _Router(router, self.RouterIP(router), port, connections, maxInFlight,
+                                          timeout, rps, burst) for router in self.routers}
+        self.__servers = []
+        self.__connections = {}  # Task serving a local connection -> its writer
+        self.__loop = None
+        self.__thread = None
+
+    def RouterIP(self, router):
+        return pyhelvarnet.RouterIP(self.server, router)
+
+    def Stats(self):
+        stats = dict(self.stats, clients=len(self.__connections))
+        stats["waiting"] = {name: len(router.limit) for name, router in self.__routers.items()
+                            if router.limit is not None}
+        if self.cache is not None:
+            stats["cache"] = self.cache.Stats()
+        return stats
+
+    async def Serve(self, host="127.0.0.1", port=50000, routersOnLoopback=True):
+        ''' Starts listening in the running loop, with routersOnLoopback every
+        router also listens on 127.0.<cluster>.<router>, on the same port
+        '''
+        hosts = [(host, self.routers[0])]
+        if routersOnLoopback:
+            hosts += [("127.0." + router, router) for router in self.routers]
+        for address, router in hosts:
+            server = await asyncio.start_server(
+                lambda reader, writer, router=router: self.__ServeConnection(reader, writer, router),
+                address, port)
+            port = port or server.sockets[0].getsockname()[1]
+            self.__servers.append(server)
+        self.port = port
+        return self
+
+    async def Shutdown(self):
+        for server in self.__servers:
+            server.close()
+        connections = list(self.__connections.items())
+        for connection, writer in connections:
+            writer.close()
+        await asyncio.gather(*[connection for connection, writer in connections], return_exceptions=True)
+        for server in self.__servers:
+            await server.wait_closed()
+        self.__servers = []
+        for router in self.__routers.values():
+            await router.Close()
+
+    def Start(self, host="127.0.0.1", port=50000, routersOnLoopback=True):
+        ''' Runs the gateway in a background thread with its own event loop,
+        port=0 picks a free port (see .port). Returns self, so it can be used
+        as a context manager that stops it on exit.
+        '''
+        self.__loop = asyncio.new_event_loop()
+        try:
+            self.__loop.run_until_complete(self.Serve(host, port, routersOnLoopback))
+        except Exception:
+            self.__loop.close()
+            raise
+
+        def Run():
+            self.__loop.run_forever()
+            self.__loop.run_until_complete(self.Shutdown())
+            self.__loop.close()
+
+        self.__thread = threading.Thread(target=Run, daemon=True)
+        self.__thread.start()
+        return self
+
+    def Stop(self):
+        if self.__thread is not None:
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+            self.__thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Stop()
+
+    async def __ServeConnection(self, reader, writer, router):
+        self.__connections[asyncio.current_task()] = writer
+        self.stats["connections"] += 1
+        router = self.__routers[router]
+        decoder = pyhelvarnet.HelvarNetFrameDecoder()
+        answering = set()  # Tasks answering the queries of this connection
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for frame in decoder.Feed(data):
+                    if frame.prefix != b">":
+                        continue
+                    key = _CacheKey(frame, router.name)
+                    command = key[1]
+                    if command is not None and 100 <= command < 200:
+                        task = asyncio.ensure_future(self.__Answer(router, frame, key, writer))
+                        answering.add(task)
+                        task.add_done_callback(answering.discard)
+                    elif b"A:1" in frame.fields.split(b","):
+                        # A command that wants an answer goes with the other
+                        # commands, and waits for it to keep their order
+                        await self.__Answer(router, frame, key, writer, router.pipes[0])
+                    else:
+                        # Waits here, so the commands of a client keep their order
+                        await self.__Forward(router, frame.fields, key)
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            for task in answering:
+                task.cancel()
+            self.__connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def __Answer(self, router, request, key, writer, pipe=None):
+        ''' key is the _CacheKey of the request, pipe the upstream connection
+        to use (the next one for queries by default)
+        '''
+        fields = request.fields
+        self.stats["queries"] += 1
+        answer = None
+        if self.cache is not None and key[2] is not None:
+            answer = self.cache.Get(*key)
+        if answer is not None:
+            self.stats["cached"] += 1
+            reply = b"?" + fields + b"=" + answer.encode() + b"#"
+        else:
+            try:
+                frame = await self.__Fetch(router, request, key, pipe)
+            except OSError as error:
+                # Nothing to answer, the client times out like without the gateway
+                self.stats["failed"] += 1
+                _LOGGER.debug("No answer from router %s to %s: %s", router.name, fields, error)
+                return
+            reply = frame.prefix + fields + (b"" if frame.answer is None else b"=" + frame.answer) + b"#"
+        if not writer.is_closing():
+            writer.write(reply)
+
+    async def __Fetch(self, router, request, key, pipe):
+        ''' Reply frame, from a single upstream request for all the identical
+        queries waiting at the same time
+        '''
+        if not self.deduplicate or pipe is not None:
+            return await self.__Request(router, request.fields, key, pipe)
+        correlation = request.Key()
+        task = router.inflight.get(correlation)
+        if task is None:
+            task = router.inflight[correlation] = asyncio.ensure_future(
+                self.__Request(router, request.fields, key, pipe))
+            task.add_done_callback(lambda done: self.__Done(router, correlation, done))
+        else:
+            self.stats["deduplicated"] += 1
+        # Shielded, a client that goes away doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def __Done(router, key, task):
+        router.inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # Retrieved, even when every client went away
+
+    async def __Request(self, router, fields, key, pipe):
+        cacheRouter, command, values = key
+        await router.Wait(command)
+        self.stats["upstream"] += 1
+        frame = await (pipe or next(router.queries)).Request(b">" + fields + b"#")
+        if frame.prefix == b"?" and self.cache is not None and values is not None:
+            if 100 <= command < 200 and frame.answer is not None:
+                # As text, like HelvarNetClient keeps them, the cache can be shared
+                self.cache.Put(cacheRouter, command, values, frame.answer.decode(errors="replace"))
+            else:
+                self.cache.Invalidate(cacheRouter, command, values)
+        return frame
+
+    async def __Forward(self, router, fields, key):
+        cacheRouter, command, values = key
+        await router.Wait(command)
+        try:
+            await router.pipes[0].Send(b">" + fields + b"#")
+        except OSError as error:
+            self.stats["failed"] += 1
+            _LOGGER.warning("Command not sent to router %s: %s", router.name, error)
+            return
+        self.stats["commands"] += 1
+        if self.cache is not None and values is not None:
+            self.cache.Invalidate(cacheRouter, command, values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HelvarNet gateway")
+    parser.add_argument("--server", required=True, help="IP address of a router")
+    parser.add_argument("--server-port", type=int, default=50000)
+    parser.add_argument("--routers", help="Comma separated cluster.router list, the router at --server by default")
+    parser.add_argument("--discover", action="store_true", help="Ask the router at --server for the routers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=50000)
+    parser.add_argument("--no-loopback-routers", action="store_true",
+                        help="Don't listen on 127.0.<cluster>.<router> for every router")
+    parser.add_argument("--connections", type=int, default=2, help="Upstream connections per router")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="Queries waiting per upstream connection")
+    parser.add_argument("--timeout", type=float, default=10, help="Seconds")
+    parser.add_argument("--rps", type=float, default=None, help="Requests per second per router")
+    parser.add_argument("--burst", type=int, default=None)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--stats-interval", type=float, default=0, help="Log the stats every that many seconds")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.discover:
+        with pyhelvarnet.HelvarNetCluster(args.server, args.server_port, timeout=args.timeout) as site:
+            routers = site.Discover()
+    elif args.routers:
+        routers = args.routers.split(",")
+    else:
+        routers = [args.server.split(".", 2)[2]]
+    gateway = HelvarNetGateway(args.server, routers, args.server_port, args.connections, args.max_in_flight,
+                               args.timeout, args.rps, args.burst, cache=False if args.no_cache else None)
+
+    async def Run():
+        await gateway.Serve(args.host, args.port, not args.no_loopback_routers)
+        _LOGGER.info("Gateway for routers %s on port %s", ", ".join(gateway.routers), gateway.port)
+        while True:
+            await asyncio.sleep(args.stats_interval or 3600)
+            if args.stats_interval:
+                _LOGGER.info("%s", gateway.Stats())
+
+    try:
+        asyncio.run(Run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
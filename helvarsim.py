@@ -0,0 +1,640 @@
+''' HelvarNet router simulator, to test and benchmark pyhelvarnet without a real
+router. It speaks the HelvarNet text protocol on TCP (and UDP), keeps the state
+of a whole workgroup (clusters, routers, subnets, devices and groups), answers
+every query the client implements and applies the control and configuration
+commands to that state.
+
+Latency, jitter, replies split in small TCP segments and failures (error
+replies, lost replies, dropped connections) can be injected to see how the
+client behaves.
+
+From the command line:
+
+    python helvarsim.py --routers 1.10,1.11 --subnets 2 --devices 32 --groups 8
+
+Every router listens on 127.0.<cluster>.<router> (the whole 127.0.0.0/8 is
+loopback on Linux), so the client derives the right device addresses:
+
+    router = pyhelvarnet.HelvarNetClient("127.0.1.10", 50000)
+
+Or in the same process:
+
+    simulator = helvarsim.HelvarNetSimulator.Generate(routers=["1.10"], devices=16)
+    with simulator.Start(port=0):
+        router = pyhelvarnet.HelvarNetClient(simulator.RouterIP("1.10"), simulator.port)
+'''
+import argparse
+import asyncio
+import dataclasses
+import json
+import random
+import threading
+import time
+
+import pyhelvarnet
+
+# Bits of the device state answered to QueryDeviceState (C:110)
+DISABLED = 0x00000001
+LAMP_FAILURE = 0x00000002
+MISSING = 0x00000004
+FAULTY = 0x00000008
+BATTERY_FAILURE = 0x00040000
+
+# Error codes of the diagnostic replies
+ERROR_INVALID_GROUP = 1
+ERROR_CLUSTER_DOES_NOT_EXIST = 9
+ERROR_ROUTER_DOES_NOT_EXIST = 10
+ERROR_DEVICE_DOES_NOT_EXIST = 11
+ERROR_INVALID_COMMAND = 15
+ERROR_MISSING_PARAMETER = 17
+
+
+class SimulatorError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+@dataclasses.dataclass
+class SimulatedDevice:
+    address: str  # cluster.router.subnet.device
+    type: int = 1  # DALI fluorescent lamp
+    description: str = ""
+    level: int = 0
+    base: int = None  # Level that proportion 0 stands for, the last one set or recalled
+    proportion: int = 0  # -100 (off) .. 100 (full level)
+    state: int = 0
+    power: float = 36.0  # Watts at full level
+    scenes: dict = dataclasses.field(default_factory=dict)  # "block.scene" -> level
+    emergency: bool = False
+    batteryCharge: int = 100
+    batteryTime: int = 180  # Minutes
+    lampTime: int = 0  # Hours
+    functionTestTime: int = 0
+    functionTestState: int = 0
+    durationTestTime: int = 0
+    durationTestState: int = 0
+    inputState: int = 0
+    measurement: int = 0
+
+    def __post_init__(self):
+        if self.base is None:
+            self.base = self.level
+
+
+@dataclasses.dataclass
+class SimulatedGroup:
+    group: int
+    description: str = ""
+    members: list = dataclasses.field(default_factory=list)  # Device addresses
+    lastScenes: dict = dataclasses.field(default_factory=dict)  # block -> scene
+
+
+class HelvarNetSimulator:
+    ''' Workgroup state plus the protocol servers. Faults:
+        latency, jitter: seconds added to every reply (latency + random jitter)
+        serviceTime: seconds the router is busy with every request, requests
+            on a connection are processed one after the other like on the bus
+        splitReplies: replies are written in segments of 1 to 8 bytes
+        errorRate, dropRate, disconnectRate: probability of answering a query
+            with an error, not answering it at all or closing the connection
+    '''
+
+    def __init__(self, devices=(), groups=(), latency=0.0, jitter=0.0, serviceTime=0.0,
+                 splitReplies=False, errorRate=0.0, dropRate=0.0, disconnectRate=0.0, seed=None):
+        self.devices = {device.address: device for device in devices}
+        self.groups = {group.group: group for group in groups}
+        self.routers = sorted({device.address.rsplit(".", 2)[0] for device in devices},
+                              key=lambda router: [int(part) for part in router.split(".")])
+        self.latency = latency
+        self.jitter = jitter
+        self.serviceTime = serviceTime
+        self.splitReplies = splitReplies
+        self.errorRate = errorRate
+        self.dropRate = dropRate
+        self.disconnectRate = disconnectRate
+        self.timeOffset = 0
+        self.longitude = 0
+        self.latitude = 0
+        self.timezone = 0
+        self.dst = False
+        self.swVersion = "2.4.4"
+        self.helvarNetVersion = "1"
+        self.received = 0  # Commands processed
+        self.port = None
+        self.udpPort = None
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()  # State is shared by the TCP and UDP servers
+        self.__loop = None
+        self.__thread = None
+        self.__servers = []
+        self.__transports = []
+        self.__connections = {}  # Handler task -> writer
+
+    @classmethod
+    def Generate(cls, routers=("1.10",), subnets=1, devices=64, groups=16, emergency=0.1, **options):
+        ''' Workgroup with the same number of devices on every subnet of every
+        router, the devices spread across the groups
+        '''
+        generator = random.Random(options.get("seed"))
+        deviceList = []
+        for router in routers:
+            for subnet in range(1, subnets + 1):
+                for device in range(1, devices + 1):
+                    address = router + "." + str(subnet) + "." + str(device)
+                    isEmergency = generator.random() < emergency
+                    deviceList.append(SimulatedDevice(
+                        address, type=1 if not isEmergency else 0x0101,
+                        description="Luminaire " + address, emergency=isEmergency,
+                        power=generator.choice((18.0, 28.0, 36.0, 54.0)),
+                        scenes={"1." + str(scene): min(100, (scene - 1) * 7) for scene in range(1, 17)},
+                        lampTime=generator.randrange(0, 20000)))
+        groupList = [SimulatedGroup(group, "Group " + str(group)) for group in range(1, groups + 1)]
+        for index, device in enumerate(deviceList):
+            if groupList:
+                groupList[index % len(groupList)].members.append(device.address)
+        return cls(deviceList, groupList, **options)
+
+    @classmethod
+    def FromConfig(cls, config, **options):
+        ''' config is a dict (as loaded from a JSON file) either with the
+        Generate arguments or with explicit "devices" and "groups" lists, the
+        "faults" dict has the fault injection options
+        '''
+        options = dict(config.get("faults", {}), **options)
+        if "devices" in config and isinstance(config["devices"], list):
+            devices = [SimulatedDevice(**device) for device in config["devices"]]
+            groups = [SimulatedGroup(**group) for group in config.get("groups", [])]
+            return cls(devices, groups, **options)
+        return cls.Generate(config.get("routers", ("1.10",)), config.get("subnets", 1),
+                            config.get("devices", 64), config.get("groups", 16),
+                            config.get("emergency", 0.1), **options)
+
+    @staticmethod
+    def RouterIP(router):
+        return "127.0." + router
+
+    ################# Protocol #################
+    def Handle(self, frame):
+        ''' Reply to a frame as bytes, None if there is nothing to answer '''
+        fields = frame.fields.decode(errors="replace")
+        parameters = {}
+        for field in fields.split(","):
+            if field.startswith("@"):
+                parameters["@"] = field[1:]
+            elif ":" in field:
+                name, value = field.split(":", 1)
+                parameters[name] = value
+        with self.__lock:
+            self.received += 1
+            try:
+                command = int(parameters.get("C", ""))
+                handler = self.__handlers.get(command)
+                if handler is None or frame.prefix != b">":
+                    raise SimulatorError(ERROR_INVALID_COMMAND)
+                answer = handler(self, parameters)
+            except SimulatorError as error:
+                return ("!" + fields + "=" + str(error.code) + "#").encode()
+            except (KeyError, ValueError):
+                return ("!" + fields + "=" + str(ERROR_MISSING_PARAMETER) + "#").encode()
+        if answer is None:
+            if parameters.get("A") == "1":
+                answer = 0  # Acknowledge requested
+            else:
+                return None
+        if self.errorRate and self.__random.random() < self.errorRate:
+            return ("!" + fields + "=" + str(ERROR_DEVICE_DOES_NOT_EXIST) + "#").encode()
+        if isinstance(answer, bool):
+            answer = int(answer)
+        return ("?" + fields + "=" + str(answer) + "#").encode()
+
+    def __Device(self, parameters):
+        address = parameters["@"]
+        device = self.devices.get(address)
+        if device is None:
+            router = address.rsplit(".", 2)[0]
+            if router not in self.routers:
+                cluster = address.split(".")[0]
+                if not any(known.split(".")[0] == cluster for known in self.routers):
+                    raise SimulatorError(ERROR_CLUSTER_DOES_NOT_EXIST)
+                raise SimulatorError(ERROR_ROUTER_DOES_NOT_EXIST)
+            raise SimulatorError(ERROR_DEVICE_DOES_NOT_EXIST)
+        return device
+
+    def __Group(self, parameters):
+        group = self.groups.get(int(parameters["G"]))
+        if group is None:
+            raise SimulatorError(ERROR_INVALID_GROUP)
+        return group
+
+    def __Members(self, group):
+        return [self.devices[address] for address in group.members if address in self.devices]
+
+    @staticmethod
+    def __Recall(device, block, scene):
+        level = device.scenes.get(block + "." + scene)
+        if level is not None:
+            device.level = device.base = level
+            device.proportion = 0
+
+    @staticmethod
+    def __Level(device, level):
+        device.level = device.base = level
+        device.proportion = 0
+
+    @staticmethod
+    def __Proportion(device, proportion):
+        ''' Positive proportions go from the base level up to 100, negative
+        ones down to 0
+        '''
+        device.proportion = max(-100, min(100, proportion))
+        span = 100 - device.base if device.proportion > 0 else device.base
+        device.level = int(round(device.base + span * device.proportion / 100))
+
+    # Control
+    def __RecallSceneOnGroup(self, parameters):
+        group = self.__Group(parameters)
+        for device in self.__Members(group):
+            self.__Recall(device, parameters["B"], parameters["S"])
+        group.lastScenes[parameters["B"]] = int(parameters["S"])
+
+    def __RecallSceneOnDevice(self, parameters):
+        self.__Recall(self.__Device(parameters), parameters["B"], parameters["S"])
+
+    def __SetGroupLevel(self, parameters):
+        for device in self.__Members(self.__Group(parameters)):
+            self.__Level(device, int(parameters["L"]))
+
+    def __SetDeviceLevel(self, parameters):
+        self.__Level(self.__Device(parameters), int(parameters["L"]))
+
+    def __SetGroupProportion(self, parameters):
+        for device in self.__Members(self.__Group(parameters)):
+            self.__Proportion(device, int(parameters["P"]))
+
+    def __SetDeviceProportion(self, parameters):
+        self.__Proportion(self.__Device(parameters), int(parameters["P"]))
+
+    def __ModifyGroupProportion(self, parameters):
+        for device in self.__Members(self.__Group(parameters)):
+            self.__Proportion(device, device.proportion + int(parameters["P"]))
+
+    def __ModifyDeviceProportion(self, parameters):
+        device = self.__Device(parameters)
+        self.__Proportion(device, device.proportion + int(parameters["P"]))
+
+    # Queries
+    def __QueryClusters(self, parameters):
+        return ",".join(sorted({router.split(".")[0] for router in self.routers}, key=int))
+
+    def __QueryRouters(self, parameters):
+        cluster = parameters["@"]
+        routers = [router.split(".")[1] for router in self.routers if router.split(".")[0] == cluster]
+        if not routers:
+            raise SimulatorError(ERROR_CLUSTER_DOES_NOT_EXIST)
+        return ",".join(routers)
+
+    def __QueryLastSceneInBlock(self, parameters):
+        return self.__Group(parameters).lastScenes.get(parameters["B"], 1)
+
+    def __QueryDeviceType(self, parameters):
+        return self.__Device(parameters).type
+
+    def __QueryGroupDescription(self, parameters):
+        return self.__Group(parameters).description
+
+    def __QueryDeviceDescription(self, parameters):
+        return self.__Device(parameters).description
+
+    def __QueryDeviceState(self, parameters):
+        return self.__Device(parameters).state
+
+    def __QueryStateBit(bit):
+        return lambda self, parameters: bool(self._HelvarNetSimulator__Device(parameters).state & bit)
+
+    def __QueryDeviceMeasurement(self, parameters):
+        return self.__Device(parameters).measurement
+
+    def __QueryDeviceInputState(self, parameters):
+        return self.__Device(parameters).inputState
+
+    def __QueryLoadLevel(self, parameters):
+        return self.__Device(parameters).level
+
+    @staticmethod
+    def __Power(device):
+        return round(device.power * device.level / 100, 1)
+
+    def __QueryDevicePower(self, parameters):
+        return self.__Power(self.__Device(parameters))
+
+    def __QueryGroupPower(self, parameters):
+        return round(sum(self.__Power(device) for device in self.__Members(self.__Group(parameters))), 1)
+
+    def __QueryGroup(self, parameters):
+        return ",".join("@" + address for address in self.__Group(parameters).members)
+
+    def __QueryGroups(self, parameters):
+        return ",".join(str(group) for group in sorted(self.groups))
+
+    def __QueryDeviceField(name):
+        return lambda self, parameters: getattr(self._HelvarNetSimulator__Device(parameters), name)
+
+    def __QueryTime(self, parameters):
+        return int(time.time()) + self.timeOffset
+
+    # Configuration
+    def __Store(self, device, parameters, level):
+        key = parameters["B"] + "." + parameters["S"]
+        # Scenes set to "ignore" are only overwritten with the force flag
+        if key in device.scenes or parameters.get("O") == "1":
+            device.scenes[key] = level
+
+    def __StoreSceneForGroup(self, parameters):
+        for device in self.__Members(self.__Group(parameters)):
+            self.__Store(device, parameters, int(parameters["L"]))
+
+    def __StoreSceneOnDevice(self, parameters):
+        self.__Store(self.__Device(parameters), parameters, int(parameters["L"]))
+
+    def __StoreCurrSceneForGroup(self, parameters):
+        for device in self.__Members(self.__Group(parameters)):
+            self.__Store(device, parameters, device.level)
+
+    def __StoreCurrSceneForDevice(self, parameters):
+        device = self.__Device(parameters)
+        self.__Store(device, parameters, device.level)
+
+    def __ResetGroupEmergency(self, parameters):
+        for device in self.__Members(self.__Group(parameters)):
+            device.lampTime = 0
+            device.batteryTime = 180
+
+    def __ResetDeviceEmergency(self, parameters):
+        device = self.__Device(parameters)
+        device.lampTime = 0
+        device.batteryTime = 180
+
+    def __SetTime(self, parameters):
+        self.timeOffset = int(parameters["T"]) - int(time.time())
+
+    def __SetLongitude(self, parameters):
+        self.longitude = parameters["E"]
+
+    def __SetLatitude(self, parameters):
+        self.latitude = parameters["N"]
+
+    def __SetTimezone(self, parameters):
+        self.timezone = int(parameters["Z"])
+
+    def __SetDST(self, parameters):
+        self.dst = parameters["Y"] == "1"
+
+    __handlers = {
+        11: __RecallSceneOnGroup,
+        12: __RecallSceneOnDevice,
+        13: __SetGroupLevel,
+        14: __SetDeviceLevel,
+        15: __SetGroupProportion,
+        16: __SetDeviceProportion,
+        17: __ModifyGroupProportion,
+        18: __ModifyDeviceProportion,
+        101: __QueryClusters,
+        102: __QueryRouters,
+        103: __QueryLastSceneInBlock,
+        104: __QueryDeviceType,
+        105: __QueryGroupDescription,
+        106: __QueryDeviceDescription,
+        110: __QueryDeviceState,
+        111: __QueryStateBit(DISABLED),
+        112: __QueryStateBit(LAMP_FAILURE),
+        113: __QueryStateBit(MISSING),
+        114: __QueryStateBit(FAULTY),
+        129: __QueryStateBit(BATTERY_FAILURE),
+        150: __QueryDeviceMeasurement,
+        151: __QueryDeviceInputState,
+        152: __QueryLoadLevel,
+        160: __QueryDevicePower,
+        161: __QueryGroupPower,
+        164: __QueryGroup,
+        165: __QueryGroups,
+        170: __QueryDeviceField("functionTestTime"),
+        171: __QueryDeviceField("functionTestState"),
+        172: __QueryDeviceField("durationTestTime"),
+        173: __QueryDeviceField("durationTestState"),
+        174: __QueryDeviceField("batteryCharge"),
+        175: __QueryDeviceField("batteryTime"),
+        176: __QueryDeviceField("lampTime"),
+        185: __QueryTime,
+        186: lambda self, parameters: self.longitude,
+        187: lambda self, parameters: self.latitude,
+        188: lambda self, parameters: self.timezone,
+        189: lambda self, parameters: self.dst,
+        190: lambda self, parameters: self.swVersion,
+        191: lambda self, parameters: self.helvarNetVersion,
+        201: __StoreSceneForGroup,
+        202: __StoreSceneOnDevice,
+        203: __StoreCurrSceneForGroup,
+        204: __StoreCurrSceneForDevice,
+        205: __ResetGroupEmergency,
+        206: __ResetDeviceEmergency,
+        241: __SetTime,
+        242: __SetLongitude,
+        243: __SetLatitude,
+        244: __SetTimezone,
+        245: __SetDST,
+    }
+
+    ################# Servers #################
+    def __Delay(self):
+        return self.latency + (self.__random.random() * self.jitter if self.jitter else 0)
+
+    def __Chunks(self, reply):
+        if not self.splitReplies:
+            return [reply]
+        chunks = []
+        while reply:
+            size = self.__random.randint(1, 8)
+            chunks.append(reply[:size])
+            reply = reply[size:]
+        return chunks
+
+    async def __ServeConnection(self, reader, writer):
+        self.__connections[asyncio.current_task()] = writer
+        replies = asyncio.Queue()  # (time to write it, reply), in order
+        sender = asyncio.ensure_future(self.__WriteReplies(writer, replies))
+        decoder = pyhelvarnet.HelvarNetFrameDecoder()
+        busyUntil = 0
+        try:
+            while not writer.is_closing():
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for frame in decoder.Feed(data):
+                    now = time.monotonic()
+                    busyUntil = max(busyUntil, now) + self.serviceTime
+                    reply = self.Handle(frame)
+                    if self.disconnectRate and self.__random.random() < self.disconnectRate:
+                        writer.close()
+                        break
+                    if reply is None or (self.dropRate and self.__random.random() < self.dropRate):
+                        continue
+                    replies.put_nowait((max(busyUntil, now + self.__Delay()), reply))
+        except (OSError, asyncio.CancelledError):
+            sender.cancel()
+        finally:
+            replies.put_nowait((0, None))
+            await asyncio.gather(sender, return_exceptions=True)
+            self.__connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def __WriteReplies(self, writer, replies):
+        while True:
+            due, reply = await replies.get()
+            if reply is None:
+                return
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            for chunk in self.__Chunks(reply):
+                writer.write(chunk)
+                await writer.drain()
+
+    class __Datagrams(asyncio.DatagramProtocol):
+        def __init__(self, simulator):
+            self.simulator = simulator
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, address):
+            # Several commands can share a datagram, the replies go back together
+            replies = [self.simulator.Handle(frame)
+                       for frame in pyhelvarnet.HelvarNetFrameDecoder().Feed(data)]
+            replies = b"".join(reply for reply in replies if reply)
+            if replies:
+                asyncio.get_running_loop().call_later(
+                    self.simulator._HelvarNetSimulator__Delay(), self.transport.sendto, replies, address)
+
+    async def Serve(self, host="127.0.0.1", port=50000, udpPort=None, routersOnLoopback=False):
+        ''' Starts listening in the running loop. With routersOnLoopback every
+        router also listens on 127.0.<cluster>.<router>, on the same ports.
+        '''
+        hosts = [host] + ([self.RouterIP(router) for router in self.routers] if routersOnLoopback else [])
+        for address in hosts:
+            server = await asyncio.start_server(self.__ServeConnection, address, port)
+            port = port or server.sockets[0].getsockname()[1]
+            self.__servers.append(server)
+            if udpPort is not None:
+                transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+                    lambda: self.__Datagrams(self), local_addr=(address, udpPort))
+                udpPort = udpPort or transport.get_extra_info("sockname")[1]
+                self.__transports.append(transport)
+        self.port = port
+        self.udpPort = udpPort
+        return self
+
+    async def Shutdown(self):
+        for server in self.__servers:
+            server.close()
+        for transport in self.__transports:
+            transport.close()
+        connections = list(self.__connections.items())
+        for connection, writer in connections:
+            writer.close()
+        await asyncio.gather(*[connection for connection, writer in connections], return_exceptions=True)
+        for server in self.__servers:
+            await server.wait_closed()
+        self.__servers = []
+        self.__transports = []
+
+    def Start(self, host="127.0.0.1", port=50000, udpPort=None, routersOnLoopback=True):
+        ''' Runs the servers in a background thread with its own event loop,
+        port=0 picks a free port (see .port). Returns self, so it can be used
+        as a context manager that stops it on exit.
+        '''
+        started = threading.Event()
+        failure = []
+
+        def Run():
+            self.__loop = asyncio.new_event_loop()
+            try:
+                self.__loop.run_until_complete(self.Serve(host, port, udpPort, routersOnLoopback))
+            except Exception as error:
+                failure.append(error)
+                started.set()
+                return
+            started.set()
+            self.__loop.run_forever()
+            self.__loop.run_until_complete(self.Shutdown())
+            self.__loop.close()
+
+        self.__thread = threading.Thread(target=Run, daemon=True)
+        self.__thread.start()
+        started.wait()
+        if failure:
+            raise failure[0]
+        return self
+
+    def Stop(self):
+        if self.__thread is not None:
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+            self.__thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HelvarNet router simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=50000)
+    parser.add_argument("--udp-port", type=int, default=None, help="Also listen on UDP on this port")
+    parser.add_argument("--config", help="JSON file with the workgroup (see HelvarNetSimulator.FromConfig)")
+    parser.add_argument("--routers", default="1.10", help="Comma separated cluster.router list")
+    parser.add_argument("--subnets", type=int, default=1)
+    parser.add_argument("--devices", type=int, default=64, help="Devices per subnet")
+    parser.add_argument("--groups", type=int, default=16)
+    parser.add_argument("--no-loopback-routers", action="store_true",
+                        help="Don't listen on 127.0.<cluster>.<router> for every router")
+    # Fault options default to None, so the ones not given keep the "faults"
+    # of --config (or the simulator defaults)
+    parser.add_argument("--latency", type=float, default=None, help="Seconds")
+    parser.add_argument("--jitter", type=float, default=None, help="Seconds")
+    parser.add_argument("--service-time", type=float, default=None, help="Seconds per request")
+    parser.add_argument("--split", action="store_true", default=None, help="Split replies in small segments")
+    parser.add_argument("--error-rate", type=float, default=None)
+    parser.add_argument("--drop-rate", type=float, default=None)
+    parser.add_argument("--disconnect-rate", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    faults = dict(latency=args.latency, jitter=args.jitter, serviceTime=args.service_time,
+                  splitReplies=args.split, errorRate=args.error_rate, dropRate=args.drop_rate,
+                  disconnectRate=args.disconnect_rate, seed=args.seed)
+    faults = {name: value for name, value in faults.items() if value is not None}
+    if args.config:
+        with open(args.config) as f:
+            simulator = HelvarNetSimulator.FromConfig(json.load(f), **faults)
+    else:
+        simulator = HelvarNetSimulator.Generate(args.routers.split(","), args.subnets, args.devices,
+                                                args.groups, **faults)
+
+    async def Run():
+        await simulator.Serve(args.host, args.port, args.udp_port, not args.no_loopback_routers)
+        print("Simulating " + str(len(simulator.devices)) + " devices in " + str(len(simulator.groups)) +
+              " groups on routers " + ", ".join(simulator.routers) + ", port " + str(simulator.port))
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(Run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,919 @@
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import dataclasses
 import socket
-import re
-import datetime
+import select
+import enum
+import heapq
+import http.server
+import json
+import logging
+import os
+import queue
+import random
+import struct
+import threading
+import time
 
-class HelvarNetClient:
-    def __init__(self, server, port):
+_LOGGER = logging.getLogger(__name__)
+
+
+class HelvarNetConnectionPool:
+    ''' Keeps long lived TCP connections to one router, so every command costs
+    a single write (plus one read for queries) instead of a full handshake.
+    At most maxConnections sockets are open at the same time, callers wait
+    for a free one when the pool is exhausted.
+    Connections that have been idle for more than idleCheck seconds are
+    checked before being handed out, dead ones are replaced transparently.
+    '''
+
+    def __init__(self, server, port, maxConnections=4, timeout=10, idleCheck=30):
+        self.server = server
+        self.port = port
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self.idleCheck = idleCheck
+        self.__idle = []  # (socket, last time it was released)
+        self.__open = 0
+        self.__closed = False
+        self.__lock = threading.Condition()
+
+    def __Connect(self, timeout):
+        s = socket.create_connection((self.server, self.port), timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return s
+
+    def __IsHealthy(self, s):
+        ''' An idle connection must have nothing to read, if the router closed it
+        recv returns b"" and if there's stale data we can't trust it either.
+        '''
+        try:
+            s.setblocking(False)
+            try:
+                return not s.recv(1, socket.MSG_PEEK)
+            finally:
+                s.settimeout(self.timeout)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def Acquire(self, timeout=None):
+        ''' A connection to the router, waiting at most timeout seconds (no
+        limit by default) for a free one and to connect
+        '''
+        deadline = None  # Only needed when we have to wait
+        with self.__lock:
+            while True:
+                if self.__closed:
+                    raise ConnectionError("Connection pool is closed")
+                while self.__idle:
+                    s, lastUsed = self.__idle.pop()
+                    if time.monotonic() - lastUsed < self.idleCheck or self.__IsHealthy(s):
+                        return s
+                    s.close()
+                    self.__open -= 1
+                if self.__open < self.maxConnections:
+                    self.__open += 1
+                    break
+                if timeout is not None:
+                    if deadline is None:
+                        deadline = time.monotonic() + timeout
+                    elif deadline <= time.monotonic():
+                        raise HelvarNetTimeoutError("No free connection to the router")
+                self.__lock.wait(None if deadline is None else deadline - time.monotonic())
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0.001)
+        if timeout is None or (self.timeout is not None and self.timeout < timeout):
+            timeout = self.timeout
+        try:
+            return self.__Connect(timeout)
+        except OSError as error:
+            with self.__lock:
+                self.__open -= 1
+                self.__lock.notify()
+            if isinstance(error, socket.timeout):
+                raise HelvarNetTimeoutError("Can't connect to the router") from None
+            raise
+
+    def Release(self, s, reusable=True):
+        ''' Gives the connection back to the pool, broken connections (or the ones
+        that may still get a late answer) must be released with reusable=False.
+        '''
+        if reusable and s.gettimeout() != self.timeout:
+            # Shortened for a deadline
+            s.settimeout(self.timeout)
+        with self.__lock:
+            if reusable and not self.__closed:
+                self.__idle.append((s, time.monotonic()))
+            else:
+                s.close()
+                self.__open -= 1
+            self.__lock.notify()
+
+    def Close(self):
+        with self.__lock:
+            self.__closed = True
+            for s, lastUsed in self.__idle:
+                s.close()
+                self.__open -= 1
+            self.__idle = []
+            self.__lock.notify_all()
+
+    def Stats(self):
+        with self.__lock:
+            return {"open": self.__open, "idle": len(self.__idle)}
+
+
+# Diagnostic codes of the error replies (!...=code#)
+_ERRORS = {
+    0: "Success",
+    1: "Invalid group index parameter",
+    2: "Invalid cluster parameter",
+    3: "Invalid router",
+    4: "Invalid router subnet",
+    5: "Invalid device parameter",
+    6: "Invalid sub device parameter",
+    7: "Invalid block parameter",
+    8: "Invalid scene",
+    9: "Cluster does not exist",
+    10: "Router does not exist",
+    11: "Device does not exist",
+    12: "Property does not exist",
+    13: "Invalid RAW message size",
+    14: "Invalid messages type",
+    15: "Invalid message command",
+    16: "Missing ASCII terminator",
+    17: "Missing ASCII parameter",
+    18: "Incompatible version",
+}
+
+
+class HelvarNetError(Exception):
+    ''' The router answered with an error diagnostic (!...=code#) '''
+
+    def __init__(self, code):
+        try:
+            code = int(code)
+        except ValueError:
+            pass
+        super().__init__("HelvarNet error " + str(code) + ": " + _ERRORS.get(code, "Unknown error"))
+        self.code = code
+
+
+class HelvarNetTimeoutError(TimeoutError):
+    ''' No answer in time, either the timeout of the client or the deadline
+    of the call (see RequestDeadline) ran out
+    '''
+
+
+class HelvarNetCircuitOpenError(ConnectionError):
+    ''' The router failed too many times in a row and its circuit breaker is
+    open, the call was not sent. retryAfter is the seconds until the next
+    try is let through.
+    '''
+
+    def __init__(self, router, retryAfter):
+        super().__init__("Router %s is not answering, next try in %.1f s" % (router, retryAfter))
+        self.router = router
+        self.retryAfter = retryAfter
+
+
+class HelvarNetFrame(collections.namedtuple("HelvarNetFrame", "prefix fields answer")):
+    ''' One message, for ?V:1,C:152,@1.10.1.5=100# prefix is b"?",
+    fields is b"V:1,C:152,@1.10.1.5" and answer is b"100" (None if there is no "=")
+    '''
+    __slots__ = ()
+
+    def Key(self):
+        ''' Same for a request and its reply, see _CorrelationKey '''
+        return _CorrelationKey(self.fields)
+
+    def Request(self, router=None):
+        ''' (command, values) of the message, the values as text in the order
+        of COMMANDS. The device addresses of router ("cluster.router", the
+        router the message is for) are (subnet, device), the way they are
+        passed to HelvarNetCommands, other addresses keep their 4 parts.
+        values is None for commands that are not in COMMANDS, command as well
+        when there is no C: field.
+        '''
+        parameters = {}
+        for field in self.fields.decode(errors="replace").split(","):
+            if field.startswith("@"):
+                address = tuple(field[1:].split("."))
+                if len(address) == 4 and router is not None and address[0] + "." + address[1] == router:
+                    address = address[2:]
+                parameters["@"] = address
+            elif ":" in field:
+                name, value = field.split(":", 1)
+                parameters[name + ":"] = value
+        try:
+            command = int(parameters.get("C:", ""))
+        except ValueError:
+            return None, None
+        if command not in COMMANDS:
+            return command, None
+        return command, tuple(parameters.get(_PARAMETERS[name]) for name in COMMANDS[command][1])
+
+
+class HelvarNetFrameDecoder:
+    ''' Incremental decoder of "#" terminated messages. Feed it whatever the
+    socket returned, it keeps the incomplete tail in a bytearray and returns
+    the complete frames, so answers split across TCP segments or several
+    answers in one segment are both handled.
+    Frames are split as bytes, nothing is decoded to str until the answer
+    is actually used.
+    '''
+
+    def __init__(self):
+        self.__buffer = bytearray()
+
+    def __len__(self):
+        ''' Bytes waiting for the rest of their frame '''
+        return len(self.__buffer)
+
+    def Feed(self, data):
+        buffer = self.__buffer
+        if buffer:
+            buffer += data
+            data = buffer
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+        last = data.rfind(b"#")
+        if last < 0:
+            if data is not buffer:
+                buffer += data
+            return []
+        complete = bytes(data[:last]) if data is buffer else data[:last]
+        frames = []
+        for frame in complete.split(b"#"):
+            if frame:
+                head, equals, answer = frame.partition(b"=")
+                frames.append(HelvarNetFrame(head[:1], head[1:], answer if equals else None))
+        if data is buffer:
+            del buffer[:last + 1]
+        elif last + 1 < len(data):
+            buffer += data[last + 1:]
+        return frames
+
+    def Clear(self):
+        del self.__buffer[:]
+
+
+def _CorrelationKey(fields):
+    ''' Replies echo the parameters of the request (?V:1,C:110,@1.10.1.5=...#),
+    so the parameters without the version identify which request it answers.
+    Sorted, in case the router does not keep the order.
+    '''
+    return tuple(sorted(
+        field for field in fields.split(b",") if field and not field.startswith(b"V:")))
+
+
+class _PendingReplies:
+    ''' In flight requests waiting for an answer, grouped by correlation key.
+    Identical requests are answered in the order they were sent.
+    '''
+
+    def __init__(self):
+        self.__pending = {}  # key -> deque of [deadline, future, convert]
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.__pending.values())
+
+    def Add(self, key, entry):
+        self.__pending.setdefault(key, collections.deque()).append(entry)
+
+    def Pop(self, key):
+        entries = self.__pending.get(key)
+        if not entries:
+            return None
+        entry = entries.popleft()
+        if not entries:
+            del self.__pending[key]
+        return entry
+
+    def Remove(self, key, entry):
+        entries = self.__pending.get(key)
+        if entries and entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self.__pending[key]
+
+    def NextDeadline(self):
+        # The oldest entry of each key is the one that expires first
+        return min((entries[0][0] for entries in self.__pending.values()), default=None)
+
+    def PopExpired(self, now):
+        expired = []
+        for key in list(self.__pending):
+            entries = self.__pending[key]
+            while entries and entries[0][0] <= now:
+                expired.append(entries.popleft())
+            if not entries:
+                del self.__pending[key]
+        return expired
+
+    def PopAll(self):
+        entries = [entry for key in self.__pending for entry in self.__pending[key]]
+        self.__pending = {}
+        return entries
+
+
+def _AnswerToList(answer):
+    return answer.split(',')
+
+
+def _AnswerToAddresses(answer):
+    return [address.lstrip("@") for address in answer.split(',') if address]
+
+
+def _AnswerToBool(answer):
+    if answer == "1":
+        return True
+    elif answer == "0":
+        return False
+
+
+# Parameters of the commands, name -> field on the wire. Values are written
+# with str(), booleans as 1/0 and device addresses can be a (subnet, device)
+# tuple of the router we are connected to or a full
+# (cluster, router, subnet, device) one.
+# Not used by any command yet: Q: Secuence Number (internal commands only),
+# A: Acknowledgement, D: Display Screen, K: Constant Light Scene
+_PARAMETERS = {
+    "cluster": "@",  # Cluster, only on QueryRouters
+    "address": "@",  # Device address
+    "group": "G:",  # Fixture group
+    "scene": "S:",  # Scene
+    "block": "B:",  # Block
+    "fade": "F:",  # Fade Time
+    "level": "L:",  # Light Level
+    "proportion": "P:",  # Proportion
+    "time": "T:",  # Time
+    "latitude": "N:",  # Latitude
+    "longitude": "E:",  # Longitude
+    "timezone": "Z:",  # Time Zone Difference
+    "dst": "Y:",  # Daylight Saving Time
+    "force": "O:",  # Force Store Scene
+}
+
+# Every command the client knows: number -> (method, parameters in the order
+# they are written on the wire)
+COMMANDS = {
+    # Control
+    11: ("RecallSceneOnGroup", ("group", "block", "scene", "fade")),
+    12: ("RecallSceneOnDevice", ("block", "scene", "fade", "address")),
+    13: ("SetGroupAbsoluteLevel", ("group", "level", "fade")),
+    14: ("SetDeviceAbsoluteLevel", ("level", "fade", "address")),
+    15: ("SetGroupLevelAbsoluteProportion", ("group", "proportion", "fade")),
+    16: ("SetDeviceLevelAbsoluteProportion", ("proportion", "fade", "address")),
+    17: ("SetGroupLevelModifyProportion", ("group", "proportion", "fade")),
+    18: ("SetDeviceLevelModifyProportion", ("proportion", "fade", "address")),
+    # Queries
+    101: ("QueryClusters", ()),
+    102: ("QueryRouters", ("cluster",)),
+    103: ("QueryLastSceneInBlock", ("group", "block")),
+    104: ("QueryDeviceType", ("address",)),
+    105: ("QueryGroupDescription", ("group",)),
+    106: ("QueryDeviceDescription", ("address",)),
+    110: ("QueryDeviceState", ("address",)),
+    111: ("QueryDeviceIsDisabled", ("address",)),
+    113: ("QueryDeviceIsMissing", ("address",)),
+    114: ("QueryDeviceIsFaulty", ("address",)),
+    129: ("QueryEmergencyBatteryFailure", ("address",)),
+    150: ("QueryDeviceMeasurement", ("address",)),
+    151: ("QueryDeviceInputState", ("address",)),
+    152: ("QueryLoadLevel", ("address",)),
+    160: ("QueryDevicePowerCompsumption", ("address",)),
+    161: ("QueryGroupPowerCompsumption", ("group",)),
+    164: ("QueryGroup", ("group",)),
+    165: ("QueryGroups", ()),
+    170: ("QueryEmergencyFunctionTestTime", ("address",)),
+    171: ("QueryEmergencyFunctionTestState", ("address",)),
+    172: ("QueryEmergencyDurationTestTime", ("address",)),
+    173: ("QueryEmergencyDurationTestState", ("address",)),
+    174: ("QueryEmergencyBatteryCharge", ("address",)),
+    175: ("QueryEmergencyBatteryTime", ("address",)),
+    176: ("QueryEmergencyTotalLampTime", ("address",)),
+    185: ("QueryTime", ()),
+    186: ("QueryLongitude", ()),
+    187: ("QueryLatitude", ()),
+    188: ("QueryTimeZone", ()),
+    189: ("QueryDST", ()),
+    190: ("QuerySWVersion", ()),
+    191: ("QueryHelvarNetVersion", ()),
+    # Configuration
+    201: ("StoreSceneForGroup", ("group", "force", "block", "scene", "level")),
+    202: ("StoreSceneOnDevice", ("address", "force", "block", "scene", "level")),
+    203: ("StoreCurrSceneForGroup", ("group", "force", "block", "scene")),
+    204: ("StoreCurrSceneForDevice", ("address", "force", "block", "scene")),
+    205: ("ResetGroupEmergencyLampBatTime", ("group",)),
+    206: ("ResetDeviceEmergencyLampBatTime", ("address",)),
+    241: ("SetRouterCurrentDateTime", ("time",)),
+    244: ("SetTimezone", ("timezone",)),
+    245: ("SetDaylightSavingTime", ("dst",)),
+}
+
+
+class HelvarNetEncoder:
+    ''' Writes the commands of COMMANDS straight to bytes. The ">V:1,C:nnn"
+    start of every command and the "cluster.member." start of the addresses
+    of our router are built once, encoding is just joining the values.
+    '''
+
+    def __init__(self, clusterID, memberID):
+        self.__address = (str(clusterID) + "." + str(memberID) + ".").encode()
+        self.__commands = {}
+        for command, (name, parameters) in COMMANDS.items():
+            self.__commands[command] = (
+                (">V:1,C:" + str(command)).encode(),
+                tuple(("," + _PARAMETERS[parameter]).encode() for parameter in parameters))
+
+    def __Value(self, value):
+        if value is True:
+            return b"1"
+        if value is False:
+            return b"0"
+        if isinstance(value, tuple):
+            if len(value) == 2:
+                return self.__address + (str(value[0]) + "." + str(value[1])).encode()
+            return ".".join(str(part) for part in value).encode()
+        return str(value).encode()
+
+    def EncodeInto(self, buffer, command, values):
+        ''' Appends the command to a bytearray, values in COMMANDS order '''
+        start, fields = self.__commands[command]
+        buffer += start
+        for field, value in zip(fields, values):
+            buffer += field
+            buffer += self.__Value(value)
+        buffer += b"#"
+        return buffer
+
+    def Encode(self, command, values):
+        start, fields = self.__commands[command]
+        parts = [start]
+        for field, value in zip(fields, values):
+            parts.append(field)
+            parts.append(self.__Value(value))
+        parts.append(b"#")
+        return b"".join(parts)
+
+    def EncodeMany(self, commands):
+        ''' Encodes an iterable of (command, values) into a single buffer '''
+        buffer = bytearray()
+        for command, values in commands:
+            self.EncodeInto(buffer, command, values)
+        return bytes(buffer)
+
+
+# Seconds the answers of each query are kept by HelvarNetCache, queries that
+# are not here are never cached
+CACHE_TTLS = {
+    101: 3600, 102: 3600, 104: 3600, 105: 3600, 106: 3600, 164: 3600, 165: 3600,
+    186: 3600, 187: 3600, 188: 3600, 189: 3600, 190: 3600, 191: 3600,
+    103: 60,
+    110: 5, 111: 5, 113: 5, 114: 5, 152: 5, 160: 5, 161: 5,
+}
+
+# Cached queries each command makes stale: "address" and "group" only drop
+# the answers about the same device or group, "all" every answer of that
+# query (a group command changes devices we can't tell apart)
+CACHE_INVALIDATIONS = {
+    11: ((103, "group"), (110, "all"), (152, "all"), (160, "all"), (161, "group")),
+    12: ((110, "address"), (152, "address"), (160, "address"), (161, "all")),
+    13: ((110, "all"), (152, "all"), (160, "all"), (161, "group")),
+    14: ((110, "address"), (152, "address"), (160, "address"), (161, "all")),
+    15: ((110, "all"), (152, "all"), (160, "all"), (161, "group")),
+    16: ((110, "address"), (152, "address"), (160, "address"), (161, "all")),
+    17: ((110, "all"), (152, "all"), (160, "all"), (161, "group")),
+    18: ((110, "address"), (152, "address"), (160, "address"), (161, "all")),
+    201: ((103, "group"),),
+    202: ((103, "all"),),
+    203: ((103, "group"),),
+    204: ((103, "all"),),
+    205: ((110, "all"),),
+    206: ((110, "address"),),
+    241: ((185, "all"),),
+    244: ((188, "all"),),
+    245: ((189, "all"),),
+}
+
+
+def _RequestKey(command, values):
+    ''' Hashable identity of a request, with every value as text so 1 and "1"
+    are the same device
+    '''
+    return (command,) + tuple(
+        tuple(str(part) for part in value) if isinstance(value, tuple) else str(value)
+        for value in values)
+
+
+def _Target(command, values, kind):
+    ''' Value of the "address" or "group" parameter of a command, as text so
+    1 and "1" are the same group
+    '''
+    parameters = COMMANDS[command][1]
+    if kind not in parameters or parameters.index(kind) >= len(values):
+        return None
+    value = values[parameters.index(kind)]
+    return tuple(str(part) for part in value) if isinstance(value, tuple) else str(value)
+
+
+def _LocalValues(router, values):
+    ''' values with the 4 part addresses of devices of router ("cluster.router")
+    as (subnet, device), the way the client passes them, so a command with
+    full addresses (HelvarNetPlanner) drops the same answers
+    '''
+    if not any(isinstance(value, tuple) and len(value) == 4 for value in values):
+        return values
+    prefix = tuple(router.split("."))
+    return tuple(value[2:] if isinstance(value, tuple) and len(value) == 4
+                 and (str(value[0]), str(value[1])) == prefix else value
+                 for value in values)
+
+
+def _EntryTarget(query, values):
+    ''' Address or group a cached query is about, None if it has neither '''
+    parameters = COMMANDS[query][1]
+    for kind in ("address", "group"):
+        if kind in parameters:
+            return _Target(query, values, kind)
+    return None
+
+
+class HelvarNetCache:
+    ''' Keeps the answers of the queries for the seconds in ttls (CACHE_TTLS
+    by default), the least recently used ones are dropped when there are more
+    than maxsize. Control and configuration commands sent through the client
+    invalidate the answers they make stale, following CACHE_INVALIDATIONS.
+    It can be shared by several clients, answers are kept per router.
+    '''
+
+    def __init__(self, maxsize=1024, ttls=None):
+        self.maxsize = maxsize
+        self.ttls = dict(CACHE_TTLS if ttls is None else ttls)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.__entries = collections.OrderedDict()  # key -> (expires, answer, target)
+        # (router, query) -> target (address or group of the entry) -> keys,
+        # so an invalidation only looks at the entries it drops
+        self.__index = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def Get(self, router, command, values):
+        ''' Cached answer, None if there is none or it expired '''
+        if command not in self.ttls:
+            return None
+        key = (router,) + _RequestKey(command, _LocalValues(router, values))
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def Put(self, router, command, values, answer):
+        ttl = self.ttls.get(command)
+        if not ttl:
+            return
+        key = (router,) + _RequestKey(command, _LocalValues(router, values))
+        target = _EntryTarget(command, key[2:])
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + ttl, answer, target)
+            self.__entries.move_to_end(key)
+            self.__index.setdefault((router, command), {}).setdefault(target, set()).add(key)
+            while len(self.__entries) > self.maxsize:
+                self.__Remove(next(iter(self.__entries)))
+
+    def __Remove(self, key):
+        entry = self.__entries.pop(key)
+        targets = self.__index[key[:2]]
+        keys = targets[entry[2]]
+        keys.discard(key)
+        if not keys:
+            del targets[entry[2]]
+            if not targets:
+                del self.__index[key[:2]]
+
+    def Invalidate(self, router, command, values):
+        ''' Drops the answers made stale by sending command to the router '''
+        rules = CACHE_INVALIDATIONS.get(command)
+        if not rules:
+            return
+        values = _LocalValues(router, values)
+        with self.__lock:
+            for query, scope in rules:
+                targets = self.__index.get((router, query))
+                if not targets:
+                    continue
+                target = None if scope == "all" else _Target(command, values, scope)
+                if target is None or scope not in COMMANDS[query][1]:
+                    # Without a target (group commands) every answer of the query goes
+                    keys = [key for keys in targets.values() for key in keys]
+                else:
+                    keys = list(targets.get(target, ())) + list(targets.get(None, ()))
+                for key in keys:
+                    self.__Remove(key)
+                self.invalidations += len(keys)
+
+    def Clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__index.clear()
+
+    def Stats(self):
+        return {"entries": len(self.__entries), "hits": self.hits,
+                "misses": self.misses, "invalidations": self.invalidations}
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.counts = [0] * (buckets + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+
+def _ErrorKind(error):
+    if isinstance(error, HelvarNetError):
+        return "error"
+    if isinstance(error, HelvarNetCircuitOpenError):
+        return "circuit_open"
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    return "connection"
+
+
+class HelvarNetMetrics:
+    ''' Request counters and latency histograms per router and command code,
+    it can be shared by several clients (metrics=...). Every request sent to
+    a router is timed as a whole ("total"), HelvarNetClient and
+    AsyncHelvarNetClient also time its phases:
+        connect: getting a pooled connection, or opening a new one
+        send: writing the request
+        first_byte: from the request written to the first byte of the answer
+    Failed requests are counted by kind: "timeout", "connection" and "error"
+    (the router answered with an error). Gauges are read when exporting, the
+    clients publish their open connections, queued and in flight requests.
+
+    Hooks run in the thread (or coroutine) doing the request:
+    before(router, command, values) right before it is sent and
+    after(router, command, values, seconds, error) once it is done, error is
+    None on success. Answers from the cache are not requests.
+    '''
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    PHASES = ("connect", "send", "first_byte", "total")
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.requests = collections.Counter()  # (router, command) -> requests
+        self.errors = collections.Counter()  # (router, command, kind) -> failed requests
+        self.histograms = {}  # (router, command, phase) -> _Histogram
+        self.__gauges = {}  # (router, name) -> function returning the value
+        self.__before = []
+        self.__after = []
+        self.__lock = threading.Lock()
+
+    def AddHook(self, before=None, after=None):
+        if before is not None:
+            self.__before.append(before)
+        if after is not None:
+            self.__after.append(after)
+
+    def Gauge(self, router, name, function):
+        ''' Publishes function() as the gauge name of router, None removes it '''
+        with self.__lock:
+            if function is None:
+                self.__gauges.pop((router, name), None)
+            else:
+                self.__gauges[(router, name)] = function
+
+    def Observe(self, router, command, phase, seconds):
+        key = (router, command, phase)
+        with self.__lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram(len(self.buckets))
+            histogram.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def Started(self, router, command, values):
+        for hook in self.__before:
+            hook(router, command, values)
+        return time.perf_counter()
+
+    def Finished(self, router, command, values, started, error=None):
+        seconds = time.perf_counter() - started
+        self.Observe(router, command, "total", seconds)
+        with self.__lock:
+            self.requests[(router, command)] += 1
+            if error is not None:
+                self.errors[(router, command, _ErrorKind(error))] += 1
+        for hook in self.__after:
+            hook(router, command, values, seconds, error)
+
+    def Percentile(self, router, command, percent, phase="total"):
+        ''' Upper bound of the bucket holding that percentile, None without
+        requests and infinite past the last bucket
+        '''
+        with self.__lock:
+            histogram = self.histograms.get((router, command, phase))
+            if histogram is None or not histogram.count:
+                return None
+            rank = histogram.count * percent / 100
+            seen = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+
+    def __Gauges(self):
+        with self.__lock:
+            gauges = list(self.__gauges.items())
+        values = []
+        for (router, name), function in gauges:
+            try:
+                values.append((router, name, function()))
+            except Exception:
+                pass  # A closed client, or one that went away
+        return values
+
+    def Snapshot(self):
+        ''' Everything as a dict, with the mean and percentiles of every phase '''
+        with self.__lock:
+            keys = sorted(set(self.requests) | {key[:2] for key in self.histograms})
+            requests = dict(self.requests)
+            errors = dict(self.errors)
+            histograms = {key: (histogram.count, histogram.sum) for key, histogram in self.histograms.items()}
+        commands = []
+        for router, command in keys:
+            latency = {}
+            for phase in self.PHASES:
+                count, total = histograms.get((router, command, phase), (0, 0))
+                if count:
+                    latency[phase] = {"count": count, "mean": total / count}
+                    for percent in (50, 95, 99):
+                        latency[phase]["p" + str(percent)] = self.Percentile(router, command, percent, phase)
+            commands.append({
+                "router": router, "command": command,
+                "name": COMMANDS[command][0] if command in COMMANDS else None,
+                "requests": requests.get((router, command), 0),
+                "errors": {kind: count for (r, c, kind), count in errors.items() if (r, c) == (router, command)},
+                "latency": latency})
+        gauges = {}
+        for router, name, value in self.__Gauges():
+            gauges.setdefault(router, {})[name] = value
+        return {"commands": commands, "gauges": gauges}
+
+    def Prometheus(self):
+        ''' Prometheus text exposition format '''
+        def Labels(router, command=None, **extra):
+            labels = [("router", router)]
+            if command is not None:
+                labels += [("command", str(command)), ("name", COMMANDS[command][0] if command in COMMANDS else "")]
+            labels += list(extra.items())
+            return "{" + ",".join(name + '="' + str(value) + '"' for name, value in labels) + "}"
+
+        with self.__lock:
+            requests = sorted(self.requests.items())
+            errors = sorted(self.errors.items())
+            histograms = sorted((key, list(histogram.counts), histogram.sum, histogram.count)
+                                for key, histogram in self.histograms.items())
+        lines = ["# HELP helvarnet_requests_total Requests sent to the routers",
+                 "# TYPE helvarnet_requests_total counter"]
+        lines += ["helvarnet_requests_total" + Labels(router, command) + " " + str(count)
+                  for (router, command), count in requests]
+        lines += ["# HELP helvarnet_errors_total Failed requests by kind (timeout, connection, circuit_open, error)",
+                  "# TYPE helvarnet_errors_total counter"]
+        lines += ["helvarnet_errors_total" + Labels(router, command, kind=kind) + " " + str(count)
+                  for (router, command, kind), count in errors]
+        lines += ["# HELP helvarnet_request_seconds Request latency by phase (connect, send, first_byte, total)",
+                  "# TYPE helvarnet_request_seconds histogram"]
+        for (router, command, phase), counts, total, count in histograms:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append("helvarnet_request_seconds_bucket" +
+                             Labels(router, command, phase=phase, le=bound) + " " + str(cumulative))
+            lines.append("helvarnet_request_seconds_sum" + Labels(router, command, phase=phase) + " " + repr(total))
+            lines.append("helvarnet_request_seconds_count" + Labels(router, command, phase=phase) + " " + str(count))
+        names = set()
+        for router, name, value in sorted(self.__Gauges()):
+            if name not in names:
+                names.add(name)
+                lines.append("# TYPE helvarnet_" + name + " gauge")
+            lines.append("helvarnet_" + name + Labels(router) + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+    def ServePrometheus(self, port, host=""):
+        ''' Serves Prometheus() over HTTP from a background thread, returns the
+        server (call its shutdown() to stop it)
+        '''
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.Prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class HelvarNetCommands:
+    ''' Builds every HelvarNet message and knows how to read the answers.
+    It does not talk to the network, the clients below implement _Query and
+    _Send, that way the blocking and the asyncio clients share the exact same
+    command surface.
+    '''
+
+    def __init__(self, server, port, cache=None, metrics=None):
         self.server = server
         self.port = port
         # Cluster ID and Member ID are part of the internal device addresses,
         # the control device generates them using the IP address info
         self.clusterID = server.split(".")[2]
         self.memberID = server.split(".")[3]
+        self._encoder = HelvarNetEncoder(self.clusterID, self.memberID)
+        self.cache = cache
+        self.metrics = metrics
+        self.__router = self.clusterID + "." + self.memberID
 
-        # Message Components
-        # Message Types
-        self.__COMMAND = ">"  # Command starter
-        self.__NTRCOMMAND = "<"  # Internal Command starter
-        self.__REPLY = "?"  # Internal Command reply
-        self.__ERRORDIAG = "!"  # TODO
-
-        # Special
-        self.__TERMINATOR = "#"
-        self.__ANSWER = "="
-
-        # Delimiters
-        # STDDELIM = ","
-        # PARAMDELIM = ":"
-        # ADDRDELIM = "."
-
-        # Parameters of the commands
-        self.__HLVSEQNUM = "Q:"  # Secuence Number - Internal commands only
-        self.__HLVVER = "V:"  # HelvarNet Version - Assumes version 1
-        self.__HLVCMD = "C:"  # Command
-        self.__HLVACK = "A:"  # Acknowledgement - Assumes = 0 - Optional
-        self.__HLVADDR = "@:"  # Address
-        self.__HLVGROUP = "G:"  # Fixture group - Optional
-        self.__HLVSCN = "S:"  # Scene - Optional
-        self.__HLVBLOCK = "B:"  # Block - Optional
-        self.__HLVFADET = "F:"  # Fade Time - Optional
-        self.__HLVLEVEL = "L:"  # Light Level
-        self.__HLVPROP = "P:"  # Proportion
-        self.__HLVDISP = "D:"  # Display Screen
-        self.__HLVTIME = "T:"  # Time
-        self.__HLVLAT = "N:"  # Latitude
-        self.__HLVLON = "E:"  # Longitude
-        self.__HLVTIMEZ = "Z:"  # Time Zone Difference
-        self.__HLVDST = "Y:"  # Daylight Saving Time
-        self.__HLVCLS = "K:"  # Constant Light Scene - Optional
-        self.__HLVFSE = "O:"  # Force Store Scene - Optional
-
-    def __GetCurrentTimeEpoch():
-        epoch = datetime.datetime.now().strftime('%s')
-        return str(epoch)
-
-    def __SendTCPMessageAndRecv(self, HOST, PORT, Message):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(10)
-            try:
-                s.connect((HOST, PORT))
-                s.sendall(Message.encode())
-                data = s.recv(1024)
-                return data
-            except socket.error:
-                return None
+    def __GetCurrentTimeEpoch(self):
+        return str(int(time.time()))
+
+    def _Message(self, command, values):
+        message = self._encoder.Encode(command, values)
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Sent command looks like: %s", message.decode())
+        return message
+
+    def _Answer(self, frame, convert=None):
+        if frame is None:
+            raise ConnectionError("No answer from the router")
+        if frame.prefix == b"!":
+            raise HelvarNetError(frame.answer.decode())
+        received = frame.answer.decode(errors="replace")
+        return convert(received) if convert else received
+
+    def _CachedAnswer(self, command, values):
+        if self.cache is None:
+            return None
+        return self.cache.Get(self.__router, command, values)
+
+    def _CacheAnswer(self, command, values, answer):
+        if self.cache is not None:
+            self.cache.Put(self.__router, command, values, answer)
+
+    def _InvalidateCache(self, command, values):
+        if self.cache is not None:
+            self.cache.Invalidate(self.__router, command, values)
+
+    def _Started(self, command, values):
+        if self.metrics is None:
+            return None
+        return self.metrics.Started(self.__router, command, values)
 
-    def __SendTCPMessageAndContinue(self, HOST, PORT, Message):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(Message.encode())
+    def _Finished(self, command, values, started, error=None):
+        if started is not None:
+            self.metrics.Finished(self.__router, command, values, started, error)
 
+    def _Observe(self, command, phase, seconds):
+        if self.metrics is not None:
+            self.metrics.Observe(self.__router, command, phase, seconds)
+
+    def _Gauge(self, name, function):
+        if self.metrics is not None:
+            self.metrics.Gauge(self.__router, name, function)
+
+    def _Query(self, command, values, convert=None):
+        raise NotImplementedError
+
+    def _Send(self, command, values):
+        raise NotImplementedError
 
     ################# Query Commands #################
     def QueryClusters(self):
@@ -75,489 +921,156 @@ class HelvarNetClient:
         the router.
         then we create a python list for easy parsing
         '''
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "101" +\
-            self.__TERMINATOR
-        print("Clusters Queried.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group().split(',')
-        return received
-
-    def QueryRouters(self):
+        _LOGGER.debug("Clusters Queried.")
+        return self._Query(101, (), _AnswerToList)
+
+    def QueryRouters(self, cluster=None):
         ''' Returns comma separates list of routers in the format of ?V:1,C:102,@253=252,253,254# from the router.
         then we create a python list for easy parsing
+        By default it asks for the routers in our own cluster.
         '''
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "102" + "," +\
-            "@" + self.clusterID +\
-            self.__TERMINATOR
-        print("Routers Queried.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group().split(',')
-        return received
+        cluster = self.clusterID if cluster is None else cluster
+        _LOGGER.debug("Routers Queried.")
+        return self._Query(102, (cluster,), _AnswerToList)
 
     def QueryLastSceneInBlock(self, group, block):
         ''' Returns the last scene in block, format is ?V:1,C:103,G:5,B:2=4#
         '''
-        group = str(group)
-        block = str(block)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "103" + "," +\
-            self.__HLVGROUP + group + "," +\
-            self.__HLVBLOCK + block + "," +\
-            self.__TERMINATOR
-        print("Last Scene Queried.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Last Scene Queried.")
+        return self._Query(103, (group, block))
 
     def QueryDeviceType(self, subnet, device):
         ''' There's a full description of the device types in "DALI Device Type Information.txt"
         I will just give you the return of the router, IDK how helvar does the conversion from HEX to ASCII in this case (WTF Helvar)
         '''
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "104" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Queried device type.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Queried device type.")
+        return self._Query(104, ((subnet, device),))
 
     def QueryGroupDescription(self, group):
         '''
         Returns the group description in string format
         '''
-        group = str(group)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "105" + "," +\
-            self.__HLVGROUP + group +\
-            self.__TERMINATOR
-        print("Queried group description.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Queried group description.")
+        return self._Query(105, (group,))
 
     def QueryDeviceDescription(self, subnet, device):
         '''
         Returns the device description in string format
         '''
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "106" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Queried device description")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Queried device description")
+        return self._Query(106, ((subnet, device),))
 
     def QueryDeviceState(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
         # Check device state table
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "110" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Queried device state")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Queried device state")
+        return self._Query(110, ((subnet, device),))
 
     def QueryDeviceIsDisabled(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "111" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Checking if device is disabled.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        if received == "1":
-            return True
-        elif received == "0":
-            return False
+        _LOGGER.debug("Checking if device is disabled.")
+        return self._Query(111, ((subnet, device),), _AnswerToBool)
 
     def QueryDeviceIsMissing(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "113" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Checking if device is missing.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        if received == "1":
-            return True
-        elif received == "0":
-            return False
+        _LOGGER.debug("Checking if device is missing.")
+        return self._Query(113, ((subnet, device),), _AnswerToBool)
 
     def QueryDeviceIsFaulty(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "114" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Checking if device is faulty.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        if received == "1":
-            return True
-        elif received == "0":
-            return False
+        _LOGGER.debug("Checking if device is faulty.")
+        return self._Query(114, ((subnet, device),), _AnswerToBool)
 
     def QueryEmergencyBatteryFailure(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "129" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Checking if battery is faulty.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        if received == "1":
-            return True
-        elif received == "0":
-            return False
+        _LOGGER.debug("Checking if battery is faulty.")
+        return self._Query(129, ((subnet, device),), _AnswerToBool)
 
     def QueryDeviceMeasurement(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "150" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Retrieving measurements...")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Retrieving measurements...")
+        return self._Query(150, ((subnet, device),))
 
     def QueryDeviceInputState(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "151" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Asking for the device input state...")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking for the device input state...")
+        return self._Query(151, ((subnet, device),))
 
     def QueryLoadLevel(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "152" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Asking for the load level...")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking for the load level...")
+        return self._Query(152, ((subnet, device),))
 
     # POWER
     def QueryDevicePowerCompsumption(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "160" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Asking for the device power consumption...")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking for the device power consumption...")
+        return self._Query(160, ((subnet, device),))
 
     def QueryGroupPowerCompsumption(self, group):
-        group = str(group)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "161" + "," +\
-            self.__HLVGROUP + group +\
-            self.__TERMINATOR
-        print("Asking for the group power consumption...")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking for the group power consumption...")
+        return self._Query(161, (group,))
+
+    # GROUPS
+    def QueryGroup(self, group):
+        ''' Returns the addresses of the devices in the group as a list of
+        "cluster.router.subnet.device" strings
+        '''
+        _LOGGER.debug("Asking for the devices in group...")
+        return self._Query(164, (group,), _AnswerToAddresses)
+
+    def QueryGroups(self):
+        ''' Returns the list of groups of the workgroup '''
+        _LOGGER.debug("Asking for the groups...")
+        return self._Query(165, (), _AnswerToList)
 
     # EMERGENCY TEST
     def QueryEmergencyFunctionTestTime(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "170" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Asking the emergency function test time.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the emergency function test time.")
+        return self._Query(170, ((subnet, device),))
 
     def QueryEmergencyFunctionTestState(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "171" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Asking the emergency function test state.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the emergency function test state.")
+        return self._Query(171, ((subnet, device),))
 
     def QueryEmergencyDurationTestTime(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "172" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Asking the emergency duration test time.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the emergency duration test time.")
+        return self._Query(172, ((subnet, device),))
 
     def QueryEmergencyDurationTestState(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "173" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Asking the emergency duration test state.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the emergency duration test state.")
+        return self._Query(173, ((subnet, device),))
 
     def QueryEmergencyBatteryCharge(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "174" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Checking emergency battery charge level.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Checking emergency battery charge level.")
+        return self._Query(174, ((subnet, device),))
 
     def QueryEmergencyBatteryTime(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "175" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Checking emergency battery time left.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Checking emergency battery time left.")
+        return self._Query(175, ((subnet, device),))
 
     def QueryEmergencyTotalLampTime(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "176" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Checking emergency total lamp time.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Checking emergency total lamp time.")
+        return self._Query(176, ((subnet, device),))
 
     def QueryTime(self):
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "185" +\
-            self.__TERMINATOR
-        print("Asking the time.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the time.")
+        return self._Query(185, ())
 
     def QueryLongitude(self):
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "186" +\
-            self.__TERMINATOR
-        print("Asking the longitude.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the longitude.")
+        return self._Query(186, ())
 
     def QueryLatitude(self):
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "187" +\
-            self.__TERMINATOR
-        print("Asking the latitude.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the latitude.")
+        return self._Query(187, ())
 
     def QueryTimeZone(self):
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "188" +\
-            self.__TERMINATOR
-        print("Asking the timezone.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the timezone.")
+        return self._Query(188, ())
 
     def QueryDST(self):
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "189" +\
-            self.__TERMINATOR
-        print("Asking if we are in daylight savings.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        if received == "1":
-            return True
-        elif received == "0":
-            return False
+        _LOGGER.debug("Asking if we are in daylight savings.")
+        return self._Query(189, (), _AnswerToBool)
 
     def QuerySWVersion(self):
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "190" +\
-            self.__TERMINATOR
-        print("Asking the software version.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the software version.")
+        return self._Query(190, ())
 
     def QueryHelvarNetVersion(self):
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "191" +\
-            self.__TERMINATOR
-        print("Asking the HelvarNet version.")
-        print("Sent command looks like: " + message)
-        received = self.__SendTCPMessageAndRecv(
-            self.server, self.port, message)
-        received = re.search(
-            "(?<=\=).*(?=#)", str(received)).group()
-        return received
+        _LOGGER.debug("Asking the HelvarNet version.")
+        return self._Query(191, ())
 
     ################# Configuration Commands #################
     # Scenes
@@ -566,143 +1079,50 @@ class HelvarNetClient:
         For now helvar only gives us the interface to change scene levels, no colors yet :((
         The "Force" flag overwrites scenes with "ignore" set.
         '''
-        group = str(group)
-        block = str(block)
-        scene = str(scene)
-        level = str(level)
-        force = "1" if force == True else "0"
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "201" + "," +\
-            self.__HLVGROUP + group + "," +\
-            self.__HLVFSE + force + "," +\
-            self.__HLVBLOCK + block + "," +\
-            self.__HLVSCN + scene + "," +\
-            self.__HLVLEVEL + level +\
-            self.__TERMINATOR
-        print("Stored Scene for group " + group + ".")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Stored Scene for group %s.", group)
+        return self._Send(201, (group, force, block, scene, level))
 
     def StoreSceneOnDevice(self, subnet, device, force: bool, block, scene, level):
-        subnet = str(subnet)
-        device = str(device)
-        block = str(block)
-        scene = str(scene)
-        level = str(level)
-        force = "1" if force == True else "0"
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "202" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__HLVFSE + force + "," +\
-            self.__HLVBLOCK + block + "," +\
-            self.__HLVSCN + scene + "," +\
-            self.__HLVLEVEL + level +\
-            self.__TERMINATOR
-        print("Stored Scene for device " + device + ".")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Stored Scene for device %s.", device)
+        return self._Send(202, ((subnet, device), force, block, scene, level))
 
     def StoreCurrSceneForGroup(self, group, force: bool, block, scene):
-        group = str(group)
-        block = str(block)
-        scene = str(scene)
-        force = "1" if force == True else "0"
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "203" + "," +\
-            self.__HLVGROUP + group + "," +\
-            self.__HLVFSE + force + "," +\
-            self.__HLVBLOCK + block + "," +\
-            self.__HLVSCN + scene +\
-            self.__TERMINATOR
-        print("Stored Scene for group " + group + ".")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Stored Scene for group %s.", group)
+        return self._Send(203, (group, force, block, scene))
 
     def StoreCurrSceneForDevice(self, subnet, device, force: bool, block, scene):
-        subnet = str(subnet)
-        device = str(device)
-        block = str(block)
-        scene = str(scene)
-        force = "1" if force == True else "0"
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "204" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__HLVFSE + force + "," +\
-            self.__HLVBLOCK + block + "," +\
-            self.__HLVSCN + scene +\
-            self.__TERMINATOR
-        print("Stored Scene for device " + device + ".")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Stored Scene for device %s.", device)
+        return self._Send(204, ((subnet, device), force, block, scene))
     # Emergecy Lights
 
     def ResetGroupEmergencyLampBatTime(self, group):
-        group = str(group)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "205" + "," +\
-            self.__HLVGROUP + group +\
-            self.__TERMINATOR
-        print("Resetted emergency lights for group: " + group + ".")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Resetted emergency lights for group: %s.", group)
+        return self._Send(205, (group,))
 
     def ResetDeviceEmergencyLampBatTime(self, subnet, device):
-        subnet = str(subnet)
-        device = str(device)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "206" + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Resetted emergency lights for device: " +
-              device + "on subnet: " + subnet + ".")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Resetted emergency lights for device: %s on subnet: %s.", device, subnet)
+        return self._Send(206, ((subnet, device),))
 
     ## Time and location
     def SetRouterCurrentDateTime(self):
         epoch = self.__GetCurrentTimeEpoch()
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "241" + "," +\
-            self.__HLVTIME + epoch +\
-            self.__TERMINATOR
-        print("Updated time and date using the epoch: " + epoch)
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Updated time and date using the epoch: %s", epoch)
+        return self._Send(241, (epoch,))
 
     def SetLatitude(self):
-        print("To be developed")
+        _LOGGER.warning("To be developed")
 
     def SetLongitude(self):
-        print("To be developed")
+        _LOGGER.warning("To be developed")
 
     def SetTimezone(self, hours):
-        secs = hours * (60 ** 2)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "244" + "," +\
-            self.__HLVTIMEZ + secs +\
-            self.__TERMINATOR
-        print("We are in timezone hours: " + hours)
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        secs = int(hours * (60 ** 2))
+        _LOGGER.debug("We are in timezone hours: %s", hours)
+        return self._Send(244, (secs,))
 
     def SetDaylightSavingTime(self, isDst: bool):
-        dst = "1" if isDst else "0"
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "245" + "," +\
-            self.__HLVDST + dst +\
-            self.__TERMINATOR
-        print("Daylight saving time enabled: " + str(isDst))
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Daylight saving time enabled: %s", isDst)
+        return self._Send(245, (bool(isDst),))
 
     ################# Control Commands #################
 
@@ -711,21 +1131,8 @@ class HelvarNetClient:
         >V:1,G:1,B:1,S:1,F:300#
         via TCP socket to the address of the Helvar dali router you defined
         while you instantiated the object"""
-        group = str(group)
-        block = str(block)
-        scene = str(scene)
-        fade = str(fade)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "11" + "," +\
-            self.__HLVGROUP + group + "," +\
-            self.__HLVBLOCK + block + "," +\
-            self.__HLVSCN + scene + "," +\
-            self.__HLVFADET + fade +\
-            self.__TERMINATOR
-        print("Recalled Scene for group " + group + ".")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Recalled Scene for group %s.", group)
+        return self._Send(11, (group, block, scene, fade))
 
     def RecallSceneOnDevice(self, subnet, device, block, scene, fade):
         ''' If ip is 192.168.1.10 for the helvar router,
@@ -735,63 +1142,2727 @@ class HelvarNetClient:
         The full device address for a device with dali address 1 and subnet 1, looks like:
         1.10.1.1
         '''
-        subnet = str(subnet)
-        device = str(device)
-        block = str(block)
-        scene = str(scene)
-        fade = str(fade)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "12" + "," +\
-            self.__HLVBLOCK + block + "," +\
-            self.__HLVSCN + scene + "," +\
-            self.__HLVFADET + fade + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Recalled Scene " + scene + " for device " +
-              device + " on subnet " + subnet + ".")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Recalled Scene %s for device %s on subnet %s.", scene, device, subnet)
+        return self._Send(12, (block, scene, fade, (subnet, device)))
 
     def SetGroupAbsoluteLevel(self, group, level, fade):
-        group = str(group)
-        level = str(level)
-        fade = str(fade)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "13" + "," +\
-            self.__HLVGROUP + group + "," +\
-            self.__HLVLEVEL + level + "," +\
-            self.__HLVFADET + fade +\
-            self.__TERMINATOR
-        print("Level Set!")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
+        _LOGGER.debug("Level Set!")
+        return self._Send(13, (group, level, fade))
 
     def SetDeviceAbsoluteLevel(self, subnet, device, level, fade):
-        subnet = str(subnet)
-        device = str(device)
-        level = str(level)
-        fade = str(fade)
-        message = self.__COMMAND +\
-            self.__HLVVER + "1" + "," +\
-            self.__HLVCMD + "14" + "," +\
-            self.__HLVLEVEL + level + "," +\
-            self.__HLVFADET + fade + "," +\
-            "@" + self.clusterID + "." + self.memberID + "." + subnet + "." + device +\
-            self.__TERMINATOR
-        print("Level Set!")
-        print("Sent command looks like: " + message)
-        self.__SendTCPMessageAndContinue(self.server, self.port, message)
-
-    def SetGroupLevelAbsoluteProportion(self):
-        print("To be developed")
-
-    def SetDeviceLevelAbsoluteProportion(self):
-        print("To be developed")
-
-    def SetGroupLevelModifyProportion(self):
-        print("To be developed")
-
-    def SetDeviceLevelModifyProportion(self):
-        print("To be developed")
\ No newline at end of file
+        _LOGGER.debug("Level Set!")
+        return self._Send(14, (level, fade, (subnet, device)))
+
+    def SetGroupLevelAbsoluteProportion(self, group, proportion, fade):
+        ''' proportion goes from -100 to 100: 0 is the level of the last scene
+        recalled, 100 full level, -100 off, and anything in between is that
+        percent of the way up or down
+        '''
+        _LOGGER.debug("Proportion %s set for group %s.", proportion, group)
+        return self._Send(15, (group, proportion, fade))
+
+    def SetDeviceLevelAbsoluteProportion(self, subnet, device, proportion, fade):
+        _LOGGER.debug("Proportion %s set for device %s on subnet %s.", proportion, device, subnet)
+        return self._Send(16, (proportion, fade, (subnet, device)))
+
+    def SetGroupLevelModifyProportion(self, group, proportion, fade):
+        ''' Adds proportion (-100 to 100) to the current proportion of the
+        group, to dim or brighten it relative to where it is without asking
+        the router for the levels first
+        '''
+        _LOGGER.debug("Proportion of group %s changed by %s.", group, proportion)
+        return self._Send(17, (group, proportion, fade))
+
+    def SetDeviceLevelModifyProportion(self, subnet, device, proportion, fade):
+        _LOGGER.debug("Proportion of device %s on subnet %s changed by %s.", device, subnet, proportion)
+        return self._Send(18, (proportion, fade, (subnet, device)))
+
+
+# Commands where only the latest value per target matters, command -> the
+# parameter that identifies the target. The relative ones (17, 18) are left
+# out, every one of them has to reach the router.
+_COALESCABLE = {13: "group", 14: "address", 15: "group", 16: "address"}
+
+
+class HelvarNetOutbox:
+    ''' Bounded queue of control and configuration messages, a background
+    thread sends them in order through send(message). Put() returns right
+    away; when the queue is full, policy decides what happens:
+        "block": wait for room (up to timeout seconds, then queue.Full)
+        "drop-oldest": the oldest queued message is thrown away
+        "error": raise queue.Full
+    Send errors never reach the caller, they are counted in failed and the
+    last one is kept in lastError.
+
+    With coalesceWindow (seconds) messages put with a key (slider mode) stay
+    at least that long in the queue, and a newer message with the same key
+    replaces the one still waiting instead of being queued after it.
+    Keys are (target, kind) pairs: a message for the same target but of
+    another kind (a proportion after a level) is queued after the waiting
+    one, which can't be replaced any more.
+    Any message without a key works as a barrier, levels put after it are
+    never merged with the ones before, so the order of what changes the
+    lights is kept.
+
+    Messages can be put with the (command, values) they hold, then
+    started(command, values) and finished(command, values, started, error)
+    are called around the write that sends them (HelvarNetClient times them
+    in its metrics this way).
+    '''
+
+    POLICIES = ("block", "drop-oldest", "error")
+
+    def __init__(self, send, maxsize=1000, policy="block", timeout=None, batch=32,
+                 coalesceWindow=None, started=None, finished=None):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown outbox policy: " + str(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.batch = batch  # Messages written together in a single send
+        self.coalesceWindow = coalesceWindow
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.collapsed = 0  # Messages replaced by a newer one before being sent
+        self.lastError = None
+        self.__send = send
+        self.__started = started
+        self.__finished = finished
+        self.__queue = collections.deque()  # [message, key, time it was queued, (command, values)s]
+        self.__latest = {}  # target -> entry that can still be replaced
+        self.__sending = 0
+        self.__closed = False
+        self.__lock = threading.Condition()
+        self.__thread = threading.Thread(target=self.__Run, daemon=True)
+        self.__thread.start()
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def Put(self, message, key=None, commands=()):
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError("Outbox is closed")
+            if key is None or self.coalesceWindow is None:
+                key = None
+                self.__latest.clear()
+            elif key[0] in self.__latest and self.__latest[key[0]][1] == key:
+                self.__latest[key[0]][0] = message
+                self.__latest[key[0]][3] = commands
+                self.collapsed += 1
+                return
+            if len(self.__queue) >= self.maxsize:
+                if self.policy == "error":
+                    raise queue.Full("Outbox is full")
+                if self.policy == "drop-oldest":
+                    self.__Forget(self.__queue.popleft())
+                    self.dropped += 1
+                elif not self.__lock.wait_for(
+                        lambda: len(self.__queue) < self.maxsize or self.__closed, self.timeout):
+                    raise queue.Full("Outbox is full")
+                elif self.__closed:
+                    raise RuntimeError("Outbox is closed")
+            entry = [message, key, time.monotonic(), commands]
+            self.__queue.append(entry)
+            if key is not None:
+                self.__latest[key[0]] = entry
+            self.__lock.notify_all()
+
+    def __Forget(self, entry):
+        if entry[1] is not None and self.__latest.get(entry[1][0]) is entry:
+            del self.__latest[entry[1][0]]
+
+    def __Wait(self, entry):
+        ''' Seconds the entry has to stay in the queue to collect newer values '''
+        if entry[1] is None or self.__closed:
+            return 0
+        return entry[2] + self.coalesceWindow - time.monotonic()
+
+    def __Run(self):
+        while True:
+            with self.__lock:
+                while not self.__queue or self.__Wait(self.__queue[0]) > 0:
+                    if not self.__queue and self.__closed:
+                        return  # Closed and everything was sent
+                    self.__lock.wait(self.__Wait(self.__queue[0]) if self.__queue else None)
+                messages = []
+                commands = []
+                while self.__queue and len(messages) < self.batch and self.__Wait(self.__queue[0]) <= 0:
+                    entry = self.__queue.popleft()
+                    self.__Forget(entry)
+                    messages.append(entry[0])
+                    commands.extend(entry[3])
+                self.__sending = len(messages)
+                self.__lock.notify_all()
+            if self.__started is not None:
+                commands = [(command, values, self.__started(command, values)) for command, values in commands]
+            error = None
+            try:
+                self.__send(b"".join(messages))
+                self.sent += len(messages)
+            except Exception as failure:
+                error = failure
+                self.failed += len(messages)
+                self.lastError = error
+            if self.__finished is not None:
+                for command, values, started in commands:
+                    self.__finished(command, values, started, error)
+            with self.__lock:
+                self.__sending = 0
+                self.__lock.notify_all()
+
+    def Flush(self, timeout=None):
+        ''' Waits until every queued message was sent, False on timeout '''
+        with self.__lock:
+            return self.__lock.wait_for(
+                lambda: not self.__queue and not self.__sending, timeout)
+
+    def Close(self, timeout=None):
+        ''' Sends what is still queued and stops the background thread '''
+        with self.__lock:
+            self.__closed = True
+            self.__lock.notify_all()
+        self.__thread.join(timeout)
+
+
+class HelvarNetTCPTransport:
+    ''' Queries and commands over pooled TCP connections, the default
+    transport of HelvarNetClient. Every transport has Request(message,
+    command) returning the answer frame (None when the router can't be
+    reached), Send(message, command) for messages without an answer, and
+    Close(). observe(command, phase, seconds) is set by the client to time
+    the phases of the requests for its metrics.
+    '''
+
+    def __init__(self, server, port, maxConnections=4, timeout=10):
+        self.timeout = timeout
+        self.__pool = HelvarNetConnectionPool(server, port, maxConnections, timeout)
+        self.observe = None
+
+    def Request(self, message, command=None):
+        ''' Sends the message through a pooled connection and reads the answer
+        frame. A pooled connection may have been closed by the router
+        while idle, so a failure gets one more try on a fresh connection.
+        Waiting for a free connection and connecting have to fit in timeout
+        seconds, and so does every read. With a deadline for the call
+        everything has to be done by then.
+        Frames that don't answer the message are thrown away: the router
+        answers a bad command with an error, and that error waits in the
+        socket for whoever uses the connection next.
+        '''
+        fields = message[1:-1]
+        # Only calls with a deadline keep track of the time left, settimeout()
+        # costs a system call
+        limited = _CONTEXT.deadline is not None
+        deadline = _Deadline(self.timeout) if limited else None
+        for attempt in range(2):
+            started = time.perf_counter()
+            try:
+                s = self.__pool.Acquire(_Remaining(deadline) if limited else self.timeout)
+            except HelvarNetTimeoutError:
+                raise
+            except OSError:
+                return None
+            connected = time.perf_counter()
+            decoder = HelvarNetFrameDecoder()
+            buffer = bytearray(1024)
+            try:
+                if limited:
+                    s.settimeout(_Remaining(deadline))
+                s.sendall(message)
+                sent = time.perf_counter()
+                answer = None
+                first = True
+                while answer is None:
+                    if limited:
+                        s.settimeout(_Remaining(deadline))
+                    received = s.recv_into(buffer)
+                    if not received:
+                        raise ConnectionResetError("Connection closed by the router")
+                    if first and self.observe is not None:
+                        self.observe(command, "first_byte", time.perf_counter() - sent)
+                    first = False
+                    frames = decoder.Feed(memoryview(buffer)[:received])
+                    for index, frame in enumerate(frames):
+                        # The reply usually echoes the fields as they were sent
+                        if frame.fields == fields or _CorrelationKey(frame.fields) == _CorrelationKey(fields):
+                            answer = frame
+                            break
+                        _LOGGER.debug("Dropped a reply to another request: %s", frame)
+            except (socket.timeout, HelvarNetTimeoutError):
+                # A late answer would be read by the next query, drop the socket
+                self.__pool.Release(s, reusable=False)
+                raise HelvarNetTimeoutError("No answer from the router") from None
+            except socket.error:
+                self.__pool.Release(s, reusable=False)
+                continue
+            # Anything after the answer is not ours, don't keep the socket
+            self.__pool.Release(s, reusable=index == len(frames) - 1 and not len(decoder))
+            if self.observe is not None:
+                self.observe(command, "connect", connected - started)
+                self.observe(command, "send", sent - connected)
+            return answer
+        return None
+
+    def Send(self, message, command=None):
+        limited = _CONTEXT.deadline is not None
+        deadline = _Deadline(self.timeout) if limited else None
+        for attempt in range(2):
+            started = time.perf_counter()
+            s = self.__pool.Acquire(_Remaining(deadline) if limited else self.timeout)
+            connected = time.perf_counter()
+            try:
+                if limited:
+                    s.settimeout(_Remaining(deadline))
+                s.sendall(message)
+            except (socket.timeout, HelvarNetTimeoutError):
+                # Part of the message may be written already
+                self.__pool.Release(s, reusable=False)
+                raise HelvarNetTimeoutError("The router is not reading") from None
+            except socket.error:
+                self.__pool.Release(s, reusable=False)
+                if attempt:
+                    raise
+                continue
+            self.__pool.Release(s)
+            if self.observe is not None and command is not None:
+                self.observe(command, "connect", connected - started)
+                self.observe(command, "send", time.perf_counter() - connected)
+            return
+
+    def Stats(self):
+        return self.__pool.Stats()
+
+    def Close(self):
+        self.__pool.Close()
+
+
+def _Datagrams(data, size):
+    ''' Packs the # terminated messages of data in as few datagrams of at most
+    size bytes as possible, a message is never split (a longer one goes alone)
+    '''
+    datagrams = []
+    start = 0
+    while len(data) - start > size:
+        end = data.rfind(b"#", start, start + size) + 1
+        if end <= start:
+            end = data.find(b"#", start + size) + 1 or len(data)
+        datagrams.append(data[start:end])
+        start = end
+    if start < len(data):
+        datagrams.append(data[start:])
+    return datagrams
+
+
+class HelvarNetUDPTransport:
+    ''' Messages as UDP datagrams (port 50001 on the routers) through a
+    single socket kept for the whole life of the client: there's no
+    connection to set up and nothing to wait for, but also no delivery
+    guarantee. Messages sent together (the outbox batches) are packed in as
+    few datagrams as possible.
+    Queries wait for the answer on the same socket, one at a time, answers
+    that don't match the query (late ones) are thrown away.
+    '''
+
+    def __init__(self, server, port=50001, timeout=10, maxDatagram=1400):
+        self.timeout = timeout
+        self.maxDatagram = maxDatagram
+        self.observe = None
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__socket.connect((server, port))
+        self.__lock = threading.Lock()  # One query waiting for its answer at a time
+
+    def Request(self, message, command=None):
+        key = _CorrelationKey(message[1:-1])
+        deadline = _Deadline(self.timeout)
+        remaining = _Remaining(deadline)
+        if not self.__lock.acquire(timeout=-1 if remaining is None else remaining):
+            raise HelvarNetTimeoutError("Another query is waiting for the router")
+        try:
+            started = time.perf_counter()
+            try:
+                self.__socket.settimeout(_Remaining(deadline))
+                self.__socket.send(message)
+                while True:
+                    self.__socket.settimeout(_Remaining(deadline))
+                    data = self.__socket.recv(65535)
+                    # Every datagram holds whole messages
+                    for frame in HelvarNetFrameDecoder().Feed(data):
+                        if _CorrelationKey(frame.fields) == key:
+                            if self.observe is not None:
+                                self.observe(command, "first_byte", time.perf_counter() - started)
+                            return frame
+            except (socket.timeout, HelvarNetTimeoutError):
+                raise HelvarNetTimeoutError("No answer from the router") from None
+            except OSError:
+                return None
+        finally:
+            self.__lock.release()
+
+    def Send(self, message, command=None):
+        for datagram in _Datagrams(message, self.maxDatagram):
+            self.__socket.send(datagram)
+
+    def Close(self):
+        self.__socket.close()
+
+
+class HelvarNetHybridTransport:
+    ''' Queries over tcp (a HelvarNetTCPTransport), where the answer matters,
+    and control and configuration commands over udp (a HelvarNetUDPTransport)
+    '''
+
+    def __init__(self, tcp, udp):
+        self.tcp = tcp
+        self.udp = udp
+
+    @property
+    def observe(self):
+        return self.tcp.observe
+
+    @observe.setter
+    def observe(self, observe):
+        self.tcp.observe = self.udp.observe = observe
+
+    def Request(self, message, command=None):
+        return self.tcp.Request(message, command)
+
+    def Send(self, message, command=None):
+        self.udp.Send(message, command)
+
+    def Stats(self):
+        return self.tcp.Stats()
+
+    def Close(self):
+        self.tcp.Close()
+        self.udp.Close()
+
+
+class _TokenBucket:
+    ''' rate requests per second, up to burst at once '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def Take(self, now, cost=1):
+        ''' Takes cost tokens and returns 0, or the seconds until there are
+        enough. A cost bigger than burst goes through with a full bucket and
+        leaves it in debt.
+        '''
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        needed = min(cost, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= cost
+            return 0
+        return (needed - self.tokens) / self.rate
+
+
+class HelvarNetPriority(enum.IntEnum):
+    INTERACTIVE = 0  # Control commands, someone is waiting for the lights
+    CONFIGURATION = 1
+    MONITORING = 2  # Queries
+    BULK = 3  # Scans, sweeps, telemetry
+
+    @classmethod
+    def ForCommand(cls, command):
+        ''' Priority of a command when nobody asked for another one '''
+        # Batches of messages (command None) come from the outbox or SendMany
+        if command is None or command < 100:
+            return cls.INTERACTIVE
+        if command > 200:
+            return cls.CONFIGURATION
+        return cls.MONITORING
+
+
+class _Context(threading.local):
+    ''' Per thread settings of the requests, see RequestPriority and
+    RequestDeadline. Class defaults, a missing attribute of a
+    threading.local is slow to look up.
+    '''
+    priority = None
+    deadline = None
+
+
+_CONTEXT = _Context()
+
+
+@contextlib.contextmanager
+def RequestPriority(priority):
+    ''' Priority of the requests made by this thread inside the with block:
+
+        with pyhelvarnet.RequestPriority(pyhelvarnet.HelvarNetPriority.BULK):
+            levels = [router.QueryLoadLevel(1, device) for device in range(1, 65)]
+    '''
+    previous = _CONTEXT.priority
+    _CONTEXT.priority = priority
+    try:
+        yield
+    finally:
+        _CONTEXT.priority = previous
+
+
+@contextlib.contextmanager
+def RequestDeadline(seconds):
+    ''' Every request made by this thread inside the with block has to be
+    done in seconds from now, waiting for a connection, for the rate limit
+    and the retries included, or it fails with HelvarNetTimeoutError. A
+    nested block can only make it shorter:
+
+        with pyhelvarnet.RequestDeadline(2):
+            level = router.QueryLoadLevel(1, 1)
+    '''
+    previous = _CONTEXT.deadline
+    deadline = time.monotonic() + seconds
+    _CONTEXT.deadline = deadline if previous is None else min(previous, deadline)
+    try:
+        yield
+    finally:
+        _CONTEXT.deadline = previous
+
+
+def _Deadline(timeout):
+    ''' Monotonic time a request has to be done by: timeout seconds from now
+    or the deadline of the call, whichever comes first (None: no limit)
+    '''
+    deadline = None if timeout is None else time.monotonic() + timeout
+    callDeadline = _CONTEXT.deadline
+    if callDeadline is not None and (deadline is None or callDeadline < deadline):
+        deadline = callDeadline
+    return deadline
+
+
+def _Remaining(deadline):
+    ''' Seconds left until deadline, HelvarNetTimeoutError once it's gone '''
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise HelvarNetTimeoutError("Deadline exceeded")
+    return remaining
+
+
+def _InContext(function):
+    ''' function running with the priority and the deadline of the calling
+    thread, for work handed to a pool of worker threads
+    '''
+    priority = _CONTEXT.priority
+    deadline = _CONTEXT.deadline
+
+    def Run(*args):
+        previous = _CONTEXT.priority, _CONTEXT.deadline
+        _CONTEXT.priority, _CONTEXT.deadline = priority, deadline
+        try:
+            return function(*args)
+        finally:
+            _CONTEXT.priority, _CONTEXT.deadline = previous
+
+    return Run
+
+
+def _Priority(command):
+    priority = _CONTEXT.priority
+    if priority is not None:
+        return priority
+    return HelvarNetPriority.ForCommand(command)
+
+
+class HelvarNetScheduler:
+    ''' Lets the requests to one router go at most rps per second (burst at
+    once), the waiting ones in priority order (HelvarNetPriority).
+    Requests age while they wait, every aging seconds they are worth one
+    class more, so bulk work keeps moving under constant interactive load.
+    '''
+
+    def __init__(self, rps=20, burst=None, aging=2.0):
+        self.aging = aging
+        self.granted = collections.Counter()  # priority -> requests let through
+        self.waited = collections.Counter()  # priority -> seconds spent waiting
+        self.__bucket = _TokenBucket(rps, burst)
+        self.__waiting = []  # [priority, time it arrived, sequence]
+        self.__sequence = 0
+        self.__lock = threading.Condition()
+
+    def __len__(self):
+        return len(self.__waiting)
+
+    def __Rank(self, waiter, now):
+        return waiter[0] - (now - waiter[1]) / self.aging, waiter[2]
+
+    def Acquire(self, priority, cost=1):
+        ''' Blocks until the request can go, cost is the number of messages.
+        Past the deadline of the call it gives up with HelvarNetTimeoutError.
+        '''
+        deadline = _CONTEXT.deadline
+        with self.__lock:
+            self.__sequence += 1
+            arrived = time.monotonic()
+            waiter = [int(priority), arrived, self.__sequence]
+            self.__waiting.append(waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if min(self.__waiting, key=lambda other: self.__Rank(other, now)) is waiter:
+                        wait = self.__bucket.Take(now, cost)
+                        if not wait:
+                            break
+                    else:
+                        # Every waiter ages at the same pace, so the order only
+                        # changes when one arrives or leaves: wait for the
+                        # head to leave (a newcomer that ranks first doesn't wait
+                        # for anyone)
+                        wait = None
+                    if deadline is not None:
+                        if deadline <= now:
+                            raise HelvarNetTimeoutError("Deadline exceeded waiting for the rate limit")
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self.__lock.wait(wait)
+            finally:
+                self.__waiting.remove(waiter)
+                # Whoever is first now has to look at the bucket
+                self.__lock.notify_all()
+            self.granted[priority] += 1
+            self.waited[priority] += time.monotonic() - arrived
+
+    def Stats(self):
+        with self.__lock:
+            return {"waiting": len(self.__waiting),
+                    "granted": {HelvarNetPriority(priority).name: count for priority, count in self.granted.items()},
+                    "waited": {HelvarNetPriority(priority).name: seconds for priority, seconds in self.waited.items()}}
+
+
+class AsyncHelvarNetScheduler:
+    ''' asyncio version of HelvarNetScheduler, for the coroutines of one
+    event loop (see helvargateway.py). The head of the queue sleeps until
+    the bucket has tokens for it and wakes the next one up.
+    '''
+
+    def __init__(self, rps=20, burst=None, aging=2.0):
+        self.aging = aging
+        self.granted = collections.Counter()  # priority -> requests let through
+        self.waited = collections.Counter()  # priority -> seconds spent waiting
+        self.__bucket = _TokenBucket(rps, burst)
+        self.__waiting = []  # [priority, time it arrived, sequence, cost, future]
+        self.__sequence = 0
+        self.__releasing = None  # Task handing the tokens out
+
+    def __len__(self):
+        return len(self.__waiting)
+
+    async def Acquire(self, priority, cost=1):
+        ''' Waits until the request can go, cost is the number of messages '''
+        arrived = time.monotonic()
+        if self.__waiting or self.__bucket.Take(arrived, cost):
+            self.__sequence += 1
+            waiter = [int(priority), arrived, self.__sequence, cost, asyncio.get_running_loop().create_future()]
+            self.__waiting.append(waiter)
+            if self.__releasing is None or self.__releasing.done():
+                self.__releasing = asyncio.ensure_future(self.__Release())
+            try:
+                await waiter[4]
+            finally:
+                if waiter in self.__waiting:
+                    self.__waiting.remove(waiter)
+        self.granted[priority] += 1
+        self.waited[priority] += time.monotonic() - arrived
+
+    async def __Release(self):
+        while self.__waiting:
+            now = time.monotonic()
+            waiter = min(self.__waiting, key=lambda other: (other[0] - (now - other[1]) / self.aging, other[2]))
+            wait = self.__bucket.Take(now, waiter[3])
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            self.__waiting.remove(waiter)
+            if not waiter[4].done():
+                waiter[4].set_result(None)
+
+    def Stats(self):
+        return {"waiting": len(self.__waiting),
+                "granted": {HelvarNetPriority(priority).name: count for priority, count in self.granted.items()},
+                "waited": {HelvarNetPriority(priority).name: seconds for priority, seconds in self.waited.items()}}
+
+
+class HelvarNetScheduledTransport:
+    ''' Puts a HelvarNetScheduler in front of another transport '''
+
+    def __init__(self, transport, scheduler):
+        self.transport = transport
+        self.scheduler = scheduler
+
+    @property
+    def observe(self):
+        return self.transport.observe
+
+    @observe.setter
+    def observe(self, observe):
+        self.transport.observe = observe
+
+    def Request(self, message, command=None):
+        self.scheduler.Acquire(_Priority(command))
+        return self.transport.Request(message, command)
+
+    def Send(self, message, command=None):
+        self.scheduler.Acquire(_Priority(command), message.count(b"#"))
+        self.transport.Send(message, command)
+
+    def Stats(self):
+        return self.transport.Stats()
+
+    def Close(self):
+        self.transport.Close()
+
+
+class HelvarNetCircuitBreaker:
+    ''' Stops sending to a router that keeps failing: after failures
+    timeouts or connection errors in a row the circuit opens, and for
+    resetTimeout seconds every call fails right away with
+    HelvarNetCircuitOpenError. Then a single call is let through to try the
+    router (half open): if it works the circuit closes, if not it stays open
+    for another resetTimeout seconds.
+    Error answers (HelvarNetError) come from a live router, they are not
+    failures, and neither is a call that ran out of its own deadline.
+    '''
+
+    def __init__(self, failures=5, resetTimeout=30, router=None):
+        self.failures = failures
+        self.resetTimeout = resetTimeout
+        self.router = router
+        self.state = "closed"  # "open" or "half-open"
+        self.opened = 0  # Times the circuit opened
+        self.rejected = 0  # Calls failed without being sent
+        self.__failed = 0  # Failures in a row
+        self.__openedAt = None
+        self.__trying = False  # The half open call is on its way
+        self.__lock = threading.Lock()
+
+    def Allow(self):
+        ''' Raises HelvarNetCircuitOpenError when the call can't go now '''
+        with self.__lock:
+            if self.state == "closed":
+                return
+            retryAfter = self.__openedAt + self.resetTimeout - time.monotonic()
+            if retryAfter <= 0 and not self.__trying:
+                self.state = "half-open"
+                self.__trying = True
+                return
+            self.rejected += 1
+        raise HelvarNetCircuitOpenError(self.router, max(retryAfter, 0))
+
+    def Record(self, ok):
+        ''' Outcome of an allowed call: True, False (failed) or None when it
+        says nothing about the router
+        '''
+        with self.__lock:
+            if ok is None:
+                self.__trying = False
+            elif ok:
+                self.state = "closed"
+                self.__failed = 0
+                self.__trying = False
+            else:
+                self.__failed += 1
+                if self.state == "half-open" or self.__failed >= self.failures:
+                    if self.state != "open":
+                        self.opened += 1
+                        _LOGGER.warning("Router %s failed %d times in a row, not sending to it for %s s",
+                                        self.router, self.__failed, self.resetTimeout)
+                    self.state = "open"
+                    self.__openedAt = time.monotonic()
+                    self.__trying = False
+
+    def Stats(self):
+        with self.__lock:
+            return {"state": self.state, "failures": self.__failed, "opened": self.opened,
+                    "rejected": self.rejected}
+
+
+def _Outcome(error):
+    ''' What a failed call tells the circuit breaker, see Record() '''
+    if not isinstance(error, OSError):
+        return None
+    deadline = _CONTEXT.deadline
+    if isinstance(error, TimeoutError) and deadline is not None and deadline <= time.monotonic():
+        return None
+    return False
+
+
+def _Backoff(attempt, backoff, maxBackoff):
+    ''' Seconds to wait before retry number attempt + 1, anything from 0 to
+    backoff * 2 ** attempt (full jitter), so clients that failed together
+    don't all come back at the same time
+    '''
+    return random.uniform(0, min(maxBackoff, backoff * 2 ** attempt))
+
+
+class HelvarNetRetryTransport:
+    ''' Puts retries and a circuit breaker (optional) in front of another
+    transport. Queries are idempotent, a timeout or connection error is
+    tried again up to retries times after a random backoff, while there's
+    time left before the deadline of the call. Commands are never retried,
+    the router may have got them before the error.
+    '''
+
+    def __init__(self, transport, retries=2, backoff=0.1, maxBackoff=2.0, breaker=None):
+        self.transport = transport
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.breaker = breaker
+        self.retried = 0
+
+    @property
+    def observe(self):
+        return self.transport.observe
+
+    @observe.setter
+    def observe(self, observe):
+        self.transport.observe = observe
+
+    def __Retry(self, attempt):
+        ''' Waits before the next try, False when there's none '''
+        if attempt >= self.retries:
+            return False
+        delay = _Backoff(attempt, self.backoff, self.maxBackoff)
+        deadline = _CONTEXT.deadline
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return False
+        time.sleep(delay)
+        self.retried += 1
+        return True
+
+    def __Call(self, call, message, command, answered=lambda result: True):
+        if self.breaker is not None:
+            self.breaker.Allow()
+        try:
+            result = call(message, command)
+        except BaseException as error:
+            if self.breaker is not None:
+                self.breaker.Record(_Outcome(error))
+            raise
+        if self.breaker is not None:
+            self.breaker.Record(answered(result))
+        return result
+
+    def Request(self, message, command=None):
+        attempt = 0
+        while True:
+            try:
+                # None is a router that can't be reached
+                frame = self.__Call(self.transport.Request, message, command,
+                                    lambda frame: frame is not None)
+            except OSError as error:
+                if isinstance(error, HelvarNetCircuitOpenError) or not self.__Retry(attempt):
+                    raise
+            else:
+                if frame is not None or not self.__Retry(attempt):
+                    return frame
+            attempt += 1
+
+    def Send(self, message, command=None):
+        self.__Call(self.transport.Send, message, command)
+
+    def Stats(self):
+        return self.transport.Stats()
+
+    def Close(self):
+        self.transport.Close()
+
+
+def _Breaker(breaker, router):
+    ''' breaker option of the clients: None, a number of failures in a row
+    (True for the default) or a HelvarNetCircuitBreaker to share
+    '''
+    if isinstance(breaker, HelvarNetCircuitBreaker):
+        if breaker.router is None:
+            breaker.router = router
+        return breaker
+    if not breaker:
+        return None
+    if breaker is True:
+        return HelvarNetCircuitBreaker(router=router)
+    return HelvarNetCircuitBreaker(breaker, router=router)
+
+
+class HelvarNetClient(HelvarNetCommands):
+    def __init__(self, server, port, maxConnections=4, timeout=10, cache=None,
+                 singleFlight=True, outboxSize=0, outboxPolicy="block", coalesceWindow=None,
+                 metrics=None, transport="tcp", udpPort=50001, rps=None, scheduler=None,
+                 retries=0, backoff=0.1, breaker=None):
+        super().__init__(server, port, cache, metrics)
+        # "tcp": pooled connections, "udp": datagrams, "hybrid": queries over
+        # TCP and everything else over UDP, or a transport object
+        if transport == "tcp":
+            transport = HelvarNetTCPTransport(server, port, maxConnections, timeout)
+        elif transport == "udp":
+            transport = HelvarNetUDPTransport(server, udpPort, timeout)
+        elif transport == "hybrid":
+            transport = HelvarNetHybridTransport(
+                HelvarNetTCPTransport(server, port, maxConnections, timeout),
+                HelvarNetUDPTransport(server, udpPort, timeout))
+        elif isinstance(transport, str):
+            raise ValueError("Unknown transport: " + transport)
+        # Requests wait their turn by priority, at most rps per second. Pass
+        # the same scheduler to every client of a router to share its budget.
+        if scheduler is None and rps is not None:
+            scheduler = HelvarNetScheduler(rps)
+        if scheduler is not None:
+            transport = HelvarNetScheduledTransport(transport, scheduler)
+            self._Gauge("scheduler_waiting", lambda: len(scheduler))
+        # Queries that time out or can't connect are tried again up to
+        # retries times. With a breaker (failures in a row before it opens,
+        # or a HelvarNetCircuitBreaker) calls to a router that is down fail
+        # right away instead of waiting for the timeout every time.
+        breaker = _Breaker(breaker, self.clusterID + "." + self.memberID)
+        if retries or breaker is not None:
+            transport = HelvarNetRetryTransport(transport, retries, backoff, breaker=breaker)
+        if breaker is not None:
+            self._Gauge("circuit_open", lambda: int(breaker.state != "closed"))
+        self.breaker = breaker
+        self.transport = transport
+        if metrics is not None:
+            transport.observe = self._Observe
+        # With an outbox, control and configuration commands are queued and
+        # sent by a background thread instead of blocking the caller.
+        # coalesceWindow needs one, so it gets a default sized outbox.
+        self.outbox = None
+        if coalesceWindow is not None and not outboxSize:
+            outboxSize = 1000
+        if outboxSize:
+            # Queued commands are timed and drop their cached answers when
+            # they are actually sent, not when they are queued
+            hooks = metrics is not None or self.cache is not None
+            self.outbox = HelvarNetOutbox(
+                transport.Send, outboxSize, outboxPolicy, coalesceWindow=coalesceWindow,
+                started=self._Started if hooks else None, finished=self.__Sent if hooks else None)
+        # Identical queries sent while one of them waits for the answer share it
+        self.singleFlight = singleFlight
+        self.coalesced = 0  # Queries that didn't have to be sent thanks to that
+        self.__inflight = {}  # request key -> Future with the answer
+        self.__inflightLock = threading.Lock()
+        if hasattr(transport, "Stats"):
+            self._Gauge("pool_open", lambda: self.transport.Stats()["open"])
+            self._Gauge("pool_idle", lambda: self.transport.Stats()["idle"])
+        self._Gauge("inflight", lambda: len(self.__inflight))
+        if self.outbox is not None:
+            self._Gauge("outbox_queued", lambda: len(self.outbox))
+
+    def Flush(self, timeout=None):
+        ''' Waits until the outbox sent every queued command, False on timeout '''
+        return self.outbox.Flush(timeout) if self.outbox is not None else True
+
+    def Close(self):
+        ''' Sends what is left in the outbox and closes every pooled connection
+        to the router
+        '''
+        if self.outbox is not None:
+            self.outbox.Close()
+        self.transport.Close()
+        for name in ("pool_open", "pool_idle", "inflight", "outbox_queued", "scheduler_waiting",
+                     "circuit_open"):
+            self._Gauge(name, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+    def __Fetch(self, command, values):
+        started = self._Started(command, values)
+        try:
+            answer = self._Answer(self.transport.Request(self._Message(command, values), command))
+        except Exception as error:
+            self._Finished(command, values, started, error)
+            raise
+        self._Finished(command, values, started)
+        self._CacheAnswer(command, values, answer)
+        return answer
+
+    def __Sent(self, command, values, started, error=None):
+        ''' Called by the outbox once it wrote a queued command '''
+        self._Finished(command, values, started, error)
+        self._InvalidateCache(command, values)
+
+    def __FetchOnce(self, command, values):
+        if not self.singleFlight:
+            return self.__Fetch(command, values)
+        key = _RequestKey(command, values)
+        with self.__inflightLock:
+            future = self.__inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.__inflight[key] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            deadline = _CONTEXT.deadline
+            if deadline is None:
+                return future.result()
+            try:
+                return future.result(max(deadline - time.monotonic(), 0))
+            except concurrent.futures.TimeoutError:
+                if future.done():
+                    raise
+                raise HelvarNetTimeoutError("Deadline exceeded") from None
+        try:
+            answer = self.__Fetch(command, values)
+            future.set_result(answer)
+            return answer
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.__inflightLock:
+                del self.__inflight[key]
+
+    def _Query(self, command, values, convert=None):
+        answer = self._CachedAnswer(command, values)
+        if answer is None:
+            answer = self.__FetchOnce(command, values)
+        return convert(answer) if convert else answer
+
+    def _Send(self, command, values):
+        if self.outbox is not None:
+            target = _COALESCABLE.get(command)
+            key = None if target is None else ((target, _Target(command, values, target)), command)
+            self.outbox.Put(self._Message(command, values), key, ((command, values),))
+            return
+        started = self._Started(command, values)
+        try:
+            self.transport.Send(self._Message(command, values), command)
+        except Exception as error:
+            self._Finished(command, values, started, error)
+            raise
+        self._Finished(command, values, started)
+        self._InvalidateCache(command, values)
+
+    def SendMany(self, commands):
+        ''' Sends (command, values) control or configuration commands in a single
+        write (as few datagrams as possible over UDP), values in the order of
+        the parameters in COMMANDS:
+
+            router.SendMany([(13, (10, 50, 0)), (11, (11, 1, 6, 500))])
+        '''
+        commands = list(commands)
+        message = self._encoder.EncodeMany(commands)
+        _LOGGER.debug("Sending %d commands", len(commands))
+        if self.outbox is not None:
+            self.outbox.Put(message, commands=commands)
+            return
+        started = [self._Started(command, values) for command, values in commands]
+        try:
+            self.transport.Send(message)
+        except Exception as error:
+            for (command, values), start in zip(commands, started):
+                self._Finished(command, values, start, error)
+            raise
+        for (command, values), start in zip(commands, started):
+            self._Finished(command, values, start)
+            self._InvalidateCache(command, values)
+
+
+class AsyncHelvarNetClient(HelvarNetCommands):
+    ''' asyncio version of HelvarNetClient, every Query*, Store*, Recall* and
+    Set* method returns an awaitable:
+
+        router = AsyncHelvarNetClient("192.168.0.200", 50000)
+        level = await router.QueryLoadLevel(1, 1)
+
+    Connections are kept open and reused, at most maxConnections at the same
+    time, so many coroutines can share a router without a thread per call.
+    Waiting for a connection and for the answer has to fit in timeout
+    seconds, for a shorter deadline on a single call use asyncio.wait_for.
+    retries and breaker work like in HelvarNetClient.
+    '''
+
+    def __init__(self, server, port, maxConnections=4, timeout=10, cache=None,
+                 singleFlight=True, metrics=None, retries=0, backoff=0.1, breaker=None):
+        super().__init__(server, port, cache, metrics)
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = 2.0
+        self.retried = 0
+        self.breaker = _Breaker(breaker, self.clusterID + "." + self.memberID)
+        self.singleFlight = singleFlight
+        self.coalesced = 0
+        self.__inflight = {}  # request key -> Task fetching the answer
+        self.__idle = []  # (reader, writer)
+        self.__slots = None  # Created on first use, inside the running loop
+        self._Gauge("pool_idle", lambda: len(self.__idle))
+        self._Gauge("inflight", lambda: len(self.__inflight))
+        if self.breaker is not None:
+            self._Gauge("circuit_open", lambda: int(self.breaker.state != "closed"))
+
+    async def __Acquire(self, deadline):
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.maxConnections)
+        try:
+            if self.__slots.locked():
+                # Remaining time first, a coroutine created and never awaited warns
+                timeout = _Remaining(deadline)
+                await asyncio.wait_for(self.__slots.acquire(), timeout)
+            else:
+                await self.__slots.acquire()
+        except asyncio.TimeoutError:
+            raise HelvarNetTimeoutError("No free connection to the router") from None
+        while self.__idle:
+            reader, writer = self.__idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        try:
+            timeout = _Remaining(deadline)
+            return await asyncio.wait_for(asyncio.open_connection(self.server, self.port), timeout)
+        except (asyncio.TimeoutError, HelvarNetTimeoutError):
+            self.__slots.release()
+            raise HelvarNetTimeoutError("Can't connect to the router") from None
+        except BaseException:
+            self.__slots.release()
+            raise
+
+    def __Release(self, connection, reusable=True):
+        if reusable:
+            self.__idle.append(connection)
+        else:
+            connection[1].close()
+        self.__slots.release()
+
+    @staticmethod
+    async def __ReadAnswer(reader, fields):
+        ''' Reads frames until the one answering the request with these fields,
+        the error of a bad command sent before on the connection is skipped
+        '''
+        while True:
+            for frame in HelvarNetFrameDecoder().Feed(await reader.readuntil(b"#")):
+                if frame.fields == fields or _CorrelationKey(frame.fields) == _CorrelationKey(fields):
+                    return frame
+                _LOGGER.debug("Dropped a reply to another request: %s", frame)
+
+    async def __SendTCPMessageAndRecv(self, Message, command=None):
+        deadline = time.monotonic() + self.timeout
+        for attempt in range(2):
+            started = time.perf_counter()
+            try:
+                reader, writer = await self.__Acquire(deadline)
+            except HelvarNetTimeoutError:
+                raise
+            except OSError:
+                return None
+            connected = time.perf_counter()
+            try:
+                writer.write(Message)
+                sent = time.perf_counter()
+                timeout = _Remaining(deadline)
+                frame = await asyncio.wait_for(self.__ReadAnswer(reader, Message[1:-1]), timeout)
+            except (asyncio.TimeoutError, HelvarNetTimeoutError):
+                self.__Release((reader, writer), reusable=False)
+                raise HelvarNetTimeoutError("No answer from the router") from None
+            except (OSError, asyncio.IncompleteReadError):
+                self.__Release((reader, writer), reusable=False)
+                continue
+            except BaseException:
+                # Cancelled while waiting, the answer may still arrive later
+                self.__Release((reader, writer), reusable=False)
+                raise
+            self.__Release((reader, writer))
+            if self.metrics is not None:
+                # The answer is read as a whole, the first byte is when it's complete
+                self._Observe(command, "connect", connected - started)
+                self._Observe(command, "send", sent - connected)
+                self._Observe(command, "first_byte", time.perf_counter() - sent)
+            return frame
+        return None
+
+    async def __SendTCPMessageAndContinue(self, Message):
+        deadline = time.monotonic() + self.timeout
+        for attempt in range(2):
+            reader, writer = await self.__Acquire(deadline)
+            try:
+                writer.write(Message)
+                timeout = _Remaining(deadline)
+                await asyncio.wait_for(writer.drain(), timeout)
+            except (asyncio.TimeoutError, HelvarNetTimeoutError):
+                # Part of the message may be written already
+                self.__Release((reader, writer), reusable=False)
+                raise HelvarNetTimeoutError("The router is not reading") from None
+            except OSError:
+                self.__Release((reader, writer), reusable=False)
+                if attempt:
+                    raise
+                continue
+            except BaseException:
+                self.__Release((reader, writer), reusable=False)
+                raise
+            self.__Release((reader, writer))
+            return
+
+    async def __Call(self, call, *args, answered=lambda result: True):
+        if self.breaker is not None:
+            self.breaker.Allow()
+        try:
+            result = await call(*args)
+        except BaseException as error:
+            # Cancelled by the caller (asyncio.wait_for) says nothing about the router
+            if self.breaker is not None:
+                self.breaker.Record(_Outcome(error))
+            raise
+        if self.breaker is not None:
+            self.breaker.Record(answered(result))
+        return result
+
+    async def __Request(self, message, command):
+        ''' Queries are tried again after a timeout or connection error, see
+        HelvarNetRetryTransport
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                frame = await self.__Call(self.__SendTCPMessageAndRecv, message, command,
+                                          answered=lambda frame: frame is not None)
+            except OSError as error:
+                if isinstance(error, HelvarNetCircuitOpenError) or attempt == self.retries:
+                    raise
+            else:
+                if frame is not None or attempt == self.retries:
+                    return frame
+            await asyncio.sleep(_Backoff(attempt, self.backoff, self.maxBackoff))
+            self.retried += 1
+
+    async def __Fetch(self, command, values):
+        started = self._Started(command, values)
+        try:
+            answer = self._Answer(await self.__Request(self._Message(command, values), command))
+        except Exception as error:
+            self._Finished(command, values, started, error)
+            raise
+        self._Finished(command, values, started)
+        self._CacheAnswer(command, values, answer)
+        return answer
+
+    async def __FetchOnce(self, command, values):
+        if not self.singleFlight:
+            return await self.__Fetch(command, values)
+        key = _RequestKey(command, values)
+        task = self.__inflight.get(key)
+        if task is None:
+            task = self.__inflight[key] = asyncio.ensure_future(self.__Fetch(command, values))
+            task.add_done_callback(lambda done: self.__inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Shielded, a caller that gets cancelled doesn't cancel the others
+        return await asyncio.shield(task)
+
+    async def _Query(self, command, values, convert=None):
+        answer = self._CachedAnswer(command, values)
+        if answer is None:
+            answer = await self.__FetchOnce(command, values)
+        return convert(answer) if convert else answer
+
+    async def _Send(self, command, values):
+        started = self._Started(command, values)
+        try:
+            await self.__Call(self.__SendTCPMessageAndContinue, self._Message(command, values))
+        except Exception as error:
+            self._Finished(command, values, started, error)
+            raise
+        self._Finished(command, values, started)
+        self._InvalidateCache(command, values)
+
+    async def Close(self):
+        ''' Closes every open connection to the router '''
+        idle, self.__idle = self.__idle, []
+        for reader, writer in idle:
+            writer.close()
+        for name in ("pool_idle", "inflight", "circuit_open"):
+            self._Gauge(name, None)
+        for reader, writer in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.Close()
+
+
+class HelvarNetPipeline(HelvarNetCommands):
+    ''' Sends requests back to back on a single connection without waiting for
+    the answers, a reader thread matches every reply with its request using
+    the echoed command and address/group. Queries return a
+    concurrent.futures.Future instead of the answer:
+
+        with HelvarNetPipeline("192.168.0.200", 50000) as pipe:
+            futures = [pipe.QueryDeviceState(1, device) for device in range(1, 65)]
+            states = [future.result() for future in futures]
+
+    At most maxInFlight queries are waiting for an answer at the same time,
+    further queries block until one is answered. Queries not answered in
+    timeout seconds fail with HelvarNetTimeoutError. When the router can't
+    be reached, the requests made in the next reconnectDelay seconds fail
+    right away instead of trying to connect one after the other.
+    '''
+
+    def __init__(self, server, port, maxInFlight=64, timeout=10, metrics=None, reconnectDelay=5):
+        super().__init__(server, port, metrics=metrics)
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.reconnectDelay = reconnectDelay
+        self.__socket = None
+        self.__pending = _PendingReplies()
+        self._Gauge("pending", lambda: len(self.__pending))
+        self.__slots = threading.BoundedSemaphore(maxInFlight)
+        self.__lock = threading.Lock()  # Guards the socket and the pending replies
+        self.__unreachable = None  # (monotonic time to try again, error) after a failed connect
+
+    def __Connect(self):
+        if self.__unreachable is not None:
+            retry, error = self.__unreachable
+            if time.monotonic() < retry:
+                raise ConnectionError("Router unreachable: %s" % error)
+        try:
+            s = socket.create_connection((self.server, self.port), self.timeout)
+        except OSError as error:
+            _LOGGER.warning("Can't connect to %s, failing its requests for %s s: %s",
+                            self.server, self.reconnectDelay, error)
+            self.__unreachable = (time.monotonic() + self.reconnectDelay, error)
+            raise
+        self.__unreachable = None
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__socket = s
+        threading.Thread(target=self.__ReadReplies, args=(s,), daemon=True).start()
+
+    def __ReadReplies(self, s):
+        decoder = HelvarNetFrameDecoder()
+        buffer = bytearray(4096)
+        while True:
+            with self.__lock:
+                if self.__socket is not s:
+                    return
+                deadline = self.__pending.NextDeadline()
+            # Wake up at the first deadline to fail the queries that expired,
+            # queries sent while we wait are checked on the next round
+            wait = self.timeout / 4
+            if deadline is not None:
+                wait = min(max(deadline - time.monotonic(), 0), wait)
+            try:
+                readable, writable, failed = select.select([s], [], [], wait)
+                received = s.recv_into(buffer) if readable else None
+            except (OSError, ValueError) as error:
+                self.__Fail(s, ConnectionResetError(str(error)))
+                return
+            if received == 0:
+                self.__Fail(s, ConnectionResetError("Connection closed by the router"))
+                return
+            if received:
+                for frame in decoder.Feed(memoryview(buffer)[:received]):
+                    self.__Dispatch(frame)
+            with self.__lock:
+                expired = self.__pending.PopExpired(time.monotonic())
+            for deadline, future, convert in expired:
+                future.set_exception(HelvarNetTimeoutError("No answer from the router"))
+
+    def __Dispatch(self, frame):
+        with self.__lock:
+            entry = self.__pending.Pop(_CorrelationKey(frame.fields))
+        if entry is None:
+            return  # Late answer of a query that timed out, or not ours
+        deadline, future, convert = entry
+        try:
+            future.set_result(self._Answer(frame, convert))
+        except Exception as error:
+            future.set_exception(error)
+
+    def __Fail(self, s, error):
+        s.close()
+        with self.__lock:
+            if self.__socket is not s:
+                return  # Already closed or replaced by a new connection
+            self.__socket = None
+            entries = self.__pending.PopAll()
+        for deadline, future, convert in entries:
+            future.set_exception(error)
+
+    def __Write(self, message, entry=None):
+        with self.__lock:
+            if self.__socket is None:
+                self.__Connect()
+            s = self.__socket
+            if entry is not None:
+                self.__pending.Add(_CorrelationKey(message[1:-1]), entry)
+            try:
+                # Written while holding the lock, so the order of the requests
+                # on the wire is the order of the pending replies
+                s.sendall(message)
+                return
+            except OSError as error:
+                failure = error
+        self.__Fail(s, failure)
+        raise failure
+
+    def _Query(self, command, values, convert=None):
+        message = self._Message(command, values)
+        self.__slots.acquire()
+        future = concurrent.futures.Future()
+        future.add_done_callback(lambda f: self.__slots.release())
+        started = self._Started(command, values)
+        if started is not None:
+            future.add_done_callback(lambda f: self._Finished(
+                command, values, started, None if f.cancelled() else f.exception()))
+        try:
+            self.__Write(message, [time.monotonic() + self.timeout, future, convert])
+        except OSError as error:
+            if not future.done():
+                future.set_exception(error)
+        return future
+
+    def _Send(self, command, values):
+        started = self._Started(command, values)
+        try:
+            self.__Write(self._Message(command, values))
+        except Exception as error:
+            self._Finished(command, values, started, error)
+            raise
+        self._Finished(command, values, started)
+
+    def Close(self):
+        self._Gauge("pending", None)
+        with self.__lock:
+            s, self.__socket = self.__socket, None
+            entries = self.__pending.PopAll()
+        if s is not None:
+            s.close()
+        for deadline, future, convert in entries:
+            future.set_exception(ConnectionError("Pipeline closed"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+
+class AsyncHelvarNetPipeline(HelvarNetCommands):
+    ''' asyncio version of HelvarNetPipeline, every query is an awaitable
+    answered as soon as its reply arrives, while many of them share one
+    connection:
+
+        async with AsyncHelvarNetPipeline("192.168.0.200", 50000) as pipe:
+            states = await asyncio.gather(*[pipe.QueryDeviceState(subnet, device)
+                                            for subnet in range(1, 5)
+                                            for device in range(1, 65)])
+    '''
+
+    def __init__(self, server, port, maxInFlight=64, timeout=10, metrics=None, reconnectDelay=5):
+        super().__init__(server, port, metrics=metrics)
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.reconnectDelay = reconnectDelay
+        self.__writer = None
+        self.__reader = None  # Task reading the replies
+        self.__pending = _PendingReplies()
+        self._Gauge("pending", lambda: len(self.__pending))
+        self.__slots = None  # Created on first use, inside the running loop
+        self.__connecting = None
+        self.__unreachable = None  # (monotonic time to try again, error) after a failed connect
+
+    async def __Connect(self):
+        if self.__connecting is None:
+            self.__connecting = asyncio.Lock()
+        async with self.__connecting:
+            if self.__writer is None:
+                if self.__unreachable is not None:
+                    retry, error = self.__unreachable
+                    if time.monotonic() < retry:
+                        raise ConnectionError("Router unreachable: %s" % error)
+                try:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.server, self.port), self.timeout)
+                except (OSError, asyncio.TimeoutError) as error:
+                    _LOGGER.warning("Can't connect to %s, failing its requests for %s s: %s",
+                                    self.server, self.reconnectDelay, error or "timeout")
+                    self.__unreachable = (time.monotonic() + self.reconnectDelay, error or "timeout")
+                    if isinstance(error, asyncio.TimeoutError):
+                        raise HelvarNetTimeoutError("Can't connect to the router") from None
+                    raise
+                self.__unreachable = None
+                self.__writer = writer
+                self.__reader = asyncio.ensure_future(self.__ReadReplies(reader, writer))
+        return self.__writer
+
+    async def __ReadReplies(self, reader, writer):
+        decoder = HelvarNetFrameDecoder()
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    raise ConnectionResetError("Connection closed by the router")
+                for frame in decoder.Feed(data):
+                    entry = self.__pending.Pop(_CorrelationKey(frame.fields))
+                    if entry is not None and not entry[1].done():
+                        entry[1].set_result(frame)
+        except OSError as error:
+            self.__Fail(writer, error)
+
+    def __Fail(self, writer, error):
+        writer.close()
+        if self.__writer is not writer:
+            return  # Already closed or replaced by a new connection
+        self.__writer = None
+        for deadline, future, convert in self.__pending.PopAll():
+            if not future.done():
+                future.set_exception(error)
+
+    async def Request(self, message):
+        ''' Sends an encoded query and returns its reply frame as it came, so
+        it can be relayed (see helvargateway.py)
+        '''
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.maxInFlight)
+        async with self.__slots:
+            writer = await self.__Connect()
+            key = _CorrelationKey(message[1:-1])
+            entry = [None, asyncio.get_running_loop().create_future(), None]
+            self.__pending.Add(key, entry)
+            try:
+                writer.write(message)
+                try:
+                    return await asyncio.wait_for(entry[1], self.timeout)
+                except asyncio.TimeoutError:
+                    raise HelvarNetTimeoutError("No answer from the router") from None
+            finally:
+                self.__pending.Remove(key, entry)
+
+    async def Send(self, message):
+        ''' Writes encoded messages that get no answer '''
+        writer = await self.__Connect()
+        writer.write(message)
+        await writer.drain()
+
+    async def _Query(self, command, values, convert=None):
+        message = self._Message(command, values)
+        started = self._Started(command, values)
+        try:
+            answer = self._Answer(await self.Request(message), convert)
+        except Exception as error:
+            self._Finished(command, values, started, error)
+            raise
+        self._Finished(command, values, started)
+        return answer
+
+    async def _Send(self, command, values):
+        message = self._Message(command, values)
+        started = self._Started(command, values)
+        try:
+            await self.Send(message)
+        except Exception as error:
+            self._Finished(command, values, started, error)
+            raise
+        self._Finished(command, values, started)
+
+    async def Close(self):
+        self._Gauge("pending", None)
+        writer, self.__writer = self.__writer, None
+        if writer is None:
+            return
+        self.__reader.cancel()
+        writer.close()
+        for deadline, future, convert in self.__pending.PopAll():
+            if not future.done():
+                future.set_exception(ConnectionError("Pipeline closed"))
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.Close()
+
+
+def RouterIP(server, router):
+    ''' IP address of router ("cluster.router") in the workgroup of the router
+    at server: routers get their cluster and member IDs from the last two
+    bytes of the IP
+    '''
+    return server.rsplit(".", 2)[0] + "." + router
+
+
+def _RouterOf(address):
+    ''' "cluster.router" of a "cluster.router.subnet.device" address '''
+    return address.rsplit(".", 2)[0]
+
+
+def _AddressText(address):
+    ''' "cluster.router.subnet.device" of an address given as text or as a tuple '''
+    return address if isinstance(address, str) else ".".join(str(part) for part in address)
+
+
+def _ForEachRouter(work, function):
+    ''' Runs function(*item) for every item of work (one per router) at the
+    same time, each one in its own thread, and returns the results in order
+    '''
+    work = list(work)
+    if not work:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(len(work)) as executor:
+        return list(executor.map(lambda item: function(*item), work))
+
+
+@dataclasses.dataclass
+class HelvarDevice:
+    address: str  # cluster.router.subnet.device
+    type: int
+    description: str = ""
+    state: int = 0
+
+    @property
+    def router(self):
+        return _RouterOf(self.address)
+
+    @property
+    def subnet(self):
+        return int(self.address.split(".")[2])
+
+    @property
+    def device(self):
+        return int(self.address.split(".")[3])
+
+
+@dataclasses.dataclass
+class HelvarGroup:
+    group: int
+    description: str = ""
+    members: list = dataclasses.field(default_factory=list)  # Device addresses
+
+
+def _Result(future):
+    ''' Answer of a pipelined query, None if the router said there's nothing
+    there (or did not answer at all)
+    '''
+    try:
+        return future.result()
+    except (HelvarNetError, TimeoutError, ConnectionError):
+        return None
+
+
+def _Found(future):
+    ''' Answer of a pipelined query about a device, None only when the router
+    says there's no device there. Timeouts and connection errors are raised,
+    a router that doesn't answer is not a router without devices.
+    '''
+    try:
+        return future.result()
+    except HelvarNetError as error:
+        if error.code == 11:  # Device does not exist
+            return None
+        raise
+
+
+class HelvarNetInventory:
+    ''' Every router, device and group behind a HelvarNet workgroup.
+    Scan() walks clusters -> routers -> subnets -> DALI addresses, every
+    router at the same time and every router through its own pipelined
+    connection, so at most maxInFlight queries per router are in the air.
+    Addresses where there's no device are skipped. A router that times out
+    or can't be reached keeps the devices known from before and its error
+    goes to errors ("groups" for ScanGroups), the other routers are scanned
+    anyway.
+
+        inventory = HelvarNetInventory("192.168.0.200", 50000)
+        inventory.Scan()
+        inventory.Save("site.json")
+
+    The next time the snapshot loads in milliseconds, and Refresh() only
+    asks for the details of the devices that changed:
+
+        inventory = HelvarNetInventory.Load("site.json", "192.168.0.200", 50000)
+        changed = inventory.Refresh()
+    '''
+
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, server, port, maxInFlight=64, timeout=10,
+                 subnets=(1, 2, 3, 4), addresses=range(1, 65), metrics=None):
+        self.server = server
+        self.port = port
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.metrics = metrics
+        self.subnets = tuple(subnets)
+        self.addresses = tuple(addresses)
+        self.routers = []  # "cluster.router"
+        self.devices = {}  # address -> HelvarDevice
+        self.groups = {}  # group -> HelvarGroup
+        self.scanned = None  # Epoch of the last Scan or Refresh
+        self.errors = {}  # router -> exception, of the last Scan or Refresh
+
+    def __Pipeline(self, router):
+        return HelvarNetPipeline(
+            RouterIP(self.server, router), self.port, self.maxInFlight, self.timeout, self.metrics)
+
+    def __ForEachRouter(self, routers, scan):
+        ''' Runs scan(router) for every router at the same time, returns a
+        HelvarNetResults
+        '''
+        outcome = HelvarNetResults()
+
+        def Run(router):
+            try:
+                outcome.results[router] = scan(router)
+            except OSError as error:
+                _LOGGER.warning("Router %s not scanned, keeping what was known: %s", router, error)
+                outcome.errors[router] = error
+
+        _ForEachRouter([(router,) for router in routers], Run)
+        return outcome
+
+    def DiscoverRouters(self):
+        ''' Asks the router we know for the clusters and the routers in them '''
+        with HelvarNetPipeline(self.server, self.port, self.maxInFlight, self.timeout, self.metrics) as pipe:
+            clusters = pipe.QueryClusters().result()
+            members = [(cluster, pipe.QueryRouters(cluster)) for cluster in clusters]
+            self.routers = [cluster + "." + member
+                            for cluster, future in members for member in _Result(future) or []]
+        return self.routers
+
+    def __DescribeDevices(self, pipe, router, types):
+        ''' types is a list of ((subnet, device), type answered by the router) '''
+        found = []
+        for (subnet, device), deviceType in types:
+            if deviceType is None:
+                continue  # Nothing on that address
+            found.append((HelvarDevice(router + "." + str(subnet) + "." + str(device),
+                                       int(deviceType) if deviceType.isdigit() else deviceType),
+                          pipe.QueryDeviceDescription(subnet, device),
+                          pipe.QueryDeviceState(subnet, device)))
+        devices = []
+        for device, description, state in found:
+            device.description = _Found(description) or ""
+            state = _Found(state)
+            device.state = int(state) if state and state.isdigit() else 0
+            devices.append(device)
+        return devices
+
+    def __QueryTypes(self, pipe, addresses):
+        # Every query is sent before waiting for the first answer
+        futures = [(address, pipe.QueryDeviceType(*address)) for address in addresses]
+        return [(address, _Found(future)) for address, future in futures]
+
+    def __ScanRouter(self, router):
+        with self.__Pipeline(router) as pipe:
+            types = self.__QueryTypes(
+                pipe, [(subnet, device) for subnet in self.subnets for device in self.addresses])
+            return self.__DescribeDevices(pipe, router, types)
+
+    def ScanGroups(self):
+        with HelvarNetPipeline(self.server, self.port, self.maxInFlight, self.timeout, self.metrics) as pipe:
+            groups = [int(group) for group in _Found(pipe.QueryGroups()) or [] if group.isdigit()]
+            details = [(group, pipe.QueryGroupDescription(group), pipe.QueryGroup(group))
+                       for group in groups]
+            self.groups = {group: HelvarGroup(group, _Found(description) or "", _Found(members) or [])
+                           for group, description, members in details}
+        return self.groups
+
+    def Scan(self, routers=None):
+        ''' Full scan, routers is a list of "cluster.router" strings, by
+        default they are discovered with QueryClusters and QueryRouters
+        '''
+        self.routers = list(routers) if routers is not None else self.DiscoverRouters()
+        outcome = self.__ForEachRouter(self.routers, self.__ScanRouter)
+        self.devices = {address: device for address, device in self.devices.items()
+                        if device.router in outcome.errors}
+        for devices in outcome.results.values():
+            for device in devices:
+                self.devices[device.address] = device
+        self.errors = outcome.errors
+        try:
+            self.ScanGroups()
+        except OSError as error:
+            _LOGGER.warning("Groups not scanned, keeping what was known: %s", error)
+            self.errors["groups"] = error
+        self.scanned = time.time()
+        return self
+
+    def __RefreshRouter(self, router):
+        known = [device for device in self.devices.values() if device.router == router]
+        with self.__Pipeline(router) as pipe:
+            types = self.__QueryTypes(pipe, [(device.subnet, device.device) for device in known])
+            changed = [(device.address, address, deviceType)
+                       for device, (address, deviceType) in zip(known, types)
+                       if deviceType != str(device.type)]
+            rescanned = self.__DescribeDevices(
+                pipe, router, [(address, deviceType) for old, address, deviceType in changed])
+        return [old for old, address, deviceType in changed], rescanned
+
+    def Refresh(self):
+        ''' Checks the type of every known device with a single query each and
+        asks again for the details of the ones that changed, devices that are
+        gone are removed. Returns the addresses that changed, the devices of
+        the routers in errors are left as they were.
+        '''
+        changedAddresses = []
+        outcome = self.__ForEachRouter(self.routers, self.__RefreshRouter)
+        self.errors = outcome.errors
+        for changed, rescanned in outcome.results.values():
+            for address in changed:
+                self.devices.pop(address, None)
+            for device in rescanned:
+                self.devices[device.address] = device
+            changedAddresses += changed
+        self.scanned = time.time()
+        return changedAddresses
+
+    def GroupsOf(self, address):
+        ''' Groups the device is a member of '''
+        return [group.group for group in self.groups.values() if address in group.members]
+
+    def Save(self, path):
+        snapshot = {
+            "version": self.SNAPSHOT_VERSION,
+            "scanned": self.scanned,
+            "routers": self.routers,
+            "devices": [dataclasses.asdict(device) for device in self.devices.values()],
+            "groups": [dataclasses.asdict(group) for group in self.groups.values()],
+        }
+        with open(path, "w") as f:
+            json.dump(snapshot, f)
+
+    @classmethod
+    def Load(cls, path, server, port, **options):
+        with open(path) as f:
+            snapshot = json.load(f)
+        if snapshot.get("version") != cls.SNAPSHOT_VERSION:
+            raise ValueError("Unsupported inventory snapshot version")
+        inventory = cls(server, port, **options)
+        inventory.scanned = snapshot["scanned"]
+        inventory.routers = snapshot["routers"]
+        inventory.devices = {device["address"]: HelvarDevice(**device) for device in snapshot["devices"]}
+        inventory.groups = {group["group"]: HelvarGroup(**group) for group in snapshot["groups"]}
+        return inventory
+
+
+@dataclasses.dataclass
+class HelvarNetResults:
+    ''' Outcome of a call fanned out to several routers (or devices), keyed by
+    "cluster.router" (or device address). A failure on one of them doesn't
+    fail the others, it ends up in errors.
+    '''
+    results: dict = dataclasses.field(default_factory=dict)
+    errors: dict = dataclasses.field(default_factory=dict)
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+class HelvarNetCluster:
+    ''' Talks to every router of the workgroup, each one through its own
+    pooled HelvarNetClient (created on first use with the options given
+    here, e.g. maxConnections, timeout, cache, metrics or transport).
+    Routers are "cluster.router" strings, from config or discovered with
+    QueryClusters and QueryRouters through the router at server:
+
+        site = HelvarNetCluster("192.168.0.200", 50000)
+        site.Discover()
+        level = site.Call("1.12.1.5", "QueryLoadLevel")
+        outcome = site.SetRouterCurrentDateTime()
+        print(outcome.results, outcome.errors)
+
+    Device calls are sent to the router the address belongs to, calls for
+    the whole site run on every router at the same time from a pool of
+    worker threads, with the priority and deadline of the caller. Pass
+    breaker to give every router its own circuit breaker, so a router that
+    is down fails fast and doesn't hold up the workers.
+    '''
+
+    def __init__(self, server, port, routers=None, workers=16, **options):
+        self.server = server
+        self.port = port
+        self.routers = list(routers) if routers is not None else []
+        self.options = options
+        self.__clients = {}  # "cluster.router" -> HelvarNetClient
+        self.__lock = threading.Lock()
+        self.__executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def RouterIP(self, router):
+        return RouterIP(self.server, router)
+
+    def Discover(self):
+        ''' Asks the router at server for the clusters and the routers in them '''
+        client = self.Client(self.server.split(".", 2)[2])
+        self.routers = [cluster + "." + member
+                        for cluster in client.QueryClusters() for member in client.QueryRouters(cluster)]
+        return self.routers
+
+    def Client(self, router):
+        with self.__lock:
+            client = self.__clients.get(router)
+            if client is None:
+                client = self.__clients[router] = HelvarNetClient(self.RouterIP(router), self.port, **self.options)
+            return client
+
+    def Call(self, address, method, *args):
+        ''' Runs a device method on the router of address ("cluster.router.subnet.device"
+        or a 4-tuple), e.g. Call("1.12.1.5", "SetDeviceAbsoluteLevel", 50, 0)
+        '''
+        cluster, router, subnet, device = (address.split(".") if isinstance(address, str)
+                                           else [str(part) for part in address])
+        return getattr(self.Client(cluster + "." + router), method)(subnet, device, *args)
+
+    def __Gather(self, futures):
+        outcome = HelvarNetResults()
+        for key, future in futures:
+            try:
+                outcome.results[key] = future.result()
+            except Exception as error:
+                outcome.errors[key] = error
+        return outcome
+
+    def CallMany(self, addresses, method, *args):
+        ''' Call() for every address in parallel, results by address '''
+        return self.__Gather([(_AddressText(address), self.__executor.submit(_InContext(self.Call), address, method, *args))
+                              for address in addresses])
+
+    def FanOut(self, method, *args, routers=None):
+        ''' Runs a method on every router (or the ones in routers) at the same
+        time, e.g. FanOut("RecallSceneOnGroup", 10, 1, 6, 500)
+        '''
+        return self.__Gather([(router, self.__executor.submit(
+                                  _InContext(lambda router: getattr(self.Client(router), method)(*args)), router))
+                              for router in (self.routers if routers is None else routers)])
+
+    def SetRouterCurrentDateTime(self):
+        return self.FanOut("SetRouterCurrentDateTime")
+
+    def Close(self):
+        self.__executor.shutdown()
+        with self.__lock:
+            clients, self.__clients = list(self.__clients.values()), {}
+        for client in clients:
+            client.Close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+
+class HelvarNetPlanner:
+    ''' Turns a target per device into as few commands as possible, using
+    the group membership (inventory.groups, or a {group: [addresses]} dict):
+
+        planner = HelvarNetPlanner(inventory.groups)
+        plan = planner.PlanLevels({"1.10.1.1": 50, "1.10.1.2": 50, "1.10.1.3": 20})
+        router.SendMany(plan)
+
+    Groups are tried from the biggest to the smallest, a group is only used
+    when every member has a target (the devices left out must not change)
+    and it saves commands: its most common target has to be right for at
+    least two more devices than before. Smaller groups sent later overwrite
+    the bigger ones, the devices still wrong after all the group commands
+    get their own command. The plan is a list of (command, values) for
+    SendMany, with full device addresses.
+    '''
+
+    def __init__(self, groups):
+        self.groups = {int(group): [str(address) for address in
+                                    (members.members if isinstance(members, HelvarGroup) else members)]
+                       for group, members in groups.items()}
+
+    def __Plan(self, targets):
+        ''' [(group, target)] and [(address, target)] that reach targets '''
+        targets = {_AddressText(address): target for address, target in targets.items()}
+        planned = {}  # address -> what the plan leaves it at
+        groupCommands = []
+        candidates = sorted((group for group, members in self.groups.items()
+                             if members and all(member in targets for member in members)),
+                            key=lambda group: (-len(self.groups[group]), group))
+        for group in candidates:
+            members = self.groups[group]
+            target = collections.Counter(targets[member] for member in members).most_common(1)[0][0]
+            fixed = sum(1 for member in members if targets[member] == target != planned.get(member))
+            broken = sum(1 for member in members if planned.get(member) == targets[member] != target)
+            if fixed - broken > 1:
+                groupCommands.append((group, target))
+                for member in members:
+                    planned[member] = target
+        deviceCommands = [(address, target) for address, target in targets.items()
+                          if planned.get(address) != target]
+        return groupCommands, deviceCommands
+
+    def PlanLevels(self, targets, fade=0):
+        ''' targets: {address: level} '''
+        groupCommands, deviceCommands = self.__Plan(targets)
+        return ([(13, (group, level, fade)) for group, level in groupCommands] +
+                [(14, (level, fade, tuple(address.split(".")))) for address, level in deviceCommands])
+
+    def PlanProportions(self, targets, fade=0):
+        ''' targets: {address: proportion}, only absolute proportions can be
+        planned, relative ones would add up on devices in several groups
+        '''
+        groupCommands, deviceCommands = self.__Plan(targets)
+        return ([(15, (group, proportion, fade)) for group, proportion in groupCommands] +
+                [(16, (proportion, fade, tuple(address.split("."))))
+                 for address, proportion in deviceCommands])
+
+    def PlanScenes(self, targets, fade=0):
+        ''' targets: {address: (block, scene)} '''
+        groupCommands, deviceCommands = self.__Plan(
+            {address: tuple(scene) for address, scene in targets.items()})
+        return ([(11, (group, block, scene, fade)) for group, (block, scene) in groupCommands] +
+                [(12, (block, scene, fade, tuple(address.split("."))))
+                 for address, (block, scene) in deviceCommands])
+
+
+class HelvarDeviceState(enum.IntFlag):
+    ''' Bits of the device state answered to QueryDeviceState (C:110) '''
+    DISABLED = 0x00000001
+    LAMP_FAILURE = 0x00000002
+    MISSING = 0x00000004
+    FAULTY = 0x00000008
+    REFRESHING = 0x00000010
+    EMERGENCY_RESTING = 0x00000100
+    IN_EMERGENCY = 0x00000400
+    IN_PROLONG = 0x00000800
+    FUNCTION_TEST_IN_PROGRESS = 0x00001000
+    DURATION_TEST_IN_PROGRESS = 0x00002000
+    DURATION_TEST_PENDING = 0x00010000
+    FUNCTION_TEST_PENDING = 0x00020000
+    BATTERY_FAILURE = 0x00040000
+    EMERGENCY_INHIBIT = 0x00200000
+    FUNCTION_TEST_REQUESTED = 0x00400000
+    DURATION_TEST_REQUESTED = 0x00800000
+    UNKNOWN = 0x01000000
+    OVER_TEMPERATURE = 0x02000000
+    OVER_CURRENT = 0x04000000
+    COMMS_ERROR = 0x08000000
+    SEVERE_ERROR = 0x10000000
+    BAD_REPLY = 0x20000000
+    DEVICE_MISMATCH = 0x80000000
+
+
+class HelvarNetStateMirror:
+    ''' Live copy of the load level and state of many devices, kept in
+    array columns (one row per device) instead of dicts of strings:
+
+        mirror = HelvarNetStateMirror.FromInventory(inventory)
+        mirror.Refresh()  # Every device
+        mirror.Refresh(100)  # The next 100 devices, round robin
+        mirror.Faulty(), mirror.MeanLevels()
+
+    Disabled, missing and faulty come from the state bitmask, so a refresh
+    costs two queries per device (QueryDeviceState and QueryLoadLevel), sent
+    through a pipeline per router that stays open until Close().
+    Everything else is answered from the columns without the network.
+    '''
+
+    NO_LEVEL = 255  # Level of the devices that were never refreshed
+
+    def __init__(self, server, port, addresses, groups=None, maxInFlight=64, timeout=10, metrics=None):
+        self.server = server
+        self.port = port
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.metrics = metrics
+        self.addresses = [_AddressText(address) for address in addresses]
+        self.keys = [self.__Key(address) for address in self.addresses]  # row -> (router, subnet, device)
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        count = len(self.addresses)
+        self.levels = array.array("B", [self.NO_LEVEL]) * count
+        self.states = array.array("L", [0]) * count
+        self.updated = array.array("d", [0.0]) * count  # Epoch of the last refresh
+        self.errors = 0  # Queries that failed, their rows keep the old values
+        self.groups = {}  # group -> rows of its members
+        for group, members in (groups or {}).items():
+            members = members.members if isinstance(members, HelvarGroup) else members
+            self.groups[int(group)] = array.array("L", [self.rows[key] for key in map(self.__Key, members)
+                                                        if key in self.rows])
+        self.__cursor = 0
+        self.__pipelines = {}  # router -> HelvarNetPipeline
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def FromInventory(cls, inventory, **options):
+        return cls(inventory.server, inventory.port, sorted(inventory.devices), inventory.groups, **options)
+
+    @staticmethod
+    def __Key(address):
+        cluster, member, subnet, device = (address.split(".") if isinstance(address, str) else address)
+        return str(cluster) + "." + str(member), int(subnet), int(device)
+
+    def __Pipeline(self, router):
+        with self.__lock:
+            pipe = self.__pipelines.get(router)
+            if pipe is None:
+                pipe = self.__pipelines[router] = HelvarNetPipeline(
+                    RouterIP(self.server, router), self.port, self.maxInFlight, self.timeout, self.metrics)
+            return pipe
+
+    def __RefreshRouter(self, router, keys):
+        pipe = self.__Pipeline(router)
+        futures = [(row, pipe.QueryDeviceState(subnet, device), pipe.QueryLoadLevel(subnet, device))
+                   for row, subnet, device in keys]
+        now = time.time()
+        for row, state, level in futures:
+            state, level = _Result(state), _Result(level)
+            if state is not None and state.isdigit():
+                self.states[row] = int(state)
+            else:
+                self.errors += 1
+            if level is not None and level.isdigit():
+                self.levels[row] = min(int(level), 254)
+            else:
+                self.errors += 1
+            if state is not None or level is not None:
+                self.updated[row] = now
+
+    def Refresh(self, count=None):
+        ''' Refreshes the next count devices (all of them by default), the
+        routers at the same time. Returns the number of devices refreshed.
+        '''
+        total = len(self.addresses)
+        count = total if count is None else min(count, total)
+        if not count:
+            return 0
+        byRouter = {}
+        for offset in range(count):
+            row = (self.__cursor + offset) % total
+            router, subnet, device = self.keys[row]
+            byRouter.setdefault(router, []).append((row, subnet, device))
+        self.__cursor = (self.__cursor + count) % total
+        _ForEachRouter(byRouter.items(), self.__RefreshRouter)
+        return count
+
+    def Update(self, address, level=None, state=None):
+        ''' Stores what we know from somewhere else, e.g. a level we just set '''
+        row = self.rows[self.__Key(address)]
+        if level is not None:
+            self.levels[row] = min(int(level), 254)
+        if state is not None:
+            self.states[row] = int(state)
+        self.updated[row] = time.time()
+
+    def Level(self, address):
+        level = self.levels[self.rows[self.__Key(address)]]
+        return None if level == self.NO_LEVEL else level
+
+    def State(self, address):
+        return HelvarDeviceState(self.states[self.rows[self.__Key(address)]])
+
+    def Where(self, flags):
+        ''' Addresses of the devices with any of the flags set '''
+        flags = int(flags)
+        return [self.addresses[row] for row, state in enumerate(self.states) if state & flags]
+
+    def Faulty(self):
+        return self.Where(HelvarDeviceState.FAULTY)
+
+    def Missing(self):
+        return self.Where(HelvarDeviceState.MISSING)
+
+    def Disabled(self):
+        return self.Where(HelvarDeviceState.DISABLED)
+
+    def MeanLevel(self, group):
+        ''' Mean level of the members of group that were refreshed, None if none was '''
+        levels = [level for level in map(self.levels.__getitem__, self.groups.get(int(group), ()))
+                  if level != self.NO_LEVEL]
+        return sum(levels) / len(levels) if levels else None
+
+    def MeanLevels(self):
+        return {group: self.MeanLevel(group) for group in self.groups}
+
+    def Close(self):
+        with self.__lock:
+            pipelines, self.__pipelines = list(self.__pipelines.values()), {}
+        for pipe in pipelines:
+            pipe.Close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+
+@dataclasses.dataclass
+class HelvarNetPollEvent:
+    address: str
+    method: str
+    previous: object  # None the first time the value is read
+    value: object
+    time: float  # Epoch
+
+
+# Fastest and slowest seconds between two polls of the same device, a value
+# that changes is polled at the fastest rate again. The critical ones never
+# wait long.
+POLL_INTERVALS = {
+    "QueryDeviceIsFaulty": (5, 120),
+    "QueryDeviceIsMissing": (5, 120),
+    "QueryDeviceState": (5, 120),
+    "QueryEmergencyBatteryFailure": (30, 900),
+    "QueryLoadLevel": (2, 60),
+}
+
+
+class HelvarNetPoller:
+    ''' Polls device queries on the clients of a HelvarNetCluster (or a
+    single HelvarNetClient), every (device, query) at its own pace: after
+    each poll without a change the wait grows by backoff up to the slowest
+    interval, and a change brings it back to the fastest one. No router
+    gets more than rps requests per second, the polls that have to wait
+    keep their order. Changes are delivered to the subscribers:
+
+        poller = HelvarNetPoller(site, rps=20)
+        poller.Watch(inventory.devices, "QueryDeviceIsFaulty")
+        poller.Subscribe(lambda event: print(event.address, event.value))
+        poller.Start()
+
+    Subscribers run in the worker threads, the first value read of every
+    device is an event too (previous is None). Use clients without a cache,
+    or the cached answers hide the changes.
+    '''
+
+    def __init__(self, clients, rps=10, workers=8, backoff=2.0):
+        self.clients = clients
+        self.rps = rps
+        self.backoff = backoff
+        self.values = {}  # (address, method) -> last value
+        self.polls = 0
+        self.errors = 0
+        self.__entries = {}  # (address, method) -> [interval, fastest, slowest, sequence]
+        self.__heap = []  # (due, sequence, (address, method))
+        self.__sequence = 0
+        self.__buckets = {}  # router -> _TokenBucket
+        self.__subscribers = []
+        self.__workers = workers
+        self.__executor = None
+        self.__thread = None
+        self.__stopped = True
+        self.__lock = threading.Condition()
+
+    def __Client(self, router):
+        if isinstance(self.clients, HelvarNetCommands):
+            if router != self.clients.clusterID + "." + self.clients.memberID:
+                raise ValueError("Device of another router: " + router)
+            return self.clients
+        return self.clients.Client(router)
+
+    def __Schedule(self, key, due):
+        entry = self.__entries[key]
+        self.__sequence += 1
+        entry[3] = self.__sequence
+        heapq.heappush(self.__heap, (due, self.__sequence, key))
+        self.__lock.notify()
+
+    def Watch(self, addresses, method, fastest=None, slowest=None):
+        ''' Starts polling method (a device query like "QueryDeviceIsFaulty")
+        on every address, the intervals default to POLL_INTERVALS
+        '''
+        defaults = POLL_INTERVALS.get(method, (10, 300))
+        fastest = defaults[0] if fastest is None else fastest
+        slowest = defaults[1] if slowest is None else slowest
+        now = time.monotonic()
+        with self.__lock:
+            for address in addresses:
+                key = (str(address), method)
+                if key not in self.__entries:
+                    self.__entries[key] = [fastest, fastest, slowest, 0]
+                    self.__Schedule(key, now)
+
+    def Unwatch(self, addresses, method):
+        with self.__lock:
+            for address in addresses:
+                self.__entries.pop((str(address), method), None)
+
+    def Subscribe(self, callback):
+        self.__subscribers.append(callback)
+
+    def __Next(self):
+        ''' Waits for a poll that is due and within its router budget '''
+        with self.__lock:
+            while not self.__stopped:
+                if not self.__heap:
+                    self.__lock.wait()
+                    continue
+                due, sequence, key = self.__heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self.__lock.wait(due - now)
+                    continue
+                heapq.heappop(self.__heap)
+                entry = self.__entries.get(key)
+                if entry is None or entry[3] != sequence:
+                    continue  # Unwatched, or scheduled again since
+                router = _RouterOf(key[0])
+                bucket = self.__buckets.get(router)
+                if bucket is None:
+                    bucket = self.__buckets[router] = _TokenBucket(self.rps)
+                wait = bucket.Take(now)
+                if wait:
+                    # Keeps its place in the queue of that router
+                    heapq.heappush(self.__heap, (now + wait, sequence, key))
+                    continue
+                return key
+            return None
+
+    def __Poll(self, key):
+        address, method = key
+        cluster, member, subnet, device = address.split(".")
+        try:
+            value = getattr(self.__Client(cluster + "." + member), method)(subnet, device)
+            failed = False
+        except Exception:
+            value = None
+            failed = True
+        event = None
+        with self.__lock:
+            self.polls += 1
+            self.errors += failed
+            entry = self.__entries.get(key)
+            if entry is None:
+                return
+            interval, fastest, slowest, sequence = entry
+            if not failed and (key not in self.values or self.values[key] != value):
+                event = HelvarNetPollEvent(address, method, self.values.get(key), value, time.time())
+                self.values[key] = value
+                interval = fastest
+            else:
+                interval = min(interval * self.backoff, slowest)
+            entry[0] = interval
+            # A little jitter, so the devices watched together spread out
+            self.__Schedule(key, time.monotonic() + interval * random.uniform(0.9, 1.1))
+        if event is not None:
+            for callback in self.__subscribers:
+                callback(event)
+
+    def __Run(self):
+        # At most one poll per worker in flight, the rest wait in the heap
+        slots = threading.Semaphore(self.__workers)
+        while True:
+            slots.acquire()
+            key = self.__Next()
+            if key is None:
+                return
+            self.__executor.submit(self.__Poll, key).add_done_callback(lambda done: slots.release())
+
+    def Start(self):
+        with self.__lock:
+            if not self.__stopped:
+                return
+            self.__stopped = False
+        self.__executor = concurrent.futures.ThreadPoolExecutor(self.__workers)
+        self.__thread = threading.Thread(target=self.__Run, daemon=True)
+        self.__thread.start()
+
+    def Stop(self):
+        with self.__lock:
+            self.__stopped = True
+            self.__lock.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__executor.shutdown()
+            self.__thread = None
+
+    def __enter__(self):
+        self.Start()
+        return self
+
+    def __exit__(self, *exc):
+        self.Stop()
+
+
+@dataclasses.dataclass
+class HelvarEmergencyResult:
+    address: str
+    functionTestTime: int = None
+    functionTestState: int = None
+    durationTestTime: int = None
+    durationTestState: int = None
+    batteryCharge: int = None
+    batteryTime: int = None
+    totalLampTime: int = None
+    batteryFailure: bool = None
+    error: str = None  # First query that failed, the row is swept again on resume
+    time: float = None  # Epoch
+
+
+# Result field -> query of every emergency fitting
+_EMERGENCY_QUERIES = (
+    ("functionTestTime", "QueryEmergencyFunctionTestTime"),
+    ("functionTestState", "QueryEmergencyFunctionTestState"),
+    ("durationTestTime", "QueryEmergencyDurationTestTime"),
+    ("durationTestState", "QueryEmergencyDurationTestState"),
+    ("batteryCharge", "QueryEmergencyBatteryCharge"),
+    ("batteryTime", "QueryEmergencyBatteryTime"),
+    ("totalLampTime", "QueryEmergencyTotalLampTime"),
+    ("batteryFailure", "QueryEmergencyBatteryFailure"),
+)
+
+
+def _IsEmergency(deviceType):
+    # DALI devices (protocol 0x01 in the low byte) of DALI device type 1
+    return isinstance(deviceType, int) and deviceType & 0xFFFF == 0x0101
+
+
+class HelvarNetEmergencySweep:
+    ''' Collects the emergency test results of many fittings, the routers at
+    the same time and every fitting's queries pipelined, and streams a
+    HelvarEmergencyResult per fitting to a CSV or JSON lines report:
+
+        sweep = HelvarNetEmergencySweep.FromInventory(inventory)
+        sweep.Run("emergency.csv")
+
+    Rows are written as soon as they're complete, at most chunk fittings
+    per router are in flight, so memory doesn't grow with the site. Run()
+    appends to an existing report and skips the fittings already in it, an
+    interrupted sweep goes on from where it stopped (fittings with an error
+    are swept again, the last row of a fitting is the good one).
+    '''
+
+    FIELDS = [field.name for field in dataclasses.fields(HelvarEmergencyResult)]
+
+    def __init__(self, server, port, addresses, maxInFlight=64, timeout=10, chunk=32, metrics=None):
+        self.server = server
+        self.port = port
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.chunk = chunk
+        self.metrics = metrics
+        self.addresses = [_AddressText(address) for address in addresses]
+        self.written = 0
+        self.failed = 0
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def FromInventory(cls, inventory, **options):
+        ''' Every emergency fitting (DALI device type 1) of the inventory '''
+        return cls(inventory.server, inventory.port,
+                   sorted(address for address, device in inventory.devices.items() if _IsEmergency(device.type)),
+                   **options)
+
+    @staticmethod
+    def __Format(path, format):
+        if format is None:
+            format = "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+        if format not in ("csv", "jsonl"):
+            raise ValueError("Unknown report format: " + str(format))
+        return format
+
+    def Done(self, path, format=None):
+        ''' Addresses with a complete row in the report '''
+        format = self.__Format(path, format)
+        if not os.path.exists(path):
+            return set()
+        done = set()
+        with open(path, newline="") as f:
+            rows = csv.DictReader(f) if format == "csv" else (json.loads(line) for line in f if line.strip())
+            for row in rows:
+                if row.get("error"):
+                    done.discard(row["address"])
+                else:
+                    done.add(row["address"])
+        return done
+
+    @staticmethod
+    def __Value(answer):
+        if isinstance(answer, str) and answer.lstrip("-").isdigit():
+            return int(answer)
+        return answer
+
+    def __SweepRouter(self, router, addresses, write):
+        with HelvarNetPipeline(RouterIP(self.server, router), self.port,
+                               self.maxInFlight, self.timeout, self.metrics) as pipe:
+            for start in range(0, len(addresses), self.chunk):
+                pending = []
+                for address in addresses[start:start + self.chunk]:
+                    cluster, member, subnet, device = address.split(".")
+                    pending.append((address, [(field, getattr(pipe, method)(subnet, device))
+                                              for field, method in _EMERGENCY_QUERIES]))
+                for address, futures in pending:
+                    result = HelvarEmergencyResult(address)
+                    for field, future in futures:
+                        try:
+                            setattr(result, field, self.__Value(future.result()))
+                        except (HelvarNetError, TimeoutError, ConnectionError) as error:
+                            result.error = result.error or field + ": " + str(error)
+                    result.time = time.time()
+                    write(result)
+
+    def Run(self, path, format=None, resume=True):
+        ''' Sweeps the fittings not in the report yet (all of them with
+        resume=False, which starts a new report). Returns the rows written.
+        '''
+        format = self.__Format(path, format)
+        done = self.Done(path, format) if resume else set()
+        fresh = not resume or not os.path.exists(path) or not os.path.getsize(path)
+        byRouter = {}
+        for address in self.addresses:
+            if address not in done:
+                byRouter.setdefault(_RouterOf(address), []).append(address)
+        written = 0
+        with open(path, "w" if fresh else "a", newline="") as f:
+            writer = csv.DictWriter(f, self.FIELDS) if format == "csv" else None
+            if writer is not None and fresh:
+                writer.writeheader()
+
+            def Write(result):
+                nonlocal written
+                row = dataclasses.asdict(result)
+                with self.__lock:
+                    if writer is not None:
+                        writer.writerow(row)
+                    else:
+                        f.write(json.dumps(row) + "\n")
+                    # Flushed row by row, an interruption loses nothing written
+                    f.flush()
+                    written += 1
+                    self.written += 1
+                    self.failed += result.error is not None
+
+            _ForEachRouter(((router, addresses, Write) for router, addresses in byRouter.items()),
+                           self.__SweepRouter)
+        return written
+
+
+class _RingBuffer:
+    ''' The last capacity (time, value) samples, in two arrays '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array("d", [0.0]) * capacity
+        self.values = array.array("f", [0.0]) * capacity  # Watts don't need doubles
+        self.count = 0
+        self.next = 0
+
+    def __len__(self):
+        return self.count
+
+    def Append(self, when, value):
+        self.times[self.next] = when
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def Items(self, since=None):
+        ''' (time, value) from the oldest to the newest, the ones after since '''
+        start = (self.next - self.count) % self.capacity
+        for offset in range(self.count):
+            index = (start + offset) % self.capacity
+            if since is None or self.times[index] >= since:
+                yield self.times[index], self.values[index]
+
+
+class HelvarNetPowerTelemetry:
+    ''' Samples the power consumption of devices and groups every interval
+    seconds, the devices of every router in parallel through pipelines, and
+    keeps the last capacity samples of each series in ring buffers, so the
+    memory used doesn't grow however long it runs:
+
+        telemetry = HelvarNetPowerTelemetry.FromInventory(inventory, interval=60)
+        telemetry.Start()
+        telemetry.Mean(("group", 5), window=3600)
+        telemetry.ByGroup(window=900)
+
+    Series are ("device", address) and ("group", group). The windows are
+    seconds back from now.
+    '''
+
+    BINARY_MAGIC = b"HVPT"
+    BINARY_VERSION = 1
+
+    def __init__(self, server, port, devices=(), groups=(), interval=60, capacity=1440,
+                 maxInFlight=64, timeout=10, metrics=None):
+        self.server = server
+        self.port = port
+        self.interval = interval
+        self.capacity = capacity
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.metrics = metrics
+        self.devices = [_AddressText(device) for device in devices]
+        # groups is a list of groups, or {group: members} to add up devices by group
+        self.members = {}
+        if isinstance(groups, dict):
+            self.members = {int(group): list(members.members if isinstance(members, HelvarGroup) else members)
+                            for group, members in groups.items()}
+        self.groups = [int(group) for group in groups]
+        self.series = {}  # key -> _RingBuffer
+        self.samples = 0
+        self.errors = 0
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    @classmethod
+    def FromInventory(cls, inventory, **options):
+        return cls(inventory.server, inventory.port, sorted(inventory.devices), inventory.groups, **options)
+
+    def __Append(self, key, when, answer):
+        try:
+            value = float(answer)
+        except (TypeError, ValueError):
+            self.errors += 1
+            return
+        with self.__lock:
+            buffer = self.series.get(key)
+            if buffer is None:
+                buffer = self.series[key] = _RingBuffer(self.capacity)
+            buffer.Append(when, value)
+            self.samples += 1
+
+    def __SampleRouter(self, router, devices, groups, when):
+        with HelvarNetPipeline(RouterIP(self.server, router), self.port,
+                               self.maxInFlight, self.timeout, self.metrics) as pipe:
+            futures = [(("device", address), pipe.QueryDevicePowerCompsumption(*address.split(".")[2:]))
+                       for address in devices]
+            futures += [(("group", group), pipe.QueryGroupPowerCompsumption(group)) for group in groups]
+            for key, future in futures:
+                self.__Append(key, when, _Result(future))
+
+    def Sample(self):
+        ''' Takes one sample of every series now '''
+        when = time.time()
+        byRouter = {}
+        for address in self.devices:
+            byRouter.setdefault(_RouterOf(address), []).append(address)
+        # Group consumption is asked to the router we know
+        router = self.server.split(".", 2)[2]
+        work = [(router, byRouter.pop(router, []), self.groups)] if self.groups else []
+        work += [(router, devices, []) for router, devices in byRouter.items()]
+        _ForEachRouter(((router, devices, groups, when) for router, devices, groups in work), self.__SampleRouter)
+
+    def __Run(self):
+        while not self.__stopped.is_set():
+            started = time.monotonic()
+            try:
+                self.Sample()
+            except Exception:
+                _LOGGER.exception("Power sample failed")
+            self.__stopped.wait(max(self.interval - (time.monotonic() - started), 0))
+
+    def Start(self):
+        if self.__thread is None:
+            self.__stopped.clear()
+            self.__thread = threading.Thread(target=self.__Run, daemon=True)
+            self.__thread.start()
+
+    def Stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __enter__(self):
+        self.Start()
+        return self
+
+    def __exit__(self, *exc):
+        self.Stop()
+
+    ################# Aggregates #################
+    def Window(self, key, window=None):
+        ''' [(time, watts)] of a series, the last window seconds or all of them '''
+        since = None if window is None else time.time() - window
+        with self.__lock:
+            buffer = self.series.get(key)
+            return list(buffer.Items(since)) if buffer is not None else []
+
+    def Aggregate(self, key, function, window=None):
+        values = [value for when, value in self.Window(key, window)]
+        return function(values) if values else None
+
+    def Sum(self, key, window=None):
+        return self.Aggregate(key, sum, window)
+
+    def Mean(self, key, window=None):
+        return self.Aggregate(key, lambda values: sum(values) / len(values), window)
+
+    def Max(self, key, window=None):
+        return self.Aggregate(key, max, window)
+
+    def ByGroup(self, window=None):
+        ''' group -> mean watts of its devices added up, from the device series '''
+        totals = {}
+        for group, members in self.members.items():
+            means = [self.Mean(("device", str(member)), window) for member in members]
+            means = [mean for mean in means if mean is not None]
+            totals[group] = sum(means) if means else None
+        return totals
+
+    ################# Export #################
+    def ExportCSV(self, path):
+        ''' One row per sample: kind, id, time, watts '''
+        with self.__lock:
+            series = [(key, list(buffer.Items())) for key, buffer in self.series.items()]
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["kind", "id", "time", "watts"])
+            for (kind, name), items in series:
+                for when, value in items:
+                    writer.writerow([kind, name, repr(when), repr(value)])
+
+    def ExportBinary(self, path):
+        ''' Magic, version and series count, then for every series its kind
+        and id (length prefixed UTF-8), the number of samples and the sample
+        times (float64) followed by the watts (float32), little endian
+        '''
+        with self.__lock:
+            series = [(key, list(buffer.Items())) for key, buffer in self.series.items()]
+        with open(path, "wb") as f:
+            f.write(self.BINARY_MAGIC + struct.pack("<HI", self.BINARY_VERSION, len(series)))
+            for (kind, name), items in series:
+                for text in (kind, str(name)):
+                    text = text.encode()
+                    f.write(struct.pack("<H", len(text)) + text)
+                times = array.array("d", [when for when, value in items])
+                values = array.array("f", [value for when, value in items])
+                if struct.pack("=H", 1) != struct.pack("<H", 1):
+                    times.byteswap()
+                    values.byteswap()
+                f.write(struct.pack("<I", len(items)) + times.tobytes() + values.tobytes())
+
+    @classmethod
+    def ReadBinary(cls, path):
+        ''' {(kind, id): [(time, watts)]} from a file written by ExportBinary '''
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:4] != cls.BINARY_MAGIC:
+            raise ValueError("Not a power telemetry file")
+        version, count = struct.unpack_from("<HI", data, 4)
+        if version != cls.BINARY_VERSION:
+            raise ValueError("Unsupported power telemetry version")
+        offset = 10
+        series = {}
+        for _ in range(count):
+            texts = []
+            for _ in range(2):
+                size, = struct.unpack_from("<H", data, offset)
+                texts.append(data[offset + 2:offset + 2 + size].decode())
+                offset += 2 + size
+            samples, = struct.unpack_from("<I", data, offset)
+            offset += 4
+            times = array.array("d", data[offset:offset + samples * 8])
+            offset += samples * 8
+            values = array.array("f", data[offset:offset + samples * 4])
+            offset += samples * 4
+            if struct.pack("=H", 1) != struct.pack("<H", 1):
+                times.byteswap()
+                values.byteswap()
+            kind, name = texts
+            series[(kind, int(name) if kind == "group" else name)] = list(zip(times, values))
+        return series
@@ -0,0 +1,217 @@
+''' Regression tests against helvarsim, every test gets its own simulated
+workgroup listening on 127.0.cluster.router
+'''
+
+import asyncio
+import concurrent.futures
+import socket
+import time
+
+import pytest
+
+import helvargateway
+import helvarsim
+import pyhelvarnet
+
+
+@pytest.fixture
+def sim():
+    simulator = helvarsim.HelvarNetSimulator.Generate(routers=["1.10", "1.11"], devices=8, groups=2, seed=0)
+    with simulator.Start(port=0):
+        yield simulator
+
+
+def Client(sim, router="1.10", **options):
+    return pyhelvarnet.HelvarNetClient(sim.RouterIP(router), sim.port, timeout=2, **options)
+
+
+def Settle(condition, timeout=2):
+    ''' Waits until condition() is true, commands have no answer to wait for '''
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+# Connection pool
+
+def test_error_reply_of_a_command_is_not_the_answer_of_the_next_query(sim):
+    with Client(sim, maxConnections=1) as client:
+        client.SetDeviceAbsoluteLevel(1, 60, 50, 0)  # No such device: the router answers with an error
+        assert client.QueryLoadLevel(1, 1) == "0"
+        assert client.QueryLoadLevel(1, 2) == "0"
+
+
+def test_async_error_reply_of_a_command_is_not_the_answer_of_the_next_query(sim):
+    async def Run():
+        async with pyhelvarnet.AsyncHelvarNetClient(sim.RouterIP("1.10"), sim.port, maxConnections=1) as client:
+            await client.SetDeviceAbsoluteLevel(1, 60, 50, 0)
+            return await client.QueryLoadLevel(1, 1), await client.QueryLoadLevel(1, 2)
+    assert asyncio.run(Run()) == ("0", "0")
+
+
+def test_identical_queries_share_the_answer():
+    simulator = helvarsim.HelvarNetSimulator.Generate(routers=["1.10"], devices=4, seed=0, latency=0.1)
+    with simulator.Start(port=0), Client(simulator, maxConnections=8) as client:
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            levels = list(executor.map(lambda _: client.QueryLoadLevel(1, 1), range(8)))
+        assert levels == ["0"] * 8
+        assert client.coalesced > 0
+
+
+# Pipeline
+
+def test_pipeline_matches_replies_with_requests(sim):
+    sim.devices["1.10.1.3"].level = 42
+    with pyhelvarnet.HelvarNetPipeline(sim.RouterIP("1.10"), sim.port, maxInFlight=4, timeout=2) as pipe:
+        futures = [pipe.QueryLoadLevel(1, device) for device in range(1, 9)]
+        assert [future.result() for future in futures] == ["0", "0", "42", "0", "0", "0", "0", "0"]
+        with pytest.raises(pyhelvarnet.HelvarNetError) as error:
+            pipe.QueryLoadLevel(1, 99).result()
+        assert error.value.code == 11
+
+
+def test_pipeline_fails_fast_while_the_router_is_down(sim):
+    pipe = pyhelvarnet.HelvarNetPipeline(sim.RouterIP("1.10"), sim.port + 1, timeout=1, reconnectDelay=0.3)
+    try:
+        assert isinstance(pipe.QueryLoadLevel(1, 1).exception(), OSError)
+        pipe.port = sim.port
+        time.sleep(0.35)
+        assert pipe.QueryLoadLevel(1, 1).result() == "0"
+    finally:
+        pipe.Close()
+
+
+# Cache
+
+def test_commands_invalidate_the_cached_answers(sim):
+    cache = pyhelvarnet.HelvarNetCache()
+    with Client(sim, cache=cache) as client:
+        assert client.QueryLoadLevel(1, 1) == "0"
+        assert client.QueryLoadLevel(1, 2) == "0"
+        client.SetDeviceAbsoluteLevel(1, 1, 60, 0)
+        assert cache.Stats()["invalidations"] == 1  # Only the entry of 1.1
+        assert client.QueryLoadLevel(1, 1) == "60"
+        client.SetGroupAbsoluteLevel(1, 30, 0)
+        assert len(cache) == 0  # Every load level, the group could hold any device
+
+
+def test_cache_keeps_the_answers_of_each_router():
+    cache = pyhelvarnet.HelvarNetCache()
+    cache.Put("1.10", 152, ((1, 2),), "5")
+    cache.Invalidate("1.10", 14, (1, 0, ("1", "11", "1", "2")))  # 1.2 of another router
+    assert cache.Get("1.10", 152, ((1, 2),)) == "5"
+    cache.Invalidate("1.10", 14, (1, 0, ("1", "10", "1", "2")))
+    assert cache.Get("1.10", 152, ((1, 2),)) is None
+
+
+def test_planned_commands_invalidate_the_cached_answers(sim):
+    planner = pyhelvarnet.HelvarNetPlanner({1: ["1.10.1.1", "1.10.1.3"], 2: ["1.10.1.2", "1.10.1.4"]})
+    with Client(sim, cache=pyhelvarnet.HelvarNetCache()) as client:
+        assert client.QueryLoadLevel(1, 1) == "0"
+        client.SendMany(planner.PlanLevels({"1.10.1.1": 77}))
+        Settle(lambda: sim.devices["1.10.1.1"].level == 77)
+        assert client.QueryLoadLevel(1, 1) == "77"
+
+
+# Outbox and coalescing
+
+@pytest.mark.parametrize("options", [{"outboxSize": 10}, {"coalesceWindow": 0.1}])
+def test_queued_commands_invalidate_the_cache_once_sent(options):
+    simulator = helvarsim.HelvarNetSimulator.Generate(routers=["1.10"], devices=4, seed=0, latency=0.05)
+    with simulator.Start(port=0), Client(simulator, cache=pyhelvarnet.HelvarNetCache(), **options) as client:
+        assert client.QueryLoadLevel(1, 1) == "0"
+        client.SetDeviceAbsoluteLevel(1, 1, 80, 0)
+        client.QueryLoadLevel(1, 1)  # Still queued, caches the old level again
+        assert client.Flush(2)
+        Settle(lambda: simulator.devices["1.10.1.1"].level == 80)
+        assert client.QueryLoadLevel(1, 1) == "80"
+
+
+def test_outbox_collapses_the_levels_of_a_slider(sim):
+    with Client(sim, coalesceWindow=0.2) as client:
+        for level in range(10, 60, 10):
+            client.SetDeviceAbsoluteLevel(1, 1, level, 0)
+        client.SetDeviceAbsoluteLevel(1, 2, 5, 0)
+        assert client.Flush(2)
+        assert client.outbox.collapsed == 4
+        Settle(lambda: sim.devices["1.10.1.1"].level == 50 and sim.devices["1.10.1.2"].level == 5)
+
+
+# Inventory
+
+def test_inventory_scan_and_refresh(sim):
+    inventory = pyhelvarnet.HelvarNetInventory(
+        sim.RouterIP("1.10"), sim.port, timeout=2, subnets=[1], addresses=range(1, 9))
+    inventory.Scan(["1.10", "1.11"])
+    assert len(inventory.devices) == 16
+    assert inventory.errors == {}
+    assert inventory.Refresh() == []
+    sim.devices["1.11.1.4"].type = 0x0601  # Replaced by another kind of device
+    sim.devices["1.11.1.4"].description = "Replaced"
+    assert inventory.Refresh() == ["1.11.1.4"]
+    assert inventory.devices["1.11.1.4"].description == "Replaced"
+
+
+def test_inventory_keeps_the_devices_of_a_router_that_is_down(sim):
+    inventory = pyhelvarnet.HelvarNetInventory(
+        sim.RouterIP("1.10"), sim.port, timeout=1, subnets=[1], addresses=range(1, 9))
+    inventory.Scan(["1.10", "1.11"])
+    known = dict(inventory.devices)
+    with socket.socket() as closed:
+        closed.bind(("127.0.0.1", 0))
+        inventory.port = closed.getsockname()[1]  # Nothing listens there
+    assert inventory.Refresh() == []
+    assert inventory.devices == known
+    assert sorted(inventory.errors) == ["1.10", "1.11"]
+    inventory.Scan(["1.10", "1.11"])
+    assert inventory.devices == known
+    assert all(isinstance(error, OSError) for error in inventory.errors.values())
+
+
+# Gateway
+
+def test_gateway_deduplicates_and_caches_queries(sim):
+    sim.devices["1.10.1.3"].level = 12
+    with helvargateway.HelvarNetGateway(sim.RouterIP("1.10"), ["1.10", "1.11"], port=sim.port).Start(port=0) as gateway:
+        clients = [pyhelvarnet.HelvarNetClient("127.0.1.10", gateway.port, timeout=2) for _ in range(10)]
+        with concurrent.futures.ThreadPoolExecutor(10) as executor:
+            assert set(executor.map(lambda client: client.QueryLoadLevel(1, 3), clients)) == {"12"}
+        assert gateway.stats["upstream"] == 1
+        clients[0].SetDeviceAbsoluteLevel(1, 3, 42, 0)
+        Settle(lambda: sim.devices["1.10.1.3"].level == 42)
+        assert clients[1].QueryLoadLevel(1, 3) == "42"
+        with pytest.raises(pyhelvarnet.HelvarNetError):
+            clients[2].QueryLoadLevel(1, 99)
+        for client in clients:
+            client.Close()
+
+
+def test_gateway_answers_for_the_router_of_the_address(sim):
+    sim.devices["1.11.1.2"].level = 99
+    with helvargateway.HelvarNetGateway(sim.RouterIP("1.10"), ["1.10", "1.11"], port=sim.port).Start(port=0) as gateway:
+        with socket.create_connection(("127.0.1.10", gateway.port), timeout=2) as connection:
+            connection.sendall(b">V:1,C:152,@1.11.1.2#")
+            assert connection.recv(100) == b"?V:1,C:152,@1.11.1.2=99#"
+            with pyhelvarnet.HelvarNetClient("127.0.1.10", gateway.port, timeout=2) as client:
+                assert client.QueryLoadLevel(1, 2) == "0"  # Not the answer cached for 1.11.1.2
+            # A command for 1.11 sent through the connection of 1.10 drops the answer cached for 1.11
+            connection.sendall(b">V:1,C:14,L:33,F:0,@1.11.1.2#")
+            Settle(lambda: sim.devices["1.11.1.2"].level == 33)
+            with pyhelvarnet.HelvarNetClient("127.0.1.11", gateway.port, timeout=2) as client:
+                assert client.QueryLoadLevel(1, 2) == "33"
+            connection.sendall(b">V:1,C:14,L:10,F:0,@1.10.1.1#>V:1,C:14,L:20,F:0,@1.10.1.1,A:1#")
+            assert connection.recv(100) == b"?V:1,C:14,L:20,F:0,@1.10.1.1,A:1=0#"
+            assert sim.devices["1.10.1.1"].level == 20
+
+
+def test_gateway_shares_the_cache_of_the_clients(sim):
+    cache = pyhelvarnet.HelvarNetCache()
+    direct = Client(sim, cache=cache)
+    with helvargateway.HelvarNetGateway(sim.RouterIP("1.10"), ["1.10"], port=sim.port, cache=cache).Start(port=0) as gateway:
+        assert gateway.cache is cache
+        via = pyhelvarnet.HelvarNetClient("127.0.1.10", gateway.port, timeout=2)
+        assert via.QueryDeviceDescription(1, 1) == direct.QueryDeviceDescription(1, 1)
+        assert direct.QueryDeviceDescription(1, 2) == via.QueryDeviceDescription(1, 2)
+        assert cache.Stats()["hits"] == 2
+    direct.Close()